@@ -3,40 +3,76 @@ Módulo principal de la aplicación Flask para TruelieBot.
 Se encarga de inicializar la app, registrar blueprints y exponer la documentación Swagger.
 """
 
-from flask import Flask, send_from_directory
+import os
+
+from flask import Flask, current_app, send_from_directory
 from flask_swagger_ui import get_swaggerui_blueprint
+from dedup import content_index
 from routes_conversations import conversations_bp
+from routes_profiles import profiles_bp
+import metrics
+from openai_proxy import shutdown_openai_pool
+from storage import close_storage
+from write_behind import write_behind_queue
 
-app = Flask(__name__)
-app.register_blueprint(conversations_bp)
+# Swagger/OpenAPI docs
+SWAGGER_URL = "/docs"
+API_URL = "/static/swagger.json"
+
+DEBUG = os.environ.get("DEBUG", "False").lower() in ("1", "true")
 
 
-@app.route("/", methods=["GET"])
 def home():
     """Endpoint raíz para verificar el estado de la API."""
     return "API de gestión de conversaciones activa.", 200
 
 
-@app.route("/favicon.ico")
 def favicon():
     """Sirve el favicon para evitar errores 404 en navegadores."""
     return send_from_directory(
-        app.root_path,
+        current_app.root_path,
         "favicon.ico",
         mimetype="image/vnd.microsoft.icon",
     )
 
 
-# Swagger/OpenAPI docs
-SWAGGER_URL = "/docs"
-API_URL = "/static/swagger.json"
-swaggerui_blueprint = get_swaggerui_blueprint(
-    SWAGGER_URL,
-    API_URL,
-    config={"app_name": "TruelieBot API"},
-)
-app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
+def create_app():
+    """Crea y configura una instancia de la aplicación Flask."""
+    app = Flask(__name__)
+    app.register_blueprint(conversations_bp)
+    app.register_blueprint(profiles_bp)
+    app.add_url_rule("/", "home", home, methods=["GET"])
+    app.add_url_rule("/favicon.ico", "favicon", favicon)
+    metrics.init_app(app)
+
+    swaggerui_blueprint = get_swaggerui_blueprint(
+        SWAGGER_URL,
+        API_URL,
+        config={"app_name": "TruelieBot API"},
+    )
+    app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
+    # El filtro de deduplicación se carga sin bloquear las primeras peticiones
+    content_index.start_loading()
+    return app
+
+
+def shutdown_app():
+    """Libera recursos al apagar: escribe lo pendiente y cierra las conexiones."""
+    write_behind_queue.close()
+    shutdown_openai_pool()
+    close_storage()
+
+
+# Única aplicación del proceso: la sirven Gunicorn (app:app) y el servidor de desarrollo
+app = create_app()
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    try:
+        app.run(
+            host=os.environ.get("HOST", "127.0.0.1"),
+            port=int(os.environ.get("PORT", "5000")),
+            debug=DEBUG,
+        )
+    finally:
+        shutdown_app()
@@ -0,0 +1,202 @@
+"""
+Retención de conversaciones: mueve los mensajes antiguos de cada perfil a bloques
+comprimidos con zlib en la tabla conversation_archive de su shard de SQLite.
+Las lecturas por perfil los siguen devolviendo de forma transparente.
+"""
+
+import argparse
+import os
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import db
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BLOCK_SIZE = int(os.environ.get("ARCHIVE_BLOCK_SIZE", "1000"))
+# Se lee del entorno sin importar storage, que abriría la conexión a PostgreSQL
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+
+
+def check_backend(name=None):
+    """Lanza RuntimeError si el backend de almacenamiento no admite el archivado."""
+    name = name or STORAGE_BACKEND
+    if name != "sqlite":
+        raise RuntimeError(
+            f"El archivado no está soportado con STORAGE_BACKEND={name}: "
+            "solo funciona con SQLite"
+        )
+
+
+def cutoff_for(days):
+    """Fecha límite (formato de ``datetime()`` de SQLite, UTC) para ``days`` días."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def add_archived_stats(conn, profile, block):
+    """Vuelve a sumar en las tablas de resumen los mensajes de un bloque archivado.
+
+    Los triggers de borrado los descuentan al sacarlos de ``conversations``, pero
+    siguen siendo mensajes del perfil. ``block`` es una lista de filas de
+    ``db.encode_archive_block``.
+    """
+    conn.execute(
+        "INSERT INTO profile_stats (profile, message_count, total_length) "
+        "VALUES (?, ?, ?) ON CONFLICT(profile) DO UPDATE SET "
+        "message_count = message_count + excluded.message_count, "
+        "total_length = total_length + excluded.total_length",
+        (profile, len(block), sum(len(row[1]) for row in block)),
+    )
+    buckets = Counter(
+        db.LENGTH_BUCKETS[bisect_right(db.LENGTH_BUCKETS, len(row[1])) - 1]
+        for row in block
+    )
+    conn.executemany(
+        "INSERT INTO profile_length_stats (profile, bucket, message_count) "
+        "VALUES (?, ?, ?) ON CONFLICT(profile, bucket) DO UPDATE SET "
+        "message_count = message_count + excluded.message_count",
+        [(profile, bucket, count) for bucket, count in buckets.items()],
+    )
+    topics = Counter(topic for row in block for topic in row[3])
+    conn.executemany(
+        "INSERT INTO profile_topic_stats (profile, topic, message_count) "
+        "VALUES (?, ?, ?) ON CONFLICT(profile, topic) DO UPDATE SET "
+        "message_count = message_count + excluded.message_count",
+        [(profile, topic, count) for topic, count in topics.items()],
+    )
+
+
+def archive_block(path, profile, cutoff, block_size=ARCHIVE_BLOCK_SIZE):
+    """Archiva en un bloque los mensajes del perfil anteriores a ``cutoff``.
+
+    Toma como mucho ``block_size`` mensajes, por orden de id, con sus temas y su
+    último reanálisis. El bloque se escribe, los mensajes se borran de la tabla
+    activa (y de la búsqueda), sus hashes de contenido se apuntan en
+    ``conversation_archive_hashes`` y las estadísticas se restauran en una sola
+    transacción. Devuelve los mensajes archivados.
+    """
+    with db.pooled_connection(path) as conn:
+        rows = conn.execute(
+            "SELECT id, message, created_at, content_hash FROM conversations "
+            "WHERE profile = ? AND created_at < ? ORDER BY id LIMIT ?",
+            (profile, cutoff, block_size),
+        ).fetchall()
+        if not rows:
+            return 0
+        topics = {}
+        for conversation_id, topic in conn.execute(
+            "SELECT conversation_id, topic FROM conversation_topics "
+            "WHERE profile = ? AND conversation_id BETWEEN ? AND ?",
+            (profile, rows[0]["id"], rows[-1]["id"]),
+        ):
+            topics.setdefault(conversation_id, []).append(topic)
+        analyses = {
+            row[0]: list(row[1:])
+            for row in conn.execute(
+                "SELECT conversation_id, study_citation, cue_score, analyzed_at "
+                "FROM conversation_analysis "
+                "WHERE profile = ? AND conversation_id BETWEEN ? AND ?",
+                (profile, rows[0]["id"], rows[-1]["id"]),
+            )
+        }
+        block = [
+            (
+                row["id"],
+                row["message"],
+                row["created_at"],
+                topics.get(row["id"], []),
+                analyses.get(row["id"]),
+            )
+            for row in rows
+        ]
+        dates = [row["created_at"] for row in rows]
+        conn.execute(
+            "INSERT INTO conversation_archive (profile, first_id, last_id, "
+            "message_count, oldest, newest, payload) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                profile,
+                rows[0]["id"],
+                rows[-1]["id"],
+                len(rows),
+                min(dates),
+                max(dates),
+                db.encode_archive_block(block),
+            ),
+        )
+        conn.executemany(
+            "DELETE FROM conversations WHERE id = ?", [(row["id"],) for row in rows]
+        )
+        # Las copias sin hash anteriores a la deduplicación no se apuntan
+        conn.executemany(
+            "INSERT OR IGNORE INTO conversation_archive_hashes "
+            "(profile, content_hash, conversation_id) VALUES (?, ?, ?)",
+            [
+                (profile, row["content_hash"], row["id"])
+                for row in rows
+                if row["content_hash"] is not None
+            ],
+        )
+        add_archived_stats(conn, profile, block)
+    return len(rows)
+
+
+def pending_archive(path, cutoff):
+    """Mensajes anteriores a ``cutoff`` por perfil en un shard."""
+    with db.pooled_connection(path) as conn:
+        return dict(
+            conn.execute(
+                "SELECT profile, count(*) FROM conversations "
+                "WHERE created_at < ? GROUP BY profile",
+                (cutoff,),
+            ).fetchall()
+        )
+
+
+def archive(days=ARCHIVE_AFTER_DAYS, block_size=ARCHIVE_BLOCK_SIZE, dry_run=False):
+    """Archiva los mensajes con más de ``days`` días de todos los shards.
+
+    Genera ``(perfil, mensajes)`` por perfil. Cada bloque es una transacción, así
+    que puede ejecutarse con la API en marcha. Solo existe con SQLite: con otro
+    backend lanza RuntimeError.
+    """
+    check_backend()
+    cutoff = cutoff_for(days)
+    for path in db.shard_paths():
+        for profile, count in pending_archive(path, cutoff).items():
+            if dry_run:
+                yield profile, count
+                continue
+            archived = 0
+            while True:
+                moved = archive_block(path, profile, cutoff, block_size)
+                if not moved:
+                    break
+                archived += moved
+            yield profile, archived
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(
+        description="Archiva comprimidos los mensajes antiguos de cada perfil."
+    )
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--block-size", type=int, default=ARCHIVE_BLOCK_SIZE)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+    try:
+        check_backend()
+    except RuntimeError as e:
+        parser.error(str(e))
+    profiles = total = 0
+    for profile, count in archive(args.days, args.block_size, args.dry_run):
+        profiles += 1
+        total += count
+        print(f"{profile}: {count} mensajes")
+    action = "a archivar" if args.dry_run else "archivados"
+    print(f"Archivado completado: {total} mensajes {action} de {profiles} perfiles.")
+
+
+if __name__ == "__main__":
+    main()
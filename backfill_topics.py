@@ -0,0 +1,49 @@
+"""
+Tarea de relleno (backfill) de temas para conversaciones ya guardadas.
+Recorre la tabla por lotes de id y reescribe sus anotaciones en conversation_topics.
+"""
+
+import argparse
+
+from storage import annotate_topics, fetch_conversation_batch
+from topic_detection import detect_topics
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def backfill_topics(batch_size=DEFAULT_BATCH_SIZE, start_id=0):
+    """Anota los temas de todas las conversaciones con id mayor que ``start_id``.
+
+    Cada lote se escribe en una transacción y es idempotente. Genera
+    ``(ultimo_id, total_procesado)`` tras cada lote para informar del progreso.
+    """
+    last_id = start_id
+    total = 0
+    while True:
+        rows = fetch_conversation_batch(last_id, batch_size)
+        if not rows:
+            return
+        annotate_topics(
+            (row["id"], row["profile"], detect_topics(row["message"])) for row in rows
+        )
+        last_id = rows[-1]["id"]
+        total += len(rows)
+        yield last_id, total
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(
+        description="Anota los temas de las conversaciones existentes."
+    )
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--start-id", type=int, default=0)
+    args = parser.parse_args(argv)
+    total = 0
+    for last_id, total in backfill_topics(args.batch_size, args.start_id):
+        print(f"Procesados {total} mensajes (último id {last_id})")
+    print(f"Backfill completado: {total} mensajes anotados.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""
+Benchmarks reproducibles de TruelieBot: siembra de datos, microbenchmarks de los
+caminos críticos y generador de carga HTTP, con resultados en JSON comparables.
+"""
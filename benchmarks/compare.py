@@ -0,0 +1,67 @@
+"""
+Compara dos ficheros de resultados JSON y falla si hay regresiones. Uso:
+
+    python -m benchmarks.compare antes.json despues.json --threshold 10
+"""
+
+import argparse
+import json
+import sys
+
+# Métricas comparadas: (clave, True si un valor mayor es mejor)
+METRICS = (
+    ("throughput_ops_s", True),
+    ("p50_ms", False),
+    ("p95_ms", False),
+    ("p99_ms", False),
+)
+
+
+def compare(baseline, current, threshold=10.0):
+    """Devuelve ``(filas, regresiones)`` comparando los resultados por operación.
+
+    Cada fila es ``(operación, métrica, antes, después, cambio_%)``; una regresión
+    es un empeoramiento mayor que ``threshold`` por ciento.
+    """
+    rows, regressions = [], []
+    for operation, before in baseline["results"].items():
+        after = current["results"].get(operation)
+        if after is None:
+            continue
+        for metric, higher_is_better in METRICS:
+            old, new = before.get(metric), after.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            row = (operation, metric, old, new, round(change, 2))
+            rows.append(row)
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append(row)
+    return rows, regressions
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Compara resultados de benchmarks.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    args = parser.parse_args(argv)
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    rows, regressions = compare(baseline, current, args.threshold)
+    for row in rows:
+        operation, metric, old, new, change = row
+        mark = " <-- regresión" if row in regressions else ""
+        print(f"{operation:35} {metric:17} {old:>12} {new:>12} {change:+8.2f}%{mark}")
+    if regressions:
+        print(f"{len(regressions)} regresiones por encima del {args.threshold}%")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Generador de carga HTTP con perfiles de lectura y escritura mezcladas. Uso:
+
+    python -m benchmarks.loadgen --url http://127.0.0.1:8000 --mix mixed \\
+        --concurrency 16 --duration 30 --output load.json
+
+Arranca la API con MOCK_OPENAI=1 (o OPENAI_API_BASE apuntando a fake_openai.py)
+para no depender de la API real.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from benchmarks.stats import environment, summarize
+
+# Peso relativo de cada operación en cada perfil de carga
+MIXES = {
+    "read-heavy": {"list": 70, "search": 15, "advice": 10, "insert": 5},
+    "write-heavy": {"list": 15, "search": 5, "advice": 0, "insert": 80},
+    "mixed": {"list": 45, "search": 15, "advice": 10, "insert": 30},
+}
+
+SEARCH_TERMS = ["microexpresión", "tono", "mensaje", "carga cognitiva"]
+INSERT_TEXTS = [
+    "Mensaje de carga sin nada especial.",
+    "Hoy noté una microexpresión de sorpresa.",
+    "Su tono emocional cambió durante la llamada.",
+]
+
+
+def build_request(base_url, operation, profile, rng, tag=""):
+    """Construye la petición ``urllib`` de una operación.
+
+    ``tag`` se añade al mensaje de las inserciones para que cada una sea única y
+    la deduplicación no la descarte.
+    """
+    if operation == "list":
+        query = urllib.parse.urlencode({"profile": profile, "limit": 20})
+        return urllib.request.Request(f"{base_url}/api/conversations?{query}")
+    if operation == "search":
+        query = urllib.parse.urlencode(
+            {"q": rng.choice(SEARCH_TERMS), "profile": profile}
+        )
+        return urllib.request.Request(f"{base_url}/api/conversations/search?{query}")
+    if operation == "advice":
+        return urllib.request.Request(f"{base_url}/api/advice")
+    message = f"{rng.choice(INSERT_TEXTS)} #{tag}" if tag else rng.choice(INSERT_TEXTS)
+    body = json.dumps({"profile": profile, "message": message})
+    return urllib.request.Request(
+        f"{base_url}/api/conversations",
+        data=body.encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+
+
+def _worker(base_url, mix, profiles, stop_at, max_requests, seed, tag, results, lock):
+    """Lanza peticiones hasta agotar el tiempo o el número máximo de peticiones."""
+    rng = random.Random(seed)
+    operations = [op for op, weight in mix.items() if weight]
+    weights = [mix[op] for op in operations]
+    local = {op: ([], 0) for op in operations}
+    sent = 0
+    while time.monotonic() < stop_at and (not max_requests or sent < max_requests):
+        operation = rng.choices(operations, weights)[0]
+        request = build_request(
+            base_url, operation, rng.choice(profiles), rng, f"{tag}-{sent}"
+        )
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+            failed = False
+        except urllib.error.HTTPError as e:
+            # 404 en listados de perfiles vacíos es una respuesta válida
+            failed = e.code >= 500 or e.code == 429
+        except OSError:
+            failed = True
+        latencies, errors = local[operation]
+        latencies.append(time.perf_counter() - t0)
+        local[operation] = (latencies, errors + failed)
+        sent += 1
+    with lock:
+        for operation, (latencies, errors) in local.items():
+            merged = results.setdefault(operation, ([], [0]))
+            merged[0].extend(latencies)
+            merged[1][0] += errors
+
+
+def run(
+    base_url,
+    mix="mixed",
+    concurrency=8,
+    duration=10.0,
+    max_requests=0,
+    profiles=("default",),
+    seed=0,
+):
+    """Ejecuta la carga y devuelve throughput y percentiles por operación y totales.
+
+    ``max_requests`` limita las peticiones por hilo (0 = sin límite); con
+    ``seed`` fijo la secuencia de operaciones de cada hilo es reproducible. Los
+    mensajes insertados llevan un sufijo único por ejecución, hilo y petición.
+    """
+    run_id = uuid.uuid4().hex[:8]
+    results = {}
+    lock = threading.Lock()
+    start = time.perf_counter()
+    stop_at = time.monotonic() + duration
+    threads = [
+        threading.Thread(
+            target=_worker,
+            args=(
+                base_url.rstrip("/"),
+                MIXES[mix],
+                list(profiles),
+                stop_at,
+                max_requests,
+                seed + n,
+                f"{run_id}-{n}",
+                results,
+                lock,
+            ),
+        )
+        for n in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    by_operation = {
+        op: summarize(latencies, elapsed, errors[0])
+        for op, (latencies, errors) in sorted(results.items())
+    }
+    all_latencies = [t for latencies, _ in results.values() for t in latencies]
+    all_errors = sum(errors[0] for _, errors in results.values())
+    return {
+        "kind": "load",
+        "environment": environment(),
+        "parameters": {
+            "url": base_url,
+            "mix": mix,
+            "concurrency": concurrency,
+            "duration_s": duration,
+            "max_requests": max_requests,
+            "profiles": list(profiles),
+            "seed": seed,
+        },
+        "results": dict(
+            by_operation, total=summarize(all_latencies, elapsed, all_errors)
+        ),
+    }
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Generador de carga de TruelieBot.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--max-requests", type=int, default=0)
+    parser.add_argument("--profiles", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args(argv)
+    profiles = ["default"] + [f"perfil_{k}" for k in range(1, args.profiles)]
+    report = run(
+        args.url,
+        args.mix,
+        args.concurrency,
+        args.duration,
+        args.max_requests,
+        profiles,
+        args.seed,
+    )
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Microbenchmarks de los caminos críticos: lectura paginada, inserción, validación,
+detección de temas y búsqueda de estudios. Uso:
+
+    python -m benchmarks.micro --db bench.db --iterations 1000 --output micro.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import time
+import uuid
+
+from benchmarks.stats import environment, summarize
+
+SAMPLE_TEXTS = [
+    "Hola, ¿qué tal el día?",
+    "Noté una microexpresión de miedo cuando le pregunté por la cena.",
+    "Su tono emocional y su lenguaje corporal no encajaban con lo que decía.",
+    "Leí sobre la IA y el análisis de voz para detectar mentiras en entrevistas.",
+]
+SAMPLE_TOPICS = ["microexpresiones", "tono emocional", "ia", "tema desconocido"]
+SAMPLE_BODIES = [{"profile": "default", "message": text} for text in SAMPLE_TEXTS] + [
+    {"message": "Sin perfil"},
+    {"profile": 123, "message": ["no", "string"]},
+]
+
+
+def measure(func, iterations, warmup=10):
+    """Ejecuta ``func(i)`` ``iterations`` veces y resume las latencias."""
+    for i in range(min(warmup, iterations)):
+        func(i)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def _deep_cursor(profile, depth):
+    """Identificador a partir del cual empieza la página a ``depth`` filas."""
+    from storage import fetch_conversations
+
+    rows = fetch_conversations(profile, limit=1, offset=max(depth - 1, 0))
+    return rows[0]["id"] if rows else 0
+
+
+def run(iterations=1000, profile="default", depth=10000, include_writes=True):
+    """Ejecuta todos los microbenchmarks y devuelve un diccionario de resultados.
+
+    ``depth`` es la profundidad de la página usada para comparar ``offset`` frente
+    a la paginación por clave. Las inserciones escriben en el perfil
+    ``benchmark`` para no alterar los datos del resto; cada mensaje lleva un
+    sufijo único para que la deduplicación no las convierta en no-ops.
+    """
+    from db import DB_NAME
+    from lie_detection_studies import get_study_citation_by_topic
+    from schemas import conversation_schema
+    from storage import backend, fetch_conversations, insert_conversation
+    from topic_detection import detect_topics
+    from validation import validate_conversation
+
+    after_id = _deep_cursor(profile, depth)
+    cases = {
+        "fetch_conversations_first_page": lambda i: fetch_conversations(profile),
+        "fetch_conversations_deep_offset": lambda i: fetch_conversations(
+            profile, offset=depth
+        ),
+        "fetch_conversations_deep_keyset": lambda i: fetch_conversations(
+            profile, after_id=after_id
+        ),
+        "detect_topics": lambda i: detect_topics(
+            SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]
+        ),
+        "get_study_citation_by_topic": lambda i: get_study_citation_by_topic(
+            SAMPLE_TOPICS[i % len(SAMPLE_TOPICS)]
+        ),
+        # Validación anterior (marshmallow) frente a la validación rápida actual
+        "validate_conversation_schema": lambda i: conversation_schema.validate(
+            SAMPLE_BODIES[i % len(SAMPLE_BODIES)]
+        ),
+        "validate_conversation_fast": lambda i: validate_conversation(
+            SAMPLE_BODIES[i % len(SAMPLE_BODIES)]
+        ),
+    }
+    if include_writes:
+        run_id, serial = uuid.uuid4().hex[:8], itertools.count()
+        cases["insert_conversation"] = lambda i: insert_conversation(
+            "benchmark",
+            f"{SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]} #{run_id}-{next(serial)}",
+        )
+    results = {name: measure(func, iterations) for name, func in cases.items()}
+    return {
+        "kind": "micro",
+        "environment": environment(),
+        "parameters": {
+            "storage": backend.name,
+            "database": DB_NAME if backend.name == "sqlite" else None,
+            "iterations": iterations,
+            "profile": profile,
+            "depth": depth,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Microbenchmarks de TruelieBot.")
+    parser.add_argument("--db", default=os.environ.get("DATABASE_NAME"))
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--profile", default="default")
+    parser.add_argument("--depth", type=int, default=10000)
+    parser.add_argument("--no-writes", action="store_true")
+    parser.add_argument("--output", help="Fichero JSON de resultados")
+    args = parser.parse_args(argv)
+    if args.db:
+        import db
+
+        db.DB_NAME = args.db
+    report = run(args.iterations, args.profile, args.depth, not args.no_writes)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Siembra una base de datos de benchmark de tamaño configurable.
+Uso: python -m benchmarks.seed --db bench.db --messages 1000000 --profiles 100
+"""
+
+import argparse
+import os
+import time
+
+
+def seed_database(path, num_messages, num_profiles, batch_size=10000):
+    """Crea ``path`` desde cero con ``num_messages`` mensajes repartidos en perfiles."""
+    import db
+    from initialize_db import initialize_database
+
+    db.DB_NAME = path
+    start = time.perf_counter()
+    initialize_database(num_messages, num_profiles, batch_size, reset=True)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(
+        description="Siembra una base de datos de benchmark."
+    )
+    parser.add_argument("--db", default=os.environ.get("DATABASE_NAME", "bench.db"))
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--profiles", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args(argv)
+    elapsed = seed_database(args.db, args.messages, args.profiles, args.batch_size)
+    print(f"{args.messages} mensajes sembrados en {args.db} en {elapsed:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
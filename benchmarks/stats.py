@@ -0,0 +1,43 @@
+"""
+Utilidades estadísticas comunes a los benchmarks.
+"""
+
+import platform
+import sys
+import time
+
+
+def percentile(sorted_values, pct):
+    """Percentil ``pct`` (0-100) por interpolación lineal de una lista ordenada."""
+    if not sorted_values:
+        return 0.0
+    rank = (len(sorted_values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (
+        rank - low
+    )
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Resume latencias (en segundos) en throughput y percentiles en milisegundos."""
+    values = sorted(latencies)
+    return {
+        "operations": len(values),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_ops_s": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 4),
+        "p95_ms": round(percentile(values, 95) * 1000, 4),
+        "p99_ms": round(percentile(values, 99) * 1000, 4),
+        "max_ms": round(values[-1] * 1000, 4) if values else 0.0,
+    }
+
+
+def environment():
+    """Metadatos del entorno para poder comparar ejecuciones."""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+    }
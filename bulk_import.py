@@ -0,0 +1,219 @@
+"""
+Importación masiva de conversaciones desde exportaciones de WhatsApp (.txt) o NDJSON.
+Procesa la entrada en streaming, valida por lotes y escribe una transacción por lote.
+"""
+
+import argparse
+import json
+import re
+import sys
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+
+from dedup import analyze_messages, content_index
+from storage import insert_conversations
+from validation import CREATED_AT_FORMAT, validate_conversations
+
+DEFAULT_BATCH_SIZE = 500
+
+# Cabecera de WhatsApp: Android "31/12/20, 21:15 - " o iOS "[31/12/20, 21:15:30] "
+_WHATSAPP_HEADER = re.compile(
+    r"^\u200e?\[?(?P<date>\d{1,4}[./-]\d{1,2}[./-]\d{2,4}),?\s"
+    r"(?P<time>\d{1,2}:\d{2}(?::\d{2})?(?:\s?[APap]\.?\s?[Mm]\.?)?)\]?"
+    r"(?:\s-)?\s(?P<rest>.*)$"
+)
+_WHATSAPP_SENDER = re.compile(r"^(?P<sender>[^:]+):\s(?P<message>.*)$", re.DOTALL)
+_WHATSAPP_TIME = re.compile(
+    r"^(?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?"
+    r"(?:\s?(?P<meridiem>[APap])\.?\s?[Mm]\.?)?$"
+)
+
+
+def parse_whatsapp_timestamp(date, time, dayfirst=True):
+    """Fecha de una cabecera de WhatsApp en formato ``AAAA-MM-DD HH:MM:SS``.
+
+    El orden de la fecha depende del idioma del teléfono: si el año va primero o
+    uno de los dos primeros números pasa de 12 se deduce; si no, ``dayfirst``
+    decide entre día/mes y mes/día. Se guarda la hora local del teléfono, sin
+    zona horaria. Devuelve None si la fecha no es válida.
+    """
+    parts = [int(part) for part in re.split(r"[./-]", date)]
+    if len(str(parts[0])) == 4 or parts[0] > 31:
+        year, month, day = parts
+    else:
+        first, second, year = parts
+        if first > 12 or (dayfirst and second <= 12):
+            day, month = first, second
+        else:
+            month, day = first, second
+        if year < 100:
+            year += 2000
+    clock = _WHATSAPP_TIME.match(time)
+    if clock is None:
+        return None
+    hour = int(clock.group("hour"))
+    meridiem = (clock.group("meridiem") or "").lower()
+    if meridiem:
+        hour = hour % 12 + (12 if meridiem == "p" else 0)
+    try:
+        moment = datetime(
+            year,
+            month,
+            day,
+            hour,
+            int(clock.group("minute")),
+            int(clock.group("second") or 0),
+        )
+    except ValueError:
+        return None
+    return moment.strftime(CREATED_AT_FORMAT)
+
+
+def iter_text_lines(stream, encoding="utf-8"):
+    """Itera las líneas de un stream (binario o de texto) decodificadas y sin salto."""
+    first = True
+    for line in stream:
+        if isinstance(line, bytes):
+            line = line.decode(encoding, errors="replace")
+        if first:
+            line = line.lstrip("\ufeff")
+            first = False
+        yield line.rstrip("\r\n")
+
+
+def parse_whatsapp_export(lines, profile=None):
+    """Convierte las líneas de una exportación de WhatsApp en registros de conversación.
+
+    Las líneas sin cabecera de fecha se consideran continuación del mensaje anterior.
+    Los avisos del sistema (sin remitente) se descartan. Si no se indica ``profile``
+    se usa el nombre del remitente como perfil. La fecha de la cabecera se guarda
+    en ``created_at`` (se omite si no es válida).
+    """
+    pending = None
+    for line in lines:
+        header = _WHATSAPP_HEADER.match(line)
+        if header is None:
+            if pending is not None:
+                pending["message"] += "\n" + line
+            continue
+        if pending is not None:
+            yield pending
+            pending = None
+        sender = _WHATSAPP_SENDER.match(header.group("rest"))
+        if sender is None:
+            continue
+        pending = {
+            "profile": profile or sender.group("sender").strip(),
+            "message": sender.group("message"),
+        }
+        created_at = parse_whatsapp_timestamp(*header.group("date", "time"))
+        if created_at is not None:
+            pending["created_at"] = created_at
+    if pending is not None:
+        yield pending
+
+
+def parse_ndjson(lines, profile=None):
+    """Convierte líneas NDJSON en registros; las inválidas se devuelven tal cual."""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = line
+        if profile and isinstance(record, dict):
+            record.setdefault("profile", profile)
+        yield record
+
+
+PARSERS = {"whatsapp": parse_whatsapp_export, "ndjson": parse_ndjson}
+
+
+def batched(iterable, size):
+    """Agrupa un iterable en listas de como máximo ``size`` elementos."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_records(records, batch_size=DEFAULT_BATCH_SIZE):
+    """Valida e inserta registros por lotes; genera un resumen por lote.
+
+    Cada lote se valida con ``validate_conversations`` y se escribe con
+    ``insert_conversations`` en una única transacción por shard, fila a fila con
+    ``ON CONFLICT DO NOTHING`` para saltar los repetidos. El resumen incluye los
+    temas detectados en el lote y los mensajes que no se guardaron por repetir uno
+    del perfil; el análisis de un contenido repetido se reutiliza. Los registros
+    con ``created_at`` conservan su fecha; el resto se fecha al insertarlo.
+    """
+    start = 0
+    for number, batch in enumerate(batched(records, batch_size), start=1):
+        errors = validate_conversations(batch)
+        valid = [record for index, record in enumerate(batch) if index not in errors]
+        analyses = analyze_messages(record["message"] for record in valid)
+        rows = [
+            (
+                record["profile"],
+                record["message"],
+                analysis["topics"],
+                record.get("created_at"),
+            )
+            for record, (_, analysis) in zip(valid, analyses)
+        ]
+        inserted = insert_conversations(rows)
+        for record, (digest, _) in zip(valid, analyses):
+            content_index.add(record["profile"], digest)
+        topics = Counter(topic for _, _, row_topics, _ in rows for topic in row_topics)
+        yield {
+            "batch": number,
+            "received": len(batch),
+            "inserted": inserted,
+            "duplicates": len(rows) - inserted,
+            "errors": {start + index: err for index, err in errors.items()},
+            "topics": dict(topics),
+        }
+        start += len(batch)
+
+
+def import_stream(stream, fmt, profile=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Importa un stream en el formato indicado (``whatsapp`` o ``ndjson``)."""
+    parser = PARSERS[fmt]
+    return import_records(parser(iter_text_lines(stream), profile), batch_size)
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(
+        description="Importa conversaciones de WhatsApp (.txt) o NDJSON."
+    )
+    parser.add_argument("path", help="Fichero a importar ('-' para stdin)")
+    parser.add_argument("--format", choices=sorted(PARSERS), default="whatsapp")
+    parser.add_argument("--profile", help="Perfil para todos los mensajes importados")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.path == "-":
+        stream = sys.stdin.buffer
+    else:
+        stream = open(args.path, "rb")
+    inserted = duplicates = rejected = 0
+    with stream:
+        results = import_stream(stream, args.format, args.profile, args.batch_size)
+        for result in results:
+            inserted += result["inserted"]
+            duplicates += result["duplicates"]
+            rejected += len(result["errors"])
+            print(json.dumps(result, ensure_ascii=False))
+    print(
+        f"Importación completada: {inserted} insertados, {duplicates} repetidos, "
+        f"{rejected} rechazados."
+    )
+
+
+if __name__ == "__main__":
+    main()
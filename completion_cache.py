@@ -0,0 +1,240 @@
+"""
+Caché de respuestas de OpenAI direccionada por contenido.
+Nivel LRU en memoria y nivel opcional en SQLite, con TTL, límite de tamaño y contadores.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from metrics import register_collector
+
+OPENAI_CACHE_SIZE = int(os.environ.get("OPENAI_CACHE_SIZE", "1024"))
+OPENAI_CACHE_TTL = float(os.environ.get("OPENAI_CACHE_TTL", "86400"))  # 0 = sin TTL
+OPENAI_CACHE_DB = os.environ.get("OPENAI_CACHE_DB", "")  # vacío = sin nivel en disco
+OPENAI_CACHE_DB_MAX_ENTRIES = int(
+    os.environ.get("OPENAI_CACHE_DB_MAX_ENTRIES", "100000")
+)
+
+
+def normalize_prompt(prompt):
+    """Normaliza un prompt para la clave de caché (NFC y espacios colapsados)."""
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+
+def make_cache_key(prompt, model, **params):
+    """Calcula la clave a partir del prompt normalizado, el modelo y los parámetros."""
+    payload = json.dumps(
+        {"prompt": normalize_prompt(prompt), "model": model, "params": params},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Caché de dos niveles (LRU en memoria y SQLite opcional) de respuestas."""
+
+    def __init__(
+        self,
+        max_entries=OPENAI_CACHE_SIZE,
+        ttl=OPENAI_CACHE_TTL,
+        db_path=OPENAI_CACHE_DB,
+        db_max_entries=OPENAI_CACHE_DB_MAX_ENTRIES,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._conn = None
+        self._disk_entries = 0  # estimación por arriba (los reemplazos también suman)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _expired(self, created_at, now):
+        return self.ttl > 0 and now - created_at > self.ttl
+
+    def _disk(self):
+        """Abre (una vez) la conexión del nivel en disco; None si está desactivado."""
+        if not self.db_path:
+            return None
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS completion_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_completion_cache_created "
+                "ON completion_cache(created_at)"
+            )
+            self._disk_entries = self._conn.execute(
+                "SELECT count(*) FROM completion_cache"
+            ).fetchone()[0]
+        return self._conn
+
+    def _evict(self, conn):
+        """Recorta el nivel en disco cuando supera ``db_max_entries``.
+
+        Se deja un margen del 10 % por debajo del límite para no tener que recortar
+        en cada inserción; se borra lo anterior a la fecha de la última entrada que
+        se conserva, que el índice de ``created_at`` localiza sin ordenar la tabla.
+        """
+        if self._disk_entries <= self.db_max_entries:
+            return
+        keep = max(self.db_max_entries - self.db_max_entries // 10, 0)
+        row = conn.execute(
+            "SELECT created_at FROM completion_cache "
+            "ORDER BY created_at DESC LIMIT 1 OFFSET ?",
+            (max(keep - 1, 0),),
+        ).fetchone()
+        if keep == 0:
+            conn.execute("DELETE FROM completion_cache")
+        elif row is not None:
+            conn.execute("DELETE FROM completion_cache WHERE created_at < ?", row)
+        self._disk_entries = conn.execute(
+            "SELECT count(*) FROM completion_cache"
+        ).fetchone()[0]
+
+    def _remember(self, key, value, created_at):
+        """Guarda en memoria respetando el límite LRU."""
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Devuelve el valor en caché o None, actualizando los contadores."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1], now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._memory[key]
+            conn = self._disk()
+            if conn is not None:
+                row = conn.execute(
+                    "SELECT value, created_at FROM completion_cache WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None:
+                    if not self._expired(row[1], now):
+                        self._remember(key, row[0], row[1])
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return row[0]
+                    with conn:
+                        conn.execute(
+                            "DELETE FROM completion_cache WHERE key = ?", (key,)
+                        )
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """Guarda un valor en ambos niveles, aplicando el límite de tamaño en disco.
+
+        Las respuestas vacías no se guardan: se volverán a pedir.
+        """
+        if not value:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            conn = self._disk()
+            if conn is not None:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO completion_cache "
+                        "(key, value, created_at) VALUES (?, ?, ?)",
+                        (key, value, now),
+                    )
+                    self._disk_entries += 1
+                    self._evict(conn)
+
+    def get_or_compute(self, prompt, model, compute, **params):
+        """Devuelve la respuesta en caché o la calcula con ``compute()`` y la guarda.
+
+        Una respuesta vacía se devuelve pero no se guarda.
+        """
+        key = make_cache_key(prompt, model, **params)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        """Vacía ambos niveles y reinicia los contadores."""
+        with self._lock:
+            self._memory.clear()
+            conn = self._disk()
+            if conn is not None:
+                with conn:
+                    conn.execute("DELETE FROM completion_cache")
+                self._disk_entries = 0
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        """Devuelve los contadores de aciertos y fallos de la caché."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._memory),
+            }
+
+
+completion_cache = CompletionCache()
+
+
+def _collect_cache_metrics():
+    """Expone los contadores de la caché de OpenAI como métricas."""
+    stats = completion_cache.stats()
+    return [
+        (
+            "trueliebot_openai_cache_requests_total",
+            "counter",
+            "Consultas a la caché de respuestas de OpenAI por resultado.",
+            [
+                ({"result": "hit"}, stats["hits"]),
+                ({"result": "miss"}, stats["misses"]),
+            ],
+        ),
+        (
+            "trueliebot_openai_cache_disk_hits_total",
+            "counter",
+            "Aciertos servidos desde el nivel en disco de la caché.",
+            [({}, stats["disk_hits"])],
+        ),
+        (
+            "trueliebot_openai_cache_entries",
+            "gauge",
+            "Entradas en el nivel en memoria de la caché.",
+            [({}, stats["entries"])],
+        ),
+    ]
+
+
+register_collector(_collect_cache_metrics)
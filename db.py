@@ -2,39 +2,745 @@
 Módulo de utilidades para la gestión de la base de datos SQLite.
 Separa la lógica de acceso a datos de la lógica de rutas Flask.
 """
+import hashlib
+import heapq
+import json
+import os
 import sqlite3
-from typing import List, Dict, Any
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 
-DB_NAME = "conversations.db"
+from metrics import db_query_duration, timed_query
+from topic_detection import detect_topics
 
+DB_NAME = os.environ.get("DATABASE_NAME", "conversations.db")
 
-def get_db_connection():
-    """Crea y retorna una conexión a la base de datos SQLite."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+# Ajustes de conexión configurables por entorno
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", "-16000"))  # negativo = KiB
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "5.0"))
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "128"))
+DB_FETCH_CHUNK = int(os.environ.get("DB_FETCH_CHUNK", "500"))
+
+# Número de ficheros SQLite (shards) entre los que se reparten los perfiles
+DB_SHARDS = int(os.environ.get("DB_SHARDS", "1"))
+DB_SHARD_VNODES = int(os.environ.get("DB_SHARD_VNODES", "64"))
+# Los ids del shard i empiezan en i * SHARD_ID_SPAN, así que son únicos globalmente
+SHARD_ID_SPAN = 10**12
+
+# Límites inferiores (en caracteres) de los tramos de longitud de mensaje
+LENGTH_BUCKETS = (0, 20, 50, 100, 200, 500, 1000)
+
+# Nivel de zlib de los bloques de mensajes archivados (datos fríos: se prima el ratio)
+ARCHIVE_COMPRESSION_LEVEL = int(os.environ.get("ARCHIVE_COMPRESSION_LEVEL", "9"))
+
+# Columnas públicas de una conversación (el hash de contenido es interno)
+_COLUMNS = "id, profile, message, created_at"
+# Columnas de las páginas de conversaciones, con el último reanálisis offline
+_PAGE_COLUMNS = (
+    "c.id, c.profile, c.message, c.created_at, a.study_citation, a.cue_score"
+)
+
+_pool_lock = threading.Lock()
+_pools: Dict[str, List[sqlite3.Connection]] = {}
+_pool_pid = None
+
+
+def shard_path(index: int) -> str:
+    """Fichero del shard ``index``; el shard 0 es ``DB_NAME``."""
+    if index == 0:
+        return DB_NAME
+    root, ext = os.path.splitext(DB_NAME)
+    return f"{root}_{index}{ext}"
+
+
+def shard_paths(num_shards: Optional[int] = None) -> List[str]:
+    """Ficheros de todos los shards configurados, por orden de índice."""
+    return [shard_path(i) for i in range(num_shards or DB_SHARDS)]
+
+
+def content_hash(message: str) -> str:
+    """Hash del contenido de un mensaje para detectar duplicados dentro del perfil.
+
+    Son los 16 primeros bytes de SHA-256 en hexadecimal, que PostgreSQL también
+    puede calcular al migrar las filas existentes.
+    """
+    return hashlib.sha256(message.encode("utf-8")).hexdigest()[:32]
+
+
+def _ring_hash(key: str) -> int:
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+@lru_cache(maxsize=16)
+def _hash_ring(num_shards: int, vnodes: int) -> Tuple[List[int], List[int]]:
+    """Anillo de hashing consistente: posiciones ordenadas y shard de cada una."""
+    points = sorted(
+        (_ring_hash(f"shard-{shard}-{vnode}"), shard)
+        for shard in range(num_shards)
+        for vnode in range(vnodes)
+    )
+    return [point for point, _ in points], [shard for _, shard in points]
+
+
+def shard_index(profile: str, num_shards: Optional[int] = None) -> int:
+    """Shard al que pertenece un perfil según el anillo de hashing consistente.
+
+    Al pasar de N a N+1 shards solo cambia de shard ~1/(N+1) de los perfiles.
+    """
+    num_shards = num_shards or DB_SHARDS
+    if num_shards == 1:
+        return 0
+    positions, shards = _hash_ring(num_shards, DB_SHARD_VNODES)
+    index = bisect_right(positions, _ring_hash(profile))
+    return shards[index % len(shards)]
+
+
+def shard_for(profile: str) -> str:
+    """Fichero del shard que guarda las conversaciones de un perfil."""
+    return shard_path(shard_index(profile))
+
+
+def configure_connection(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """Aplica los PRAGMA de rendimiento configurados a una conexión."""
+    conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size={DB_CACHE_SIZE:d}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE:d}")
     return conn
 
 
+def get_db_connection(path: Optional[str] = None):
+    """Crea y retorna una conexión a la base de datos SQLite (o a un shard)."""
+    conn = sqlite3.connect(
+        path or DB_NAME,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    return configure_connection(conn)
+
+
+def _acquire(path: str) -> sqlite3.Connection:
+    """Toma una conexión del pool del fichero o abre una nueva si está vacío."""
+    global _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            # Proceso hijo tras un fork: las conexiones del padre no se reutilizan
+            _pools.clear()
+            _pool_pid = os.getpid()
+        pool = _pools.get(path)
+        if pool:
+            return pool.pop()
+    return get_db_connection(path)
+
+
+def _release(conn: sqlite3.Connection, path: str) -> None:
+    """Devuelve una conexión al pool, o la cierra si el pool está lleno."""
+    with _pool_lock:
+        if _pool_pid == os.getpid():
+            pool = _pools.setdefault(path, [])
+            if len(pool) < DB_POOL_SIZE:
+                pool.append(conn)
+                return
+    conn.close()
+
+
+@contextmanager
+def pooled_connection(path: Optional[str] = None):
+    """Presta una conexión persistente del pool dentro de una transacción.
+
+    Sin ``path`` se usa ``DB_NAME`` (el shard 0); ``shard_for(profile)`` da el
+    fichero de un perfil.
+    """
+    path = path or DB_NAME
+    conn = _acquire(path)
+    try:
+        with conn:
+            yield conn
+    except BaseException:
+        conn.close()
+        raise
+    _release(conn, path)
+
+
+def close_db_connections() -> None:
+    """Cierra todas las conexiones del pool (p. ej. al apagar la app)."""
+    with _pool_lock:
+        connections = [conn for pool in _pools.values() for conn in pool]
+        _pools.clear()
+    for conn in connections:
+        conn.close()
+
+
+def _conversations_query(
+    profile: str,
+    limit: int,
+    offset: int,
+    after_id: Optional[int],
+    topic: Optional[str],
+) -> Tuple[str, List[Any]]:
+    """Construye la consulta paginada de conversaciones y sus parámetros."""
+    if topic is None:
+        sql = (
+            f"SELECT {_PAGE_COLUMNS} FROM conversations c "
+            "LEFT JOIN conversation_analysis a ON a.conversation_id = c.id "
+            "WHERE c.profile = ?"
+        )
+        params: List[Any] = [profile]
+        id_column = "c.id"
+    else:
+        sql = (
+            f"SELECT {_PAGE_COLUMNS} FROM conversation_topics t "
+            "JOIN conversations c ON c.id = t.conversation_id "
+            "LEFT JOIN conversation_analysis a ON a.conversation_id = c.id "
+            "WHERE t.profile = ? AND t.topic = ?"
+        )
+        params = [profile, topic]
+        id_column = "t.conversation_id"
+    if after_id is not None:
+        sql += f" AND {id_column} > ? ORDER BY {id_column} LIMIT ?"
+        params.extend([after_id, limit])
+    else:
+        sql += f" ORDER BY {id_column} LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+    return sql, params
+
+
+def encode_archive_block(rows: List[Tuple]) -> bytes:
+    """Comprime un bloque de mensajes ordenado por id.
+
+    Cada fila es ``(id, message, created_at, topics, analysis)``, con ``analysis``
+    igual a ``(study_citation, cue_score, analyzed_at)`` o None si el mensaje no se
+    había reanalizado.
+    """
+    payload = json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(payload.encode("utf-8"), ARCHIVE_COMPRESSION_LEVEL)
+
+
+def decode_archive_block(payload: bytes) -> List[List[Any]]:
+    """Lista de ``[id, message, created_at, topics, analysis]`` de un bloque.
+
+    Los bloques anteriores al análisis archivado reciben ``analysis`` None.
+    """
+    rows = json.loads(zlib.decompress(payload).decode("utf-8"))
+    for row in rows:
+        if len(row) < 5:
+            row.append(None)
+    return rows
+
+
+def _has_archive(conn: sqlite3.Connection, profile: str, after_id: int) -> bool:
+    """Indica si el perfil tiene mensajes archivados con id mayor que ``after_id``."""
+    return (
+        conn.execute(
+            "SELECT 1 FROM conversation_archive WHERE profile = ? AND last_id > ? "
+            "LIMIT 1",
+            (profile, after_id),
+        ).fetchone()
+        is not None
+    )
+
+
+def _archived_rows(
+    conn: sqlite3.Connection, profile: str, after_id: int, topic: Optional[str]
+) -> Iterator[Dict[str, Any]]:
+    """Genera los mensajes archivados del perfil con id mayor que ``after_id``.
+
+    Los bloques se descomprimen en orden de su primer id y solo cuando hacen falta;
+    un montículo mantiene el orden por id aunque dos bloques se solapen.
+    """
+    pending: List[Tuple[int, str, str, Optional[List[Any]]]] = []
+    blocks = conn.execute(
+        "SELECT first_id, payload FROM conversation_archive "
+        "WHERE profile = ? AND last_id > ? ORDER BY first_id",
+        (profile, after_id),
+    )
+    for first_id, payload in blocks:
+        while pending and pending[0][0] < first_id:
+            yield _archived_row(profile, heapq.heappop(pending))
+        for conversation_id, message, created_at, topics, analysis in (
+            decode_archive_block(payload)
+        ):
+            if conversation_id > after_id and (topic is None or topic in topics):
+                heapq.heappush(
+                    pending, (conversation_id, message, created_at, analysis)
+                )
+    while pending:
+        yield _archived_row(profile, heapq.heappop(pending))
+
+
+def _archived_row(
+    profile: str, row: Tuple[int, str, str, Optional[List[Any]]]
+) -> Dict[str, Any]:
+    conversation_id, message, created_at, analysis = row
+    return {
+        "id": conversation_id,
+        "profile": profile,
+        "message": message,
+        "created_at": created_at,
+        "study_citation": analysis[0] if analysis else None,
+        "cue_score": analysis[1] if analysis else None,
+    }
+
+
+def _read_through(
+    conn: sqlite3.Connection,
+    profile: str,
+    limit: int,
+    offset: int,
+    after_id: Optional[int],
+    topic: Optional[str],
+) -> List[Dict[str, Any]]:
+    """Página que mezcla por id los mensajes archivados y los de la tabla activa."""
+    start = after_id if after_id is not None else 0
+    skip = 0 if after_id is not None else offset
+    sql, params = _conversations_query(profile, skip + limit, 0, start, topic)
+    hot = [dict(row) for row in conn.execute(sql, params)]
+    merged = heapq.merge(
+        _archived_rows(conn, profile, start, topic), hot, key=lambda row: row["id"]
+    )
+    return list(islice(merged, skip, skip + limit))
+
+
+@timed_query("fetch_conversations")
 def fetch_conversations(
-    profile: str, limit: int = 20, offset: int = 0
+    profile: str,
+    limit: int = 20,
+    offset: int = 0,
+    after_id: Optional[int] = None,
+    topic: Optional[str] = None,
 ) -> List[Dict[str, Any]]:
-    """Obtiene conversaciones para un perfil dado, con paginación."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM conversations WHERE profile = ? LIMIT ? OFFSET ?",
-            (profile, limit, offset),
-        )
-        rows = cursor.fetchall()
+    """Obtiene conversaciones para un perfil dado, con paginación.
+
+    Si se indica ``after_id`` se usa paginación por clave (keyset) sobre el índice
+    ``(profile, id)`` y se ignora ``offset``. Con ``topic`` solo se devuelven los
+    mensajes anotados con ese tema (índice ``(profile, topic, conversation_id)``).
+    Los mensajes archivados del perfil se leen de forma transparente.
+    """
+    with pooled_connection(shard_for(profile)) as conn:
+        if _has_archive(conn, profile, after_id or 0):
+            return _read_through(conn, profile, limit, offset, after_id, topic)
+        sql, params = _conversations_query(profile, limit, offset, after_id, topic)
+        rows = conn.execute(sql, params).fetchall()
         return [dict(row) for row in rows]
 
 
-def insert_conversation(profile: str, message: str) -> None:
-    """Inserta una nueva conversación en la base de datos."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO conversations (profile, message) VALUES (?, ?)",
-            (profile, message),
+def iter_conversations(
+    profile: str,
+    limit: int = 20,
+    offset: int = 0,
+    after_id: Optional[int] = None,
+    topic: Optional[str] = None,
+    chunk_size: int = DB_FETCH_CHUNK,
+) -> Iterator[Dict[str, Any]]:
+    """Recorre una página de conversaciones sin cargarla entera en memoria.
+
+    Acepta los mismos filtros que ``fetch_conversations`` y lee el cursor en bloques
+    de ``chunk_size`` filas. La conexión queda prestada hasta que el generador se
+    agota o se cierra.
+    """
+    sql, params = _conversations_query(profile, limit, offset, after_id, topic)
+    start = time.perf_counter()
+    path = shard_for(profile)
+    conn = _acquire(path)
+    cursor = None
+    try:
+        if _has_archive(conn, profile, after_id or 0):
+            # Con mensajes archivados la página se mezcla en memoria
+            yield from _read_through(conn, profile, limit, offset, after_id, topic)
+            return
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+    finally:
+        if cursor is not None:
+            cursor.close()
+        _release(conn, path)
+        db_query_duration.observe(
+            time.perf_counter() - start, operation="iter_conversations"
+        )
+
+
+@timed_query("fetch_recent_conversations")
+def fetch_recent_conversations(profile: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """Obtiene las ``limit`` conversaciones más recientes del perfil, en orden de id.
+
+    Recorre el índice ``(profile, id)`` hacia atrás, sin offset.
+    """
+    with pooled_connection(shard_for(profile)) as conn:
+        rows = conn.execute(
+            f"SELECT {_COLUMNS} FROM conversations WHERE profile = ? "
+            "ORDER BY id DESC LIMIT ?",
+            (profile, limit),
+        ).fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+
+@timed_query("fetch_conversations_version")
+def fetch_conversations_version(
+    profile: str, topic: Optional[str] = None
+) -> Dict[str, Any]:
+    """Obtiene una versión barata de las conversaciones de un perfil.
+
+    Combina el id máximo (índice ``(profile, id)``) con los recuentos de las tablas
+    de resumen, así que cambia con cada inserción, borrado o anotación de temas
+    sin recorrer las conversaciones. ``last_seen`` es la fecha de la última
+    inserción, o None si el perfil no tiene mensajes; ``analyzed_at`` la del
+    último reanálisis (índice ``(profile, analyzed_at)``).
+    """
+    with pooled_connection(shard_for(profile)) as conn:
+        row = conn.execute(
+            "SELECT (SELECT MAX(id) FROM conversations WHERE profile = ?) AS max_id, "
+            "s.message_count, s.last_seen, "
+            "(SELECT message_count FROM profile_topic_stats "
+            "WHERE profile = ? AND topic = ?) AS topic_count, "
+            "(SELECT MAX(analyzed_at) FROM conversation_analysis "
+            "WHERE profile = ?) AS analyzed_at "
+            "FROM (SELECT 1) LEFT JOIN profile_stats s ON s.profile = ?",
+            (profile, profile, topic, profile, profile),
+        ).fetchone()
+    return {
+        "max_id": row["max_id"],
+        "message_count": row["message_count"] or 0,
+        "topic_count": row["topic_count"] or 0,
+        "last_seen": row["last_seen"],
+        "analyzed_at": row["analyzed_at"],
+    }
+
+
+@timed_query("search_conversations")
+def search_conversations(
+    match: str, profile: Optional[str] = None, limit: int = 20, offset: int = 0
+) -> List[Dict[str, Any]]:
+    """Busca mensajes con FTS5, ordenados por relevancia (bm25) y con fragmento.
+
+    ``match`` es una expresión MATCH de FTS5 ya construida por el llamante. Sin
+    ``profile`` se consulta cada shard y se mezclan los resultados por relevancia.
+    """
+    sql = (
+        "SELECT c.id, c.profile, c.message, "
+        "snippet(conversations_fts, 0, '<mark>', '</mark>', '…', 12) AS snippet, "
+        "bm25(conversations_fts) AS rank "
+        "FROM conversations_fts JOIN conversations c ON c.id = conversations_fts.rowid "
+        "WHERE conversations_fts MATCH ?"
+    )
+    params: List[Any] = [match]
+    if profile is not None:
+        sql += " AND c.profile = ?"
+        params.append(profile)
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    if profile is not None:
+        params.extend([limit, offset])
+        with pooled_connection(shard_for(profile)) as conn:
+            rows = conn.execute(sql, params).fetchall()
+            return [dict(row) for row in rows]
+    # Cada shard aporta sus limit + offset mejores; la página sale de la mezcla
+    params.extend([limit + offset, 0])
+    per_shard = []
+    for path in shard_paths():
+        with pooled_connection(path) as conn:
+            per_shard.append([dict(row) for row in conn.execute(sql, params)])
+    merged = heapq.merge(*per_shard, key=lambda row: row["rank"])
+    return list(islice(merged, offset, offset + limit))
+
+
+def has_archived_conversations(profile: Optional[str] = None) -> bool:
+    """Indica si el perfil (o, sin ``profile``, algún perfil) tiene mensajes archivados.
+
+    La búsqueda de texto completo no los encuentra, así que la API lo avisa.
+    """
+    sql = "SELECT 1 FROM conversation_archive"
+    params: Tuple = ()
+    if profile is not None:
+        sql, params = sql + " WHERE profile = ?", (profile,)
+    paths = [shard_for(profile)] if profile is not None else shard_paths()
+    for path in paths:
+        with pooled_connection(path) as conn:
+            if conn.execute(sql + " LIMIT 1", params).fetchone():
+                return True
+    return False
+
+
+def _insert_with_topics(
+    conn: sqlite3.Connection,
+    profile: str,
+    message: str,
+    topics: Optional[Iterable[str]] = None,
+    created_at: Optional[str] = None,
+) -> Optional[int]:
+    """Inserta un mensaje y sus temas en la transacción de ``conn``; devuelve el id.
+
+    Sin ``created_at`` el mensaje se fecha ahora (UTC, formato de ``datetime()``).
+    Si el perfil ya tiene un mensaje con el mismo contenido, activo (índice único
+    ``(profile, content_hash)``) o archivado, no se inserta nada y se devuelve None.
+    """
+    digest = content_hash(message)
+    cursor = conn.execute(
+        "INSERT INTO conversations (profile, message, created_at, content_hash) "
+        "SELECT ?, ?, COALESCE(?, datetime('now')), ? "
+        "WHERE NOT EXISTS (SELECT 1 FROM conversation_archive_hashes "
+        "WHERE profile = ? AND content_hash = ?) "
+        "ON CONFLICT(profile, content_hash) DO NOTHING",
+        (profile, message, created_at, digest, profile, digest),
+    )
+    if not cursor.rowcount:
+        return None
+    conversation_id = cursor.lastrowid
+    if topics is None:
+        topics = detect_topics(message)
+    if topics:
+        conn.executemany(
+            "INSERT OR IGNORE INTO conversation_topics "
+            "(conversation_id, profile, topic) VALUES (?, ?, ?)",
+            [(conversation_id, profile, topic) for topic in topics],
+        )
+    return conversation_id
+
+
+@timed_query("insert_conversation")
+def insert_conversation(
+    profile: str, message: str, topics: Optional[Iterable[str]] = None
+) -> Optional[int]:
+    """Inserta una nueva conversación y sus temas; devuelve su id.
+
+    Si no se indican ``topics`` se detectan aquí con ``detect_topics``. Devuelve
+    None si el perfil ya tenía un mensaje idéntico.
+    """
+    with pooled_connection(shard_for(profile)) as conn:
+        return _insert_with_topics(conn, profile, message, topics)
+
+
+@timed_query("insert_conversations")
+def insert_conversations(rows: Iterable[Tuple], path: Optional[str] = None) -> int:
+    """Inserta varias conversaciones en una sola transacción por shard.
+
+    Cada fila es ``(profile, message)``, ``(profile, message, topics)`` o
+    ``(profile, message, topics, created_at)``. Con ``path`` todas las filas van a
+    ese fichero en vez de al shard de su perfil. Devuelve las filas insertadas, sin
+    los mensajes que el perfil ya tenía.
+    """
+    by_shard: Dict[str, List[Tuple]] = {}
+    for row in rows:
+        by_shard.setdefault(path or shard_for(row[0]), []).append(row)
+    inserted = 0
+    for path, shard_rows in by_shard.items():
+        with pooled_connection(path) as conn:
+            for profile, message, *extra in shard_rows:
+                if _insert_with_topics(conn, profile, message, *extra) is not None:
+                    inserted += 1
+    return inserted
+
+
+@timed_query("fetch_duplicate_id")
+def fetch_duplicate_id(profile: str, digest: str) -> Optional[int]:
+    """Id del mensaje del perfil, activo o archivado, con hash ``digest``, o None."""
+    with pooled_connection(shard_for(profile)) as conn:
+        row = conn.execute(
+            "SELECT id FROM conversations WHERE profile = ? AND content_hash = ? "
+            "UNION ALL SELECT conversation_id FROM conversation_archive_hashes "
+            "WHERE profile = ? AND content_hash = ? LIMIT 1",
+            (profile, digest, profile, digest),
+        ).fetchone()
+    return row[0] if row is not None else None
+
+
+def iter_content_hashes() -> Iterator[Tuple[str, str]]:
+    """Genera ``(profile, content_hash)`` de todos los mensajes, por lotes.
+
+    Incluye los hashes de los mensajes archivados.
+    """
+    for path in shard_paths():
+        after_id = 0
+        while True:
+            with pooled_connection(path) as conn:
+                rows = conn.execute(
+                    "SELECT id, profile, content_hash FROM conversations "
+                    "WHERE id > ? AND content_hash IS NOT NULL ORDER BY id LIMIT ?",
+                    (after_id, DB_FETCH_CHUNK),
+                ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row["profile"], row["content_hash"]
+            after_id = rows[-1]["id"]
+        after_key = ("", "")
+        while True:
+            with pooled_connection(path) as conn:
+                rows = conn.execute(
+                    "SELECT profile, content_hash FROM conversation_archive_hashes "
+                    "WHERE (profile, content_hash) > (?, ?) "
+                    "ORDER BY profile, content_hash LIMIT ?",
+                    (*after_key, DB_FETCH_CHUNK),
+                ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row["profile"], row["content_hash"]
+            after_key = tuple(rows[-1])
+
+
+def _replace_topics(
+    conn: sqlite3.Connection, rows: List[Tuple[int, str, List[str]]]
+) -> None:
+    """Sustituye en la transacción de ``conn`` los temas de las conversaciones."""
+    conn.executemany(
+        "DELETE FROM conversation_topics WHERE conversation_id = ?",
+        [(conversation_id,) for conversation_id, _, _ in rows],
+    )
+    conn.executemany(
+        "INSERT INTO conversation_topics (conversation_id, profile, topic) "
+        "VALUES (?, ?, ?)",
+        [
+            (conversation_id, profile, topic)
+            for conversation_id, profile, topics in rows
+            for topic in topics
+        ],
+    )
+
+
+@timed_query("annotate_topics")
+def annotate_topics(rows: Iterable[Tuple[int, str, List[str]]]) -> int:
+    """Sustituye los temas guardados de ``(conversation_id, profile, topics)``."""
+    by_shard: Dict[str, List[Tuple[int, str, List[str]]]] = {}
+    for row in rows:
+        by_shard.setdefault(shard_for(row[1]), []).append(row)
+    for path, shard_rows in by_shard.items():
+        with pooled_connection(path) as conn:
+            _replace_topics(conn, shard_rows)
+    return sum(len(shard_rows) for shard_rows in by_shard.values())
+
+
+@timed_query("save_analysis")
+def save_analysis(
+    rows: Iterable[Tuple[int, str, List[str], Optional[str], float]]
+) -> int:
+    """Guarda el análisis de ``(conversation_id, profile, topics, cita, puntuación)``.
+
+    Sustituye los temas y la fila de ``conversation_analysis`` de cada conversación
+    en una sola transacción por shard.
+    """
+    by_shard: Dict[str, List[Tuple[int, str, List[str], Optional[str], float]]] = {}
+    for row in rows:
+        by_shard.setdefault(shard_for(row[1]), []).append(row)
+    for path, shard_rows in by_shard.items():
+        with pooled_connection(path) as conn:
+            _replace_topics(conn, [row[:3] for row in shard_rows])
+            conn.executemany(
+                "INSERT INTO conversation_analysis "
+                "(conversation_id, profile, study_citation, cue_score, analyzed_at) "
+                "VALUES (?, ?, ?, ?, datetime('now')) "
+                "ON CONFLICT(conversation_id) DO UPDATE SET "
+                "study_citation = excluded.study_citation, "
+                "cue_score = excluded.cue_score, "
+                "analyzed_at = excluded.analyzed_at",
+                [
+                    (conversation_id, profile, citation, score)
+                    for conversation_id, profile, _, citation, score in shard_rows
+                ],
+            )
+    return sum(len(shard_rows) for shard_rows in by_shard.values())
+
+
+@timed_query("fetch_conversation_batch")
+def fetch_conversation_batch(after_id: int, limit: int) -> List[Dict[str, Any]]:
+    """Obtiene un lote de conversaciones de todos los perfiles por orden de id.
+
+    Los ids de cada shard están en su propio rango, así que basta con recorrer los
+    shards en orden empezando por el del ``after_id``. Solo lee la tabla activa, no
+    los bloques archivados.
+    """
+    for index in range(min(after_id // SHARD_ID_SPAN, DB_SHARDS - 1), DB_SHARDS):
+        with pooled_connection(shard_path(index)) as conn:
+            rows = conn.execute(
+                f"SELECT {_COLUMNS} FROM conversations WHERE id > ? "
+                "ORDER BY id LIMIT ?",
+                (after_id, limit),
+            ).fetchall()
+        if rows:
+            return [dict(row) for row in rows]
+    return []
+
+
+@timed_query("count_topics")
+def count_topics(profile: str) -> Dict[str, int]:
+    """Cuenta los mensajes de un perfil por tema (desde la tabla de resumen)."""
+    with pooled_connection(shard_for(profile)) as conn:
+        rows = conn.execute(
+            "SELECT topic, message_count FROM profile_topic_stats "
+            "WHERE profile = ? AND message_count > 0 ORDER BY message_count DESC",
+            (profile,),
+        ).fetchall()
+        return {topic: count for topic, count in rows}
+
+
+def length_bucket_sql(column: str) -> str:
+    """Expresión SQL con el límite inferior del tramo de longitud de un mensaje."""
+    cases = " ".join(
+        f"WHEN length({column}) >= {bound} THEN {bound}"
+        for bound in sorted(LENGTH_BUCKETS, reverse=True)
+    )
+    return f"CASE {cases} ELSE 0 END"
+
+
+def bucket_label(index: int) -> str:
+    """Etiqueta legible de un tramo de longitud (p. ej. ``"20-49"`` o ``"1000+"``)."""
+    low = LENGTH_BUCKETS[index]
+    if index + 1 == len(LENGTH_BUCKETS):
+        return f"{low}+"
+    return f"{low}-{LENGTH_BUCKETS[index + 1] - 1}"
+
+
+@timed_query("fetch_profile_stats")
+def fetch_profile_stats(profile: str, days: int = 30) -> Optional[Dict[str, Any]]:
+    """Obtiene las estadísticas agregadas de un perfil desde las tablas de resumen.
+
+    Devuelve None si el perfil no tiene mensajes.
+    """
+    with pooled_connection(shard_for(profile)) as conn:
+        summary = conn.execute(
+            "SELECT * FROM profile_stats WHERE profile = ?", (profile,)
+        ).fetchone()
+        if summary is None or summary["message_count"] <= 0:
+            return None
+        buckets = dict(
+            conn.execute(
+                "SELECT bucket, message_count FROM profile_length_stats "
+                "WHERE profile = ?",
+                (profile,),
+            ).fetchall()
         )
-        conn.commit()
+        activity = conn.execute(
+            "SELECT day, message_count FROM profile_activity_stats "
+            "WHERE profile = ? AND day >= date('now', ?) ORDER BY day",
+            (profile, f"-{int(days)} days"),
+        ).fetchall()
+    count = summary["message_count"]
+    return {
+        "profile": profile,
+        "message_count": count,
+        "average_length": summary["total_length"] / count,
+        "first_seen": summary["first_seen"],
+        "last_seen": summary["last_seen"],
+        "topics": count_topics(profile),
+        "length_distribution": {
+            bucket_label(i): buckets.get(bound, 0)
+            for i, bound in enumerate(LENGTH_BUCKETS)
+        },
+        "activity": [{"date": day, "count": n} for day, n in activity],
+    }
@@ -0,0 +1,259 @@
+"""
+Puntuación por lotes de indicios textuales de engaño (DePaulo et al. 2003, SCAN).
+Extrae rasgos lingüísticos de muchos mensajes a la vez y calcula una puntuación
+heurística por mensaje; orientativa, no es un veredicto sobre la sinceridad.
+"""
+
+import math
+import os
+import re
+import time
+from array import array
+from bisect import bisect_right
+
+from metrics import cue_scoring_duration
+from topic_detection import normalize
+
+try:
+    import numpy
+except ImportError:  # numpy es opcional; sin él se calcula con array y bucles
+    numpy = None
+
+# Indicios en el orden del vector de rasgos, con sus palabras (ya normalizadas)
+CUE_LEXICONS = [
+    ("first_person", ["yo", "me", "mi", "mis", "mio", "mia", "conmigo", "nosotros"]),
+    # "el" se omite: normalizado no se distingue el pronombre del artículo
+    ("third_person", ["ella", "ellos", "ellas", "le", "les", "su", "sus"]),
+    (
+        "hedges",
+        [
+            "quizas", "quiza", "tal vez", "a lo mejor", "creo", "supongo",
+            "probablemente", "posiblemente", "puede que", "igual", "parece",
+            "no se", "no recuerdo", "no me acuerdo",
+        ],
+    ),
+    (
+        "justifications",
+        [
+            "porque", "ya que", "por eso", "debido", "asi que", "la verdad",
+            "sinceramente", "honestamente", "francamente", "te lo juro", "juro",
+            "en serio", "te prometo",
+        ],
+    ),
+    (
+        "sensory",
+        [
+            "vi", "ver", "veia", "mire", "oi", "escuche", "sonaba", "sonido",
+            "ruido", "olor", "olia", "sabor", "sabia a", "toque", "frio", "calor",
+            "color", "luz", "oscuro", "brillante",
+        ],
+    ),
+    (
+        "negations",
+        ["no", "nunca", "jamas", "nada", "nadie", "ningun", "ninguno", "ninguna",
+         "tampoco"],
+    ),
+    ("fillers", ["eh", "em", "mmm", "bueno", "pues", "o sea", "en plan", "vale"]),
+]
+
+CUE_NAMES = tuple(name for name, _ in CUE_LEXICONS)
+# Vector completo: tasa de cada indicio por palabra, longitud relativa y palabras
+FEATURE_NAMES = CUE_NAMES + ("length_ratio", "words")
+
+# Pesos por cada 10 palabras: positivos en indicios asociados al engaño
+CUE_WEIGHTS = {
+    "first_person": -0.2,
+    "third_person": 0.2,
+    "hedges": 0.6,
+    "justifications": 0.5,
+    "sensory": -0.5,
+    "negations": 0.3,
+    "fillers": 0.4,
+}
+LENGTH_WEIGHT = -0.2
+SCORE_BIAS = -1.0
+# Longitud de referencia (en palabras) para que la puntuación no dependa del lote
+CUE_REFERENCE_WORDS = float(os.environ.get("CUE_REFERENCE_WORDS", "12"))
+CUE_BATCH_SIZE = int(os.environ.get("CUE_BATCH_SIZE", "2000"))
+
+
+def _build_pattern(lexicons):
+    """Expresión regular con un grupo con nombre por indicio."""
+    groups = []
+    for index, (_, words) in enumerate(lexicons):
+        # Las frases admiten uno o más espacios, nunca saltos de línea: los mensajes
+        # del lote se unen con "\n" y ninguna coincidencia debe cruzar de uno a otro
+        variants = sorted(
+            {" +".join(map(re.escape, normalize(w).split())) for w in words},
+            key=len,
+            reverse=True,
+        )
+        groups.append(f"(?P<c{index}>{'|'.join(variants)})")
+    return re.compile(r"(?<!\w)(?:" + "|".join(groups) + r")(?!\w)")
+
+
+_CUE_PATTERN = _build_pattern(CUE_LEXICONS)
+_GROUP_INDEX = {f"c{index}": index for index in range(len(CUE_LEXICONS))}
+_WEIGHTS = [CUE_WEIGHTS[name] for name in CUE_NAMES]
+
+
+def _scan(texts):
+    """Recorre el lote en una sola pasada de la expresión regular.
+
+    Devuelve los desplazamientos de inicio de cada mensaje en el texto unido, y la
+    posición y el indicio de cada coincidencia.
+    """
+    offsets = array("q")
+    position = 0
+    for text in texts:
+        offsets.append(position)
+        position += len(text) + 1
+    joined = "\n".join(texts)
+    starts = array("q")
+    cues = array("b")
+    for match in _CUE_PATTERN.finditer(joined):
+        starts.append(match.start())
+        cues.append(_GROUP_INDEX[match.lastgroup])
+    return offsets, starts, cues
+
+
+def _features_numpy(offsets, starts, cues, words):
+    """Matriz de rasgos y puntuaciones con operaciones vectorizadas de numpy."""
+    n, k = len(offsets), len(CUE_NAMES)
+    counts = numpy.zeros((n, k), dtype=numpy.float64)
+    if len(starts):
+        rows = numpy.searchsorted(
+            numpy.frombuffer(offsets, dtype=numpy.int64),
+            numpy.frombuffer(starts, dtype=numpy.int64),
+            side="right",
+        ) - 1
+        numpy.add.at(counts, (rows, numpy.frombuffer(cues, dtype=numpy.int8)), 1)
+    words = numpy.frombuffer(words, dtype=numpy.int64).astype(numpy.float64)
+    rates = counts / numpy.maximum(words, 1.0)[:, None]
+    length_ratio = words / CUE_REFERENCE_WORDS
+    logits = (
+        SCORE_BIAS
+        + (rates * 10.0) @ numpy.asarray(_WEIGHTS)
+        + LENGTH_WEIGHT * numpy.log(numpy.maximum(length_ratio, 1e-3))
+    )
+    scores = 1.0 / (1.0 + numpy.exp(-logits))
+    features = numpy.column_stack((rates, length_ratio, words))
+    return features.tolist(), scores.tolist()
+
+
+def _features_python(offsets, starts, cues, words):
+    """Equivalente sin numpy: recuentos en un array plano de n × k contadores."""
+    n, k = len(offsets), len(CUE_NAMES)
+    counts = array("l", [0]) * (n * k)
+    for start, cue in zip(starts, cues):
+        counts[(bisect_right(offsets, start) - 1) * k + cue] += 1
+    features, scores = [], []
+    for row in range(n):
+        total = words[row]
+        rates = [c / max(total, 1) for c in counts[row * k:(row + 1) * k]]
+        length_ratio = total / CUE_REFERENCE_WORDS
+        logit = SCORE_BIAS + LENGTH_WEIGHT * math.log(max(length_ratio, 1e-3))
+        logit += sum(w * r * 10.0 for w, r in zip(_WEIGHTS, rates))
+        features.append(rates + [length_ratio, float(total)])
+        scores.append(1.0 / (1.0 + math.exp(-logit)))
+    return features, scores
+
+
+def cue_matrix(messages, normalized=False):
+    """Calcula el vector de rasgos y la puntuación de cada mensaje del lote.
+
+    Devuelve ``(features, scores)``: una fila por mensaje con los valores de
+    ``FEATURE_NAMES`` y una puntuación entre 0 y 1. Cada mensaje se puntúa con la
+    misma escala sea cual sea el lote, así que el resultado coincide por petición y
+    por perfil.
+    """
+    start = time.perf_counter()
+    texts = list(messages) if normalized else [normalize(m) for m in messages]
+    if not texts:
+        return [], []
+    words = array("q", (len(text.split()) for text in texts))
+    offsets, starts, cues = _scan(texts)
+    compute = _features_numpy if numpy is not None else _features_python
+    result = compute(offsets, starts, cues, words)
+    cue_scoring_duration.observe(time.perf_counter() - start)
+    return result
+
+
+def score_messages(messages, normalized=False):
+    """Puntúa un lote de mensajes; devuelve ``{"cues", "score"}`` por mensaje."""
+    features, scores = cue_matrix(messages, normalized)
+    return [
+        {
+            "cues": {
+                name: round(value, 4) for name, value in zip(FEATURE_NAMES, row)
+            },
+            "score": round(score, 4),
+        }
+        for row, score in zip(features, scores)
+    ]
+
+
+class CueSummary:
+    """Sumas de los indicios de los mensajes de un perfil, ampliables uno a uno."""
+
+    def __init__(self):
+        self.count = 0
+        self.score_sum = 0.0
+        self.sums = [0.0] * len(FEATURE_NAMES)
+        self.top = None
+
+    def add_batch(self, ids, features, scores):
+        """Suma un lote de mensajes con sus ids, rasgos y puntuaciones."""
+        if not scores:
+            return
+        self.sums = [a + sum(column) for a, column in zip(self.sums, zip(*features))]
+        self.score_sum += sum(scores)
+        best = max(range(len(scores)), key=scores.__getitem__)
+        if self.top is None or scores[best] > self.top[1]:
+            self.top = (ids[best], scores[best])
+        self.count += len(scores)
+
+    def add(self, conversation_id, features, score):
+        """Suma un mensaje nuevo; devuelve False sin sumarlo si no puede.
+
+        Si el mensaje pasa a ser el de mayor puntuación hace falta su id, que no se
+        conoce mientras la inserción está diferida.
+        """
+        if conversation_id is None and (self.top is None or score > self.top[1]):
+            return False
+        self.add_batch([conversation_id], [features], [score])
+        return True
+
+    def summary(self, profile):
+        """Medias de los indicios y mensaje de mayor puntuación; None si no hay."""
+        if not self.count:
+            return None
+        return {
+            "profile": profile,
+            "message_count": self.count,
+            "mean_score": round(self.score_sum / self.count, 4),
+            "mean_cues": {
+                name: round(total / self.count, 4)
+                for name, total in zip(FEATURE_NAMES, self.sums)
+            },
+            "max_score": {"id": self.top[0], "score": round(self.top[1], 4)},
+        }
+
+
+def scan_profile(fetch_page, profile, batch_size=CUE_BATCH_SIZE):
+    """Recorre todos los mensajes de un perfil y devuelve su ``CueSummary``.
+
+    ``fetch_page(profile, limit=..., after_id=...)`` es ``fetch_conversations`` de la
+    capa de almacenamiento; los mensajes se leen y puntúan por lotes con paginación
+    por clave.
+    """
+    summary = CueSummary()
+    after_id = 0
+    while True:
+        rows = fetch_page(profile, limit=batch_size, after_id=after_id)
+        if not rows:
+            break
+        features, scores = cue_matrix(row["message"] for row in rows)
+        summary.add_batch([row["id"] for row in rows], features, scores)
+        after_id = rows[-1]["id"]
+    return summary
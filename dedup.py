@@ -0,0 +1,325 @@
+"""
+Deduplicación por contenido de los mensajes reenviados o reimportados.
+Un filtro de Bloom en memoria evita consultar la base de datos con el contenido
+nuevo, y el análisis de cada mensaje se memoriza por su hash de contenido.
+"""
+
+import hashlib
+import itertools
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from db import content_hash
+from deception_cues import cue_matrix
+from lie_detection_studies import get_study_citation_by_topic
+from metrics import register_collector
+from storage import fetch_duplicate_id, iter_content_hashes
+from topic_detection import detect_topics
+
+logger = logging.getLogger(__name__)
+
+DEDUP_BLOOM_CAPACITY = int(os.environ.get("DEDUP_BLOOM_CAPACITY", "1000000"))
+DEDUP_BLOOM_ERROR_RATE = float(os.environ.get("DEDUP_BLOOM_ERROR_RATE", "0.01"))
+DEDUP_ANALYSIS_CACHE_SIZE = int(os.environ.get("DEDUP_ANALYSIS_CACHE_SIZE", "10000"))
+# Hashes que el hilo de carga añade al filtro en cada toma del lock
+DEDUP_LOAD_CHUNK = 10000
+
+
+class BloomFilter:
+    """Conjunto probabilístico: ``key in bloom`` es False solo si nunca se añadió.
+
+    Se dimensiona para ``capacity`` claves con una tasa de falsos positivos de
+    ``error_rate``; con más claves la tasa crece, pero nunca da falsos negativos.
+    """
+
+    def __init__(
+        self, capacity=DEDUP_BLOOM_CAPACITY, error_rate=DEDUP_BLOOM_ERROR_RATE
+    ):
+        capacity = max(capacity, 1)
+        self.num_bits = max(
+            8, int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Doble hashing: k posiciones a partir de dos hashes de 64 bits
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        """Añade una clave al filtro."""
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    def clear(self):
+        """Vacía el filtro."""
+        self._bits = bytearray(len(self._bits))
+        self.count = 0
+
+
+class ContentIndex:
+    """Filtro de Bloom de los ``(perfil, hash)`` guardados, cargado en segundo plano.
+
+    Si el filtro dice que el contenido es nuevo se inserta sin consultar; si puede
+    estar repetido se busca en la base de datos. Hasta que termina la carga todas
+    las comprobaciones van a la base de datos. El índice único de la base de datos
+    sigue siendo la referencia: lo que escriban otros procesos y falte en el filtro
+    lo detecta la propia inserción.
+    """
+
+    def __init__(
+        self, capacity=DEDUP_BLOOM_CAPACITY, error_rate=DEDUP_BLOOM_ERROR_RATE
+    ):
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._loader = None
+        # Cambia con cada reset para que una carga anterior no siga añadiendo
+        self._generation = 0
+        self.skipped = 0
+        self.lookups = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def _key(profile, digest):
+        return f"{profile}\0{digest}"
+
+    def load(self):
+        """Añade al filtro los hashes guardados; True si la carga sigue vigente.
+
+        El lock solo se toma para cada tramo de ``DEDUP_LOAD_CHUNK`` hashes, así que
+        las peticiones no esperan a que termine.
+        """
+        with self._lock:
+            generation = self._generation
+        hashes = iter_content_hashes()
+        while True:
+            keys = [
+                self._key(profile, digest)
+                for profile, digest in itertools.islice(hashes, DEDUP_LOAD_CHUNK)
+            ]
+            with self._lock:
+                if generation != self._generation:
+                    return False
+                for key in keys:
+                    self._bloom.add(key)
+                if not keys:
+                    self._loaded = True
+                    return True
+
+    def _run_loader(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception("No se pudo cargar el filtro de contenido")
+        finally:
+            with self._lock:
+                # Si la carga falló se reintenta en la siguiente comprobación
+                if self._loader is threading.current_thread():
+                    self._loader = None
+
+    def start_loading(self):
+        """Lanza la carga del filtro en un hilo si no está hecha ni en curso."""
+        with self._lock:
+            if self._loaded or self._loader is not None:
+                return
+            self._loader = threading.Thread(
+                target=self._run_loader, name="content-index-loader", daemon=True
+            )
+            self._loader.start()
+
+    def find(self, profile, digest):
+        """Id del mensaje del perfil con ese hash, o None si no está guardado."""
+        self.start_loading()
+        key = self._key(profile, digest)
+        with self._lock:
+            if self._loaded and key not in self._bloom:
+                self.skipped += 1
+                return None
+            self.lookups += 1
+        conversation_id = fetch_duplicate_id(profile, digest)
+        if conversation_id is not None:
+            with self._lock:
+                self.duplicates += 1
+        return conversation_id
+
+    def add(self, profile, digest):
+        """Apunta un mensaje guardado (o encolado) del perfil."""
+        with self._lock:
+            self._bloom.add(self._key(profile, digest))
+
+    def reset(self):
+        """Descarta el filtro; se vuelve a cargar de la base de datos al usarlo."""
+        with self._lock:
+            self._bloom.clear()
+            self._loaded = False
+            self._loader = None
+            self._generation += 1
+
+    def stats(self):
+        """Consultas evitadas por el filtro, consultas hechas y duplicados hallados."""
+        with self._lock:
+            return {
+                "skipped": self.skipped,
+                "lookups": self.lookups,
+                "duplicates": self.duplicates,
+                "entries": self._bloom.count,
+                "loaded": self._loaded,
+            }
+
+
+class AnalysisCache:
+    """Análisis de mensajes memorizado por hash de contenido (LRU)."""
+
+    def __init__(self, max_entries=DEDUP_ANALYSIS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        """Análisis en caché, marcado como recién usado; None si falta."""
+        with self._lock:
+            analysis = self._entries.get(digest)
+            if analysis is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(digest)
+            return analysis
+
+    def set(self, digest, analysis):
+        """Guarda un análisis respetando el límite LRU."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[digest] = analysis
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Vacía la caché y reinicia los contadores."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Aciertos, fallos y entradas de la caché."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+
+content_index = ContentIndex()
+analysis_cache = AnalysisCache()
+
+
+def _study(topics):
+    """Cita y resumen del primer tema que tenga estudio."""
+    for topic in topics:
+        citation, summary = get_study_citation_by_topic(topic)
+        if citation:
+            return citation, summary
+    return None, None
+
+
+def analyze_messages(messages):
+    """Temas, puntuación de indicios y estudio de un lote, memorizados por hash.
+
+    Devuelve ``(hash, análisis)`` por mensaje, con el análisis como
+    ``{"topics", "score", "cues", "study_citation", "study_summary"}``, donde
+    ``cues`` es la fila de rasgos de ``cue_matrix``. Solo se analizan
+    los contenidos que no estén en caché, con una sola llamada a ``cue_matrix``.
+    Los análisis son compartidos: no deben modificarse.
+    """
+    messages = list(messages)
+    digests = [content_hash(message) for message in messages]
+    analyses = [analysis_cache.get(digest) for digest in digests]
+    missing = {}
+    for message, digest, analysis in zip(messages, digests, analyses):
+        if analysis is None:
+            missing.setdefault(digest, message)
+    if missing:
+        features, scores = cue_matrix(missing.values())
+        for (digest, message), cues, score in zip(missing.items(), features, scores):
+            topics = tuple(detect_topics(message))
+            citation, summary = _study(topics)
+            analysis = {
+                "topics": topics,
+                "score": score,
+                "cues": tuple(cues),
+                "study_citation": citation,
+                "study_summary": summary,
+            }
+            missing[digest] = analysis
+            analysis_cache.set(digest, analysis)
+        analyses = [
+            analysis or missing[digest] for digest, analysis in zip(digests, analyses)
+        ]
+    return list(zip(digests, analyses))
+
+
+def analyze_message(message):
+    """Hash y análisis memorizado de un mensaje (ver ``analyze_messages``)."""
+    return analyze_messages([message])[0]
+
+
+def _collect_dedup_metrics():
+    """Expone los contadores de deduplicación como métricas."""
+    index = content_index.stats()
+    cache = analysis_cache.stats()
+    return [
+        (
+            "trueliebot_dedup_checks_total",
+            "counter",
+            "Comprobaciones de contenido repetido por resultado.",
+            [
+                ({"result": "bloom_skip"}, index["skipped"]),
+                ({"result": "db_lookup"}, index["lookups"]),
+                ({"result": "duplicate"}, index["duplicates"]),
+            ],
+        ),
+        (
+            "trueliebot_dedup_bloom_loaded",
+            "gauge",
+            "1 si el filtro de contenido ya está cargado; antes se consulta la base.",
+            [({}, int(index["loaded"]))],
+        ),
+        (
+            "trueliebot_dedup_analysis_cache_requests_total",
+            "counter",
+            "Consultas a la caché de análisis por hash por resultado.",
+            [
+                ({"result": "hit"}, cache["hits"]),
+                ({"result": "miss"}, cache["misses"]),
+            ],
+        ),
+        (
+            "trueliebot_dedup_analysis_cache_entries",
+            "gauge",
+            "Análisis memorizados en memoria.",
+            [({}, cache["entries"])],
+        ),
+    ]
+
+
+register_collector(_collect_dedup_metrics)
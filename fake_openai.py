@@ -0,0 +1,95 @@
+"""
+Servidor local que imita la API de chat de OpenAI, para pruebas y benchmarks.
+Complementa MOCK_OPENAI=1 con latencia, errores transitorios y streaming por HTTP.
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Responde a ``POST /v1/chat/completions`` con una respuesta fija."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        with server.lock:
+            server.requests += 1
+            failing = server.requests <= server.fail_first
+        if failing:
+            error = {"message": "Servicio no disponible", "type": "server_error"}
+            self._send_json(503, {"error": error})
+            return
+        time.sleep(server.delay)
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": server.answer}
+            self._send_json(200, {"choices": [{"index": 0, "message": message}]})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for token in server.answer.split(" "):
+            chunk = {"choices": [{"index": 0, "delta": {"content": token + " "}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(server.token_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def start_fake_upstream(
+    port=0, answer="París", delay=0.0, token_delay=0.0, fail_first=0
+):
+    """Arranca el servidor en un hilo; devuelve ``(server, api_base)``.
+
+    ``fail_first`` hace que las primeras peticiones respondan 503, para probar
+    los reintentos. Se detiene con ``server.shutdown()``.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.answer = answer
+    server.delay = delay
+    server.token_delay = token_delay
+    server.fail_first = fail_first
+    server.requests = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Servidor local que imita OpenAI.")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--answer", default="París")
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    parser.add_argument("--fail-first", type=int, default=0)
+    args = parser.parse_args(argv)
+    server, api_base = start_fake_upstream(
+        args.port, args.answer, args.delay, args.token_delay, args.fail_first
+    )
+    print(f"Fake OpenAI escuchando en {api_base} (usa OPENAI_API_BASE={api_base})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Utilidades de caché HTTP: ETag, Last-Modified, Cache-Control y respuestas 304.
+Permiten a los clientes que sondean la API revalidar sin volver a descargar nada.
+"""
+
+import hashlib
+from datetime import datetime, timezone
+
+from flask import Response, request
+
+
+def make_etag(*parts):
+    """Calcula un ETag estable a partir de las partes que determinan la respuesta."""
+    raw = "|".join(str(part) for part in parts).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+def parse_sqlite_datetime(value):
+    """Convierte un ``datetime('now')`` de SQLite (UTC) en un datetime con zona."""
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+
+
+def _apply(response, etag, last_modified, cache_control):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if cache_control:
+        response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def not_modified(etag, last_modified=None, cache_control=None):
+    """Devuelve una respuesta 304 si el cliente ya tiene esta versión, o None.
+
+    Se comprueba antes de construir el cuerpo, para no hacer el trabajo cuando la
+    respuesta no ha cambiado. ``If-None-Match`` tiene prioridad sobre
+    ``If-Modified-Since``.
+    """
+    response = _apply(Response(), etag, last_modified, cache_control)
+    response = response.make_conditional(request)
+    return response if response.status_code == 304 else None
+
+
+def cached(response, etag, last_modified=None, cache_control=None):
+    """Añade a ``response`` las cabeceras de validación y de caché."""
+    if isinstance(response, tuple):
+        _apply(response[0], etag, last_modified, cache_control)
+        return response
+    return _apply(response, etag, last_modified, cache_control)
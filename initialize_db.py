@@ -1,18 +1,428 @@
 """
-Script para inicializar la base de datos SQLite con datos de prueba.
+Script para inicializar la base de datos con datos de prueba.
+Incluye el esquema de SQLite (tablas, índices y triggers) que se crea en cada shard
+y sus migraciones, que nunca borran datos.
 """
 
-import sqlite3
+import argparse
 
+from bulk_import import batched
+from db import (
+    SHARD_ID_SPAN,
+    content_hash,
+    decode_archive_block,
+    get_db_connection,
+    length_bucket_sql,
+    shard_paths,
+)
+from storage import fetch_conversation_batch, insert_conversations, setup_schema
 
-def initialize_database():
-    """Crea la base de datos y la tabla de conversaciones con datos de ejemplo."""
-    connection = sqlite3.connect("conversations.db")
-    cursor = connection.cursor()
+# Coletillas de los mensajes de prueba; algunas contienen palabras clave
+SAMPLE_SUFFIXES = [
+    "",
+    ". Hoy noté una microexpresión de enfado.",
+    ", sin nada especial que comentar.",
+    ". Dice que no, pero la carga cognitiva de la respuesta era evidente.",
+    ". Me escribió muy tarde y con prisas.",
+    ". Su tono emocional cambió de repente.",
+    ". Leí que la IA ya analiza patrones verbales.",
+    ". Todo normal.",
+]
 
-    # Eliminar la tabla si ya existe (opcional, si quieres recrearla siempre)
+
+def create_search_index(cursor):
+    """Crea la tabla FTS5 de búsqueda de mensajes y los triggers que la sincronizan."""
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'conversations_fts'"
+    ).fetchone()
+    # unicode61 con remove_diacritics 2 ignora tildes y mayúsculas, como normalize()
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            message,
+            content='conversations',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_ai AFTER INSERT ON conversations
+        BEGIN
+            INSERT INTO conversations_fts(rowid, message)
+            VALUES (new.id, new.message);
+        END
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_ad AFTER DELETE ON conversations
+        BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+        END
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_au AFTER UPDATE ON conversations
+        BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+            INSERT INTO conversations_fts(rowid, message)
+            VALUES (new.id, new.message);
+        END
+        """
+    )
+    # Indexar las filas que ya hubiera en conversations, solo al crear el índice
+    if not exists:
+        cursor.execute(
+            "INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')"
+        )
+
+
+def create_topics_table(cursor):
+    """Crea la tabla de temas detectados por mensaje y sus índices."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversation_topics (
+            conversation_id INTEGER NOT NULL,
+            profile TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            PRIMARY KEY (conversation_id, topic)
+        ) WITHOUT ROWID
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_topics_profile_topic "
+        "ON conversation_topics(profile, topic, conversation_id)"
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS conversation_topics_ad
+        AFTER DELETE ON conversations
+        BEGIN
+            DELETE FROM conversation_topics WHERE conversation_id = old.id;
+        END
+        """
+    )
+
+
+def create_analysis_table(cursor):
+    """Crea la tabla con el último análisis offline de cada mensaje."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversation_analysis (
+            conversation_id INTEGER PRIMARY KEY,
+            profile TEXT NOT NULL,
+            study_citation TEXT,
+            cue_score REAL NOT NULL,
+            analyzed_at TEXT NOT NULL
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS conversation_analysis_ad
+        AFTER DELETE ON conversations
+        BEGIN
+            DELETE FROM conversation_analysis WHERE conversation_id = old.id;
+        END
+        """
+    )
+    # Fecha del último reanálisis de un perfil (versión de sus páginas)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_analysis_profile_analyzed "
+        "ON conversation_analysis(profile, analyzed_at)"
+    )
+
+
+def create_stats_tables(cursor):
+    """Crea las tablas de resumen por perfil y los triggers que las actualizan.
+
+    Las estadísticas se mantienen de forma incremental en cada inserción o borrado,
+    sin recorrer la tabla de conversaciones. La actividad diaria registra cuándo
+    se guardaron los mensajes y no se descuenta al borrarlos.
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS profile_stats (
+            profile TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            total_length INTEGER NOT NULL DEFAULT 0,
+            first_seen TEXT,
+            last_seen TEXT
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS profile_length_stats (
+            profile TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (profile, bucket)
+        ) WITHOUT ROWID
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS profile_activity_stats (
+            profile TEXT NOT NULL,
+            day TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (profile, day)
+        ) WITHOUT ROWID
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS profile_topic_stats (
+            profile TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (profile, topic)
+        ) WITHOUT ROWID
+        """
+    )
+    new_bucket = length_bucket_sql("new.message")
+    old_bucket = length_bucket_sql("old.message")
+    cursor.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS profile_stats_ai AFTER INSERT ON conversations
+        BEGIN
+            INSERT INTO profile_stats
+                (profile, message_count, total_length, first_seen, last_seen)
+            VALUES (new.profile, 1, length(new.message), datetime('now'),
+                    datetime('now'))
+            ON CONFLICT(profile) DO UPDATE SET
+                message_count = message_count + 1,
+                total_length = total_length + excluded.total_length,
+                last_seen = excluded.last_seen;
+            INSERT INTO profile_length_stats (profile, bucket, message_count)
+            VALUES (new.profile, {new_bucket}, 1)
+            ON CONFLICT(profile, bucket) DO UPDATE SET
+                message_count = message_count + 1;
+            INSERT INTO profile_activity_stats (profile, day, message_count)
+            VALUES (new.profile, date('now'), 1)
+            ON CONFLICT(profile, day) DO UPDATE SET
+                message_count = message_count + 1;
+        END
+        """
+    )
+    cursor.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS profile_stats_ad AFTER DELETE ON conversations
+        BEGIN
+            UPDATE profile_stats SET
+                message_count = message_count - 1,
+                total_length = total_length - length(old.message)
+            WHERE profile = old.profile;
+            UPDATE profile_length_stats SET message_count = message_count - 1
+            WHERE profile = old.profile AND bucket = {old_bucket};
+        END
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS profile_topic_stats_ai
+        AFTER INSERT ON conversation_topics
+        BEGIN
+            INSERT INTO profile_topic_stats (profile, topic, message_count)
+            VALUES (new.profile, new.topic, 1)
+            ON CONFLICT(profile, topic) DO UPDATE SET
+                message_count = message_count + 1;
+        END
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS profile_topic_stats_ad
+        AFTER DELETE ON conversation_topics
+        BEGIN
+            UPDATE profile_topic_stats SET message_count = message_count - 1
+            WHERE profile = old.profile AND topic = old.topic;
+        END
+        """
+    )
+
+
+def add_created_at(cursor):
+    """Migración 1: fecha de creación de cada mensaje.
+
+    Las filas existentes toman el ``last_seen`` de su perfil (la última fecha en que
+    pudieron guardarse), así que la retención nunca las archiva antes de tiempo. El
+    trigger de búsqueda pasa a reaccionar solo a cambios del mensaje.
+    """
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(conversations)")}
+    if "created_at" not in columns:
+        cursor.execute("ALTER TABLE conversations ADD COLUMN created_at TEXT")
+    cursor.execute("DROP TRIGGER IF EXISTS conversations_fts_au")
+    cursor.execute(
+        """
+        CREATE TRIGGER conversations_fts_au
+        AFTER UPDATE OF message ON conversations
+        BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+            INSERT INTO conversations_fts(rowid, message)
+            VALUES (new.id, new.message);
+        END
+        """
+    )
+    cursor.execute(
+        """
+        UPDATE conversations SET created_at = COALESCE(
+            (SELECT last_seen FROM profile_stats s
+             WHERE s.profile = conversations.profile),
+            datetime('now')
+        )
+        WHERE created_at IS NULL
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_created_at "
+        "ON conversations(created_at)"
+    )
+
+
+def create_archive_table(cursor):
+    """Migración 2: bloques comprimidos de mensajes archivados por perfil."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversation_archive (
+            id INTEGER PRIMARY KEY,
+            profile TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            oldest TEXT NOT NULL,
+            newest TEXT NOT NULL,
+            payload BLOB NOT NULL
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_archive_profile_first "
+        "ON conversation_archive(profile, first_id)"
+    )
+
+
+def add_content_hash(cursor):
+    """Migración 3: hash del contenido con índice único por perfil.
+
+    Si un perfil ya tenía mensajes repetidos, solo el primero recibe el hash; las
+    copias se conservan con el hash vacío (NULL no choca en el índice único).
+    """
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(conversations)")}
+    if "content_hash" not in columns:
+        cursor.execute("ALTER TABLE conversations ADD COLUMN content_hash TEXT")
+    cursor.connection.create_function(
+        "trueliebot_content_hash", 1, content_hash, deterministic=True
+    )
+    cursor.execute(
+        """
+        UPDATE conversations SET content_hash = trueliebot_content_hash(message)
+        WHERE id IN (
+            SELECT min(id) FROM conversations
+            GROUP BY profile, trueliebot_content_hash(message)
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_conversations_profile_hash "
+        "ON conversations(profile, content_hash)"
+    )
+
+
+def create_archive_hash_table(cursor):
+    """Migración 4: hashes de contenido de los mensajes archivados por perfil.
+
+    Las inserciones los consultan para no guardar otra vez un mensaje archivado. Se
+    rellena con los bloques que ya existían.
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversation_archive_hashes (
+            profile TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            PRIMARY KEY (profile, content_hash)
+        ) WITHOUT ROWID
+        """
+    )
+    blocks = cursor.execute(
+        "SELECT profile, payload FROM conversation_archive ORDER BY first_id"
+    ).fetchall()
+    for profile, payload in blocks:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO conversation_archive_hashes "
+            "(profile, content_hash, conversation_id) VALUES (?, ?, ?)",
+            [
+                (profile, content_hash(row[1]), row[0])
+                for row in decode_archive_block(payload)
+            ],
+        )
+
+
+# Migraciones en orden; PRAGMA user_version guarda cuántas se han aplicado
+MIGRATIONS = [
+    add_created_at,
+    create_archive_table,
+    add_content_hash,
+    create_archive_hash_table,
+]
+
+
+def migrate_schema(cursor):
+    """Aplica las migraciones pendientes del shard; devuelve las aplicadas.
+
+    Cada migración es idempotente y solo añade columnas, tablas o índices.
+    """
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(cursor)
+        cursor.execute(f"PRAGMA user_version = {number}")
+    return len(MIGRATIONS) - min(version, len(MIGRATIONS))
+
+
+def generate_messages(num_messages, num_profiles=1):
+    """Genera mensajes de prueba ``(profile, message)`` repartidos entre perfiles.
+
+    El primer perfil es ``default``; algunos mensajes incluyen palabras clave para
+    que la detección de temas tenga trabajo realista.
+    """
+    profiles = ["default"] + [f"perfil_{k}" for k in range(1, num_profiles)]
+    for i in range(1, num_messages + 1):
+        suffix = SAMPLE_SUFFIXES[i % len(SAMPLE_SUFFIXES)]
+        yield profiles[i % len(profiles)], f"Mensaje de prueba número {i}{suffix}"
+
+
+def drop_schema(cursor):
+    """Elimina las tablas de conversaciones, búsqueda, temas, análisis y resumen."""
+    cursor.execute("DROP TABLE IF EXISTS conversations_fts")
+    cursor.execute("DROP TABLE IF EXISTS conversation_topics")
+    cursor.execute("DROP TABLE IF EXISTS conversation_analysis")
+    cursor.execute("DROP TABLE IF EXISTS conversation_archive")
+    cursor.execute("DROP TABLE IF EXISTS conversation_archive_hashes")
     cursor.execute("DROP TABLE IF EXISTS conversations")
+    for table in (
+        "profile_stats",
+        "profile_length_stats",
+        "profile_activity_stats",
+        "profile_topic_stats",
+    ):
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.execute("PRAGMA user_version = 0")
+
 
+def create_schema(cursor, shard=0):
+    """Crea el esquema completo de un shard; no toca lo que ya exista.
+
+    Los ids del shard ``shard`` empiezan en ``shard * SHARD_ID_SPAN`` para que
+    sean únicos entre todos los shards.
+    """
     # Crear la tabla con la estructura correcta
     cursor.execute(
         """
@@ -23,20 +433,75 @@ def initialize_database():
         )
         """
     )
+    if shard:
+        cursor.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'conversations', ? "
+            "WHERE NOT EXISTS "
+            "(SELECT 1 FROM sqlite_sequence WHERE name = 'conversations')",
+            (shard * SHARD_ID_SPAN,),
+        )
 
-    # Crear índice para mejorar el rendimiento de las búsquedas por perfil
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_profile ON conversations(profile)")
-
-    # Insertar múltiples datos de prueba para probar la paginación
-    mensajes = [("default", f"Mensaje de prueba número {i}") for i in range(1, 51)]
-    cursor.executemany(
-        "INSERT INTO conversations (profile, message) VALUES (?, ?)", mensajes
+    # Índice compuesto para búsquedas por perfil y paginación por clave (keyset)
+    cursor.execute("DROP INDEX IF EXISTS idx_profile")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_profile_id ON conversations(profile, id)"
     )
 
-    connection.commit()
-    connection.close()
-    print("Base de datos inicializada correctamente con 50 mensajes de prueba.")
+    create_search_index(cursor)
+    create_topics_table(cursor)
+    create_analysis_table(cursor)
+    create_stats_tables(cursor)
+    migrate_schema(cursor)
+
+
+def setup_sqlite_schema(reset=False):
+    """Crea o migra el esquema de cada shard de SQLite; ``reset`` lo recrea vacío."""
+    for index, path in enumerate(shard_paths()):
+        connection = get_db_connection(path)
+        cursor = connection.cursor()
+        if reset:
+            drop_schema(cursor)
+        create_schema(cursor, index)
+        connection.commit()
+        connection.close()
+
+
+def initialize_database(
+    num_messages=50, num_profiles=1, batch_size=10000, reset=False
+):
+    """Crea o migra la base de datos del backend configurado.
+
+    Solo con ``reset`` se borran los datos existentes. Los mensajes de ejemplo se
+    insertan si la base de datos queda vacía.
+    """
+    setup_schema(reset=reset)
+    if fetch_conversation_batch(0, 1):
+        print("Esquema actualizado; la base de datos ya tenía datos.")
+        return
+
+    # Insertar datos de prueba por lotes (con sus temas) para probar la paginación
+    inserted = 0
+    for batch in batched(generate_messages(num_messages, num_profiles), batch_size):
+        inserted += insert_conversations(batch)
+        if num_messages > batch_size:
+            print(f"Insertados {inserted} de {num_messages} mensajes...")
+    print(f"Base de datos inicializada con {num_messages} mensajes de prueba.")
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(
+        description="Inicializa la base de datos con datos de prueba."
+    )
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--profiles", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--reset", action="store_true", help="borra los datos existentes"
+    )
+    args = parser.parse_args(argv)
+    initialize_database(args.messages, args.profiles, args.batch_size, args.reset)
 
 
 if __name__ == "__main__":
-    initialize_database()
+    main()
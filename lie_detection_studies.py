@@ -3,7 +3,8 @@ Módulo con la base científica y utilidades para estudios de detección de enga
 Incluye función para obtener citas relevantes según el tema.
 """
 
-import unicodedata
+from functools import lru_cache
+from topic_detection import KEYWORDS, normalize
 
 studies = [
     {
@@ -72,33 +73,70 @@ studies = [
     }
 ]
 
-def get_study_citation_by_topic(topic):
-    """Devuelve la cita y el resumen de un estudio relevante según el tema o palabra clave normalizada."""
-    def normalize(text):
-        return unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode('utf-8').lower()
-    topic_norm = normalize(topic)
-    topic_aliases = {
-        "fmri": ["fmri", "resonancia", "f m r i", "magnetic resonance", "resonancia cerebral"],
-        "resonancia": ["fmri", "resonancia", "f m r i", "magnetic resonance", "resonancia cerebral"],
-        "verbal": ["verbal", "paraverbal", "señal verbal", "señales verbales", "verbales", "verbalidad"],
-    }
+TOPIC_ALIASES = {
+    "fmri": ["fmri", "resonancia", "f m r i", "magnetic resonance", "resonancia cerebral"],
+    "resonancia": ["fmri", "resonancia", "f m r i", "magnetic resonance", "resonancia cerebral"],
+    "verbal": ["verbal", "paraverbal", "señal verbal", "señales verbales", "verbales", "verbalidad"],
+}
+
+# Alias normalizados una sola vez al importar el módulo
+_ALIAS_NORMS = {normalize(a) for aliases in TOPIC_ALIASES.values() for a in aliases}
+
+
+def _build_study_index():
+    """Precalcula los textos normalizados de cada estudio y si contienen algún alias."""
+    entries = []
     for s in studies:
         title_norm = normalize(s["title"])
         summary_norm = normalize(s["summary"])
+        has_alias = any(a in title_norm or a in summary_norm for a in _ALIAS_NORMS)
+        result = (s["citation"], s["summary"])
+        entries.append((title_norm, summary_norm, has_alias, result))
+    return entries
+
+
+_STUDY_INDEX = _build_study_index()
+
+
+def _resolve_topic(topic_norm):
+    """Busca el primer estudio relevante para un tema ya normalizado."""
+    for title_norm, summary_norm, has_alias, result in _STUDY_INDEX:
         # Coincidencia directa o por subcadena
         if topic_norm in title_norm or topic_norm in summary_norm:
-            return (s["citation"], s["summary"])
-        # Coincidencia por alias: buscar si algún alias está como subcadena en el título o resumen
-        for key, aliases in topic_aliases.items():
-            alias_norms = [normalize(alias) for alias in aliases]
-            if topic_norm == key or topic_norm in alias_norms:
-                for alias_norm in alias_norms:
-                    if alias_norm in title_norm or alias_norm in summary_norm:
-                        return (s["citation"], s["summary"])
-        # Coincidencia explícita: si cualquier alias está en el título o resumen (no solo para keys)
-        for aliases in topic_aliases.values():
-            for alias in aliases:
-                alias_norm = normalize(alias)
-                if alias_norm in title_norm or alias_norm in summary_norm:
-                    return (s["citation"], s["summary"])
+            return result
+        # Coincidencia por alias: cualquier alias presente en el título o resumen
+        if has_alias:
+            return result
     return (None, None)
+
+
+def _build_topic_index():
+    """Indexa de antemano los temas detectables y todos sus alias."""
+    topics = {normalize(topic) for topic, _ in KEYWORDS}
+    topics.update(normalize(k) for _, keyword_list in KEYWORDS for k in keyword_list)
+    topics.update(_ALIAS_NORMS)
+    topics.update(TOPIC_ALIASES)
+    return {topic: _resolve_topic(topic) for topic in topics}
+
+
+_TOPIC_INDEX = _build_topic_index()
+
+
+@lru_cache(maxsize=1024)
+def _lookup(topic_norm):
+    """Resuelve temas no indexados, memorizando el resultado."""
+    return _resolve_topic(topic_norm)
+
+
+def get_study_citation_by_topic(topic):
+    """Devuelve la cita y el resumen de un estudio relevante según el tema o palabra clave normalizada."""
+    topic_norm = normalize(topic)
+    result = _TOPIC_INDEX.get(topic_norm)
+    if result is None:
+        result = _lookup(topic_norm)
+    return result
+
+
+def get_study_citations_by_topics(topics):
+    """Resuelve varios temas a la vez; devuelve un dict tema -> (cita, resumen)."""
+    return {topic: get_study_citation_by_topic(topic) for topic in topics}
@@ -0,0 +1,248 @@
+"""
+Métricas en proceso (contadores e histogramas) con exposición en formato Prometheus.
+Pensado para coste mínimo en el camino crítico: un bisect y una suma bajo un lock.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+# Límites por defecto (en segundos) de los histogramas de latencia
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+_registry = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador monótono con etiquetas."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        register(self)
+
+    def inc(self, amount=1, **labels):
+        """Incrementa el contador de la serie con las etiquetas dadas."""
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Valor actual de la serie con las etiquetas dadas."""
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def samples(self):
+        """Genera las muestras ``(nombre{etiquetas}, valor)`` del contador."""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name + _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Histograma de latencias con cubos fijos y etiquetas."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+        register(self)
+
+    def observe(self, value, **labels):
+        """Registra una observación en la serie con las etiquetas dadas."""
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Recuentos por cubo (no acumulados), suma y número de observaciones
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Mide la duración del bloque ``with`` y la registra."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        """Número de observaciones de la serie con las etiquetas dadas."""
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            return series[2] if series else 0
+
+    def samples(self):
+        """Genera las muestras acumuladas por cubo, la suma y el recuento."""
+        with self._lock:
+            items = [(k, (list(s[0]), s[1], s[2])) for k, s in self._series.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                labels = _format_labels(
+                    self.labelnames, key, ("le", _format_value(bound))
+                )
+                yield f"{self.name}_bucket{labels}", cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels}", total
+            yield f"{self.name}_count{labels}", count
+
+
+def register(metric):
+    """Registra una métrica para que aparezca en ``render``."""
+    with _registry_lock:
+        _registry.append(metric)
+
+
+def register_collector(collector):
+    """Registra una función que genera ``(nombre, tipo, ayuda, muestras)``.
+
+    ``muestras`` es una lista de ``(dict_de_etiquetas, valor)``.
+
+    Sirve para exponer valores que ya se cuentan en otro módulo (p. ej. la caché de
+    OpenAI) sin duplicar contadores en el camino crítico.
+    """
+    with _registry_lock:
+        _collectors.append(collector)
+
+
+def render():
+    """Devuelve todas las métricas en el formato de texto de Prometheus."""
+    with _registry_lock:
+        metrics = list(_registry)
+        collectors = list(_collectors)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample, value in metric.samples():
+            lines.append(f"{sample} {_format_value(value)}")
+    for collector in collectors:
+        for name, kind, help_text, samples in collector():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                names = tuple(labels)
+                label_text = _format_labels(names, tuple(labels[n] for n in names))
+                lines.append(f"{name}{label_text} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+http_request_duration = Histogram(
+    "trueliebot_http_request_duration_seconds",
+    "Latencia de las peticiones HTTP por ruta, método y estado.",
+    ("method", "route", "status"),
+)
+db_query_duration = Histogram(
+    "trueliebot_db_query_duration_seconds",
+    "Duración de las operaciones de base de datos.",
+    ("operation",),
+)
+topic_detection_duration = Histogram(
+    "trueliebot_topic_detection_duration_seconds",
+    "Duración de la detección de temas por mensaje.",
+)
+cue_scoring_duration = Histogram(
+    "trueliebot_cue_scoring_duration_seconds",
+    "Duración de la puntuación de indicios de engaño por lote de mensajes.",
+)
+openai_request_duration = Histogram(
+    "trueliebot_openai_request_duration_seconds",
+    "Latencia de las llamadas a OpenAI por resultado.",
+    ("outcome",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+rate_limited_requests = Counter(
+    "trueliebot_rate_limited_requests_total",
+    "Peticiones rechazadas con 429 por cuota y ámbito (perfil o IP).",
+    ("quota", "scope"),
+)
+
+
+def timed_query(operation):
+    """Decorador que registra la duración de una operación de base de datos."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                db_query_duration.observe(
+                    time.perf_counter() - start, operation=operation
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    """Registra en la app la medición de latencia por ruta y el endpoint /metrics."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_latency(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            rule = request.url_rule.rule if request.url_rule else "unmatched"
+            http_request_duration.observe(
+                time.perf_counter() - start,
+                method=request.method,
+                route=rule,
+                status=response.status_code,
+            )
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics_endpoint():
+        """Expone las métricas del proceso en formato Prometheus."""
+        return Response(render(), mimetype="text/plain; version=0.0.4")
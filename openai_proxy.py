@@ -0,0 +1,239 @@
+"""
+Proxy hacia la API de OpenAI con límite de peticiones en vuelo, timeouts y reintentos.
+Las llamadas se ejecutan en un pool de hilos dedicado; admite respuestas en streaming.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import openai
+
+from metrics import openai_request_duration
+
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+OPENAI_MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", "100"))
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE", "")  # vacío = API oficial
+OPENAI_ADMISSION_TIMEOUT = float(os.environ.get("OPENAI_ADMISSION_TIMEOUT", "0.1"))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "30"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "2"))
+OPENAI_BACKOFF_BASE = float(os.environ.get("OPENAI_BACKOFF_BASE", "0.5"))
+# Plazo total de una petición (intentos y esperas incluidos); debe quedar por debajo
+# de GUNICORN_TIMEOUT (60) para responder 504 antes de que se reinicie el worker
+OPENAI_DEADLINE = float(os.environ.get("OPENAI_DEADLINE", "45"))
+# Hilos por worker de Gunicorn (gunicorn.conf.py): cada llamada en vuelo ocupa uno
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", "4"))
+
+
+def max_in_flight(threads, configured=None):
+    """Llamadas simultáneas a OpenAI por proceso: como mucho ``threads - 1``.
+
+    Así siempre queda un hilo del worker para las demás rutas aunque OpenAI vaya
+    lento. Con un solo hilo no hay margen y el límite es 1.
+    """
+    cap = max(threads - 1, 1)
+    return cap if configured is None else max(min(configured, cap), 1)
+
+
+OPENAI_MAX_IN_FLIGHT = max_in_flight(
+    GUNICORN_THREADS,
+    int(os.environ["OPENAI_MAX_IN_FLIGHT"])
+    if os.environ.get("OPENAI_MAX_IN_FLIGHT")
+    else None,
+)
+
+# Respuesta fija del modo mock (MOCK_OPENAI=1)
+MOCK_ANSWER = "París"
+
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+class UpstreamBusyError(Exception):
+    """Se alcanzó el límite de peticiones simultáneas hacia OpenAI."""
+
+
+class UpstreamTimeoutError(Exception):
+    """OpenAI no respondió dentro de ``OPENAI_DEADLINE``."""
+
+
+_slots = threading.BoundedSemaphore(OPENAI_MAX_IN_FLIGHT)
+_executor = ThreadPoolExecutor(
+    max_workers=OPENAI_MAX_IN_FLIGHT, thread_name_prefix="openai"
+)
+
+
+def is_mock():
+    """Indica si está activo el modo mock para pruebas locales."""
+    return os.environ.get("MOCK_OPENAI", "0") == "1"
+
+
+def backoff_delay(attempt):
+    """Espera antes del reintento ``attempt`` (backoff exponencial con jitter)."""
+    return random.uniform(0, OPENAI_BACKOFF_BASE * (2**attempt))
+
+
+def new_deadline():
+    """Instante (``time.monotonic()``) en que vence una petición que empieza ahora."""
+    return time.monotonic() + OPENAI_DEADLINE
+
+
+def with_retries(func, *args, deadline, **kwargs):
+    """Ejecuta ``func(..., deadline=deadline)`` reintentando los errores transitorios.
+
+    No se empieza un reintento después de ``deadline``: se lanza
+    ``UpstreamTimeoutError``.
+    """
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            return func(*args, deadline=deadline, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            delay = backoff_delay(attempt)
+            if time.monotonic() + delay >= deadline:
+                raise UpstreamTimeoutError("Tiempo de espera agotado con OpenAI") from e
+            if attempt == OPENAI_MAX_RETRIES:
+                raise
+            time.sleep(delay)
+
+
+def _create(prompt, model, max_tokens, deadline, stream=False):
+    """Llama a ``ChatCompletion.create`` con el timeout y la URL base configurados.
+
+    El timeout del intento se recorta para no pasar de ``deadline``.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise UpstreamTimeoutError("Tiempo de espera agotado con OpenAI")
+    kwargs = {}
+    if OPENAI_API_BASE:
+        kwargs["api_base"] = OPENAI_API_BASE
+    start = time.perf_counter()
+    outcome = "success"
+    try:
+        return openai.ChatCompletion.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            request_timeout=min(OPENAI_TIMEOUT, remaining),
+            stream=stream,
+            **kwargs,
+        )
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        openai_request_duration.observe(time.perf_counter() - start, outcome=outcome)
+
+
+def request_completion(prompt, model, max_tokens, deadline):
+    """Solicita una respuesta a OpenAI (o al mock local si MOCK_OPENAI=1)."""
+    if is_mock():
+        return MOCK_ANSWER
+    response = with_retries(_create, prompt, model, max_tokens, deadline=deadline)
+    try:
+        response_dict = json.loads(response.__str__())
+    except Exception:
+        response_dict = response if isinstance(response, dict) else {}
+    choice = response_dict.get("choices", [{}])[0]
+    return choice.get("message", {}).get("content", "").strip()
+
+
+def submit(func, *args):
+    """Ejecuta ``func`` en el pool de OpenAI respetando el límite de peticiones.
+
+    El hueco se libera cuando la llamada termina, aunque el llamante haya dejado de
+    esperarla. Lanza ``UpstreamBusyError`` si no hay hueco libre a tiempo.
+    """
+    if not _slots.acquire(timeout=OPENAI_ADMISSION_TIMEOUT):
+        raise UpstreamBusyError("Demasiadas peticiones simultáneas a OpenAI")
+    try:
+        future = _executor.submit(func, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def complete(prompt, model=OPENAI_MODEL, max_tokens=OPENAI_MAX_TOKENS):
+    """Obtiene una respuesta completa con límite de concurrencia y plazo máximo.
+
+    Lanza ``UpstreamTimeoutError`` si no hay respuesta dentro de
+    ``OPENAI_DEADLINE`` segundos.
+    """
+    deadline = new_deadline()
+    future = submit(request_completion, prompt, model, max_tokens, deadline)
+    try:
+        return future.result(OPENAI_DEADLINE)
+    except FutureTimeoutError:
+        raise UpstreamTimeoutError("Tiempo de espera agotado con OpenAI") from None
+
+
+class CompletionStream:
+    """Iterador de fragmentos de texto que libera su hueco al agotarse o cerrarse."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._lock = threading.Lock()
+        self._released = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks:
+                delta = chunk["choices"][0].get("delta", {})
+                if delta.get("content"):
+                    yield delta["content"]
+        finally:
+            self.close()
+
+    def close(self):
+        """Libera el hueco de concurrencia (idempotente)."""
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        _slots.release()
+
+
+def _mock_chunks():
+    """Fragmentos con el formato del streaming de OpenAI, para MOCK_OPENAI=1."""
+    half = len(MOCK_ANSWER) // 2
+    for text in (MOCK_ANSWER[:half], MOCK_ANSWER[half:]):
+        yield {"choices": [{"delta": {"content": text}}]}
+
+
+def stream_completion(prompt, model=OPENAI_MODEL, max_tokens=OPENAI_MAX_TOKENS):
+    """Abre una respuesta en streaming y devuelve un ``CompletionStream``.
+
+    La conexión se establece (con reintentos, en ``OPENAI_DEADLINE`` como mucho)
+    antes de devolver, así que los errores de admisión, de red o de plazo se pueden
+    responder con su código HTTP. El hueco de concurrencia queda ocupado hasta que
+    el stream se agota o se cierra.
+    """
+    if not _slots.acquire(timeout=OPENAI_ADMISSION_TIMEOUT):
+        raise UpstreamBusyError("Demasiadas peticiones simultáneas a OpenAI")
+    try:
+        if is_mock():
+            chunks = _mock_chunks()
+        else:
+            chunks = with_retries(
+                _create, prompt, model, max_tokens, deadline=new_deadline(), stream=True
+            )
+    except BaseException:
+        _slots.release()
+        raise
+    return CompletionStream(chunks)
+
+
+def shutdown_openai_pool():
+    """Detiene el pool de OpenAI sin esperar a las llamadas en curso."""
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,270 @@
+"""
+Estado incremental por perfil (temas, puntuaciones de indicios recientes y ritmo de
+mensajes) en una caché LRU en memoria del proceso. Cada mensaje nuevo lo actualiza
+en O(1); si falta o ha caducado se reconstruye desde la base de datos. También guarda
+las sumas de indicios de todo el historial una vez que se han pedido.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from deception_cues import cue_matrix, scan_profile
+from metrics import register_collector
+from storage import (
+    count_topics,
+    fetch_conversations,
+    fetch_conversations_version,
+    fetch_recent_conversations,
+)
+
+PROFILE_STATE_MAX_PROFILES = int(
+    os.environ.get("PROFILE_STATE_MAX_PROFILES", "10000")
+)
+# Cada worker tiene su caché: el TTL acota cuánto tarda en ver lo que escriben los demás
+PROFILE_STATE_TTL = float(os.environ.get("PROFILE_STATE_TTL", "300"))
+PROFILE_STATE_WINDOW = int(os.environ.get("PROFILE_STATE_WINDOW", "50"))
+PROFILE_STATE_RATE_WINDOW = float(os.environ.get("PROFILE_STATE_RATE_WINDOW", "60"))
+# Umbrales de las alertas a nivel de conversación
+PROFILE_STATE_SCORE_THRESHOLD = float(
+    os.environ.get("PROFILE_STATE_SCORE_THRESHOLD", "0.5")
+)
+PROFILE_STATE_MIN_MESSAGES = int(os.environ.get("PROFILE_STATE_MIN_MESSAGES", "5"))
+PROFILE_STATE_BURST_RATE = float(os.environ.get("PROFILE_STATE_BURST_RATE", "20"))
+
+
+class ProfileState:
+    """Estadísticas acumuladas de un perfil que se actualizan mensaje a mensaje."""
+
+    def __init__(self, message_count=0, topic_counts=None, scores=(), now=None):
+        self.message_count = message_count
+        self.topic_counts = dict(topic_counts or {})
+        self.scores = deque(maxlen=PROFILE_STATE_WINDOW)
+        self.score_sum = 0.0
+        for score in scores:
+            self._push_score(score)
+        # Instantes de los mensajes recibidos por este proceso (ritmo de mensajes)
+        self.arrivals = deque()
+        # Sumas de indicios de todo el historial; None hasta que se piden
+        self.cues = None
+        self.built_at = time.monotonic() if now is None else now
+
+    def _push_score(self, score):
+        if len(self.scores) == self.scores.maxlen:
+            self.score_sum -= self.scores[0]
+        self.scores.append(score)
+        self.score_sum += score
+
+    def _trim_arrivals(self, now):
+        while self.arrivals and now - self.arrivals[0] > PROFILE_STATE_RATE_WINDOW:
+            self.arrivals.popleft()
+
+    def mark_arrival(self, now):
+        """Cuenta un mensaje recibido en el ritmo de mensajes."""
+        self.arrivals.append(now)
+        self._trim_arrivals(now)
+
+    def update(self, topics, score, now=None, cues=None, conversation_id=None):
+        """Incorpora un mensaje nuevo con sus temas y su puntuación de indicios.
+
+        ``cues`` son los rasgos del mensaje para las sumas del historial; sin ellos
+        (o si no se pueden sumar) las sumas se descartan y se recalculan al pedirlas.
+        """
+        now = time.monotonic() if now is None else now
+        self.message_count += 1
+        for topic in topics:
+            self.topic_counts[topic] = self.topic_counts.get(topic, 0) + 1
+        self._push_score(score)
+        self.mark_arrival(now)
+        if self.cues is not None:
+            if cues is None or not self.cues.add(conversation_id, cues, score):
+                self.cues = None
+
+    def snapshot(self, now=None):
+        """Resumen serializable del estado con las alertas de la conversación."""
+        now = time.monotonic() if now is None else now
+        self._trim_arrivals(now)
+        window = len(self.scores)
+        mean_score = self.score_sum / window if window else 0.0
+        rate = len(self.arrivals) * 60.0 / PROFILE_STATE_RATE_WINDOW
+        flags = []
+        if (
+            window >= PROFILE_STATE_MIN_MESSAGES
+            and mean_score >= PROFILE_STATE_SCORE_THRESHOLD
+        ):
+            flags.append("high_cue_scores")
+        if rate >= PROFILE_STATE_BURST_RATE:
+            flags.append("message_burst")
+        return {
+            "message_count": self.message_count,
+            "topics": dict(
+                sorted(self.topic_counts.items(), key=lambda item: -item[1])
+            ),
+            "recent_scores": {
+                "window": window,
+                "mean": round(mean_score, 4),
+                "last": round(self.scores[-1], 4) if window else None,
+            },
+            "messages_per_minute": round(rate, 2),
+            "flags": flags,
+        }
+
+
+def build_state(profile, now=None):
+    """Reconstruye el estado de un perfil desde la base de datos, o None si no existe.
+
+    Usa las tablas de resumen y los últimos ``PROFILE_STATE_WINDOW`` mensajes, sin
+    recorrer el historial. El ritmo de mensajes empieza vacío.
+    """
+    message_count = fetch_conversations_version(profile)["message_count"]
+    if not message_count:
+        return None
+    recent = fetch_recent_conversations(profile, PROFILE_STATE_WINDOW)
+    _, scores = cue_matrix(row["message"] for row in recent)
+    return ProfileState(message_count, count_topics(profile), scores, now)
+
+
+class ProfileStateCache:
+    """Estados por perfil en memoria; los menos usados se descartan por LRU."""
+
+    def __init__(self, max_profiles=PROFILE_STATE_MAX_PROFILES, ttl=PROFILE_STATE_TTL):
+        self.max_profiles = max_profiles
+        self.ttl = ttl
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, profile, now):
+        """Estado vigente en caché, marcado como recién usado; None si falta."""
+        state = self._states.get(profile)
+        if state is not None and self.ttl > 0 and now - state.built_at > self.ttl:
+            del self._states[profile]
+            state = None
+        if state is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._states.move_to_end(profile)
+        return state
+
+    def _store(self, profile, state):
+        self._states[profile] = state
+        self._states.move_to_end(profile)
+        while len(self._states) > self.max_profiles:
+            self._states.popitem(last=False)
+
+    def _state(self, profile, now):
+        with self._lock:
+            state = self._lookup(profile, now)
+        if state is not None:
+            return state, False
+        # La reconstrucción consulta la base de datos fuera del lock
+        state = build_state(profile, now)
+        if state is None:
+            return None, True
+        with self._lock:
+            self._store(profile, state)
+        return state, True
+
+    def get(self, profile, now=None):
+        """Resumen del estado del perfil; None si el perfil no tiene mensajes."""
+        now = time.monotonic() if now is None else now
+        state, _ = self._state(profile, now)
+        if state is None:
+            return None
+        with self._lock:
+            return state.snapshot(now)
+
+    def cues(self, profile, now=None):
+        """Medias de indicios de todo el historial del perfil; None si no tiene.
+
+        La primera consulta tras (re)construir el estado recorre el historial; las
+        siguientes usan las sumas que ``record`` mantiene con cada mensaje nuevo.
+        """
+        now = time.monotonic() if now is None else now
+        state, _ = self._state(profile, now)
+        if state is None:
+            return None
+        with self._lock:
+            summary = state.cues
+        if summary is None:
+            # El recorrido consulta la base de datos fuera del lock
+            summary = scan_profile(fetch_conversations, profile)
+            with self._lock:
+                if state.cues is None:
+                    state.cues = summary
+                summary = state.cues
+        with self._lock:
+            return summary.summary(profile)
+
+    def record(
+        self, profile, topics, score, now=None, cues=None, conversation_id=None
+    ):
+        """Aplica un mensaje recién guardado y devuelve el resumen actualizado.
+
+        Si el estado no estaba en caché se reconstruye, y la base de datos ya
+        incluye el mensaje: solo se cuenta en el ritmo de mensajes. ``cues`` y
+        ``conversation_id`` (None con inserción diferida) actualizan las sumas de
+        indicios del historial.
+        """
+        now = time.monotonic() if now is None else now
+        state, rebuilt = self._state(profile, now)
+        if state is None:
+            # Inserción diferida aún no escrita: el perfil empieza con este mensaje
+            state = ProfileState(now=now)
+            rebuilt = False
+            with self._lock:
+                self._store(profile, state)
+        with self._lock:
+            if rebuilt:
+                state.mark_arrival(now)
+            else:
+                state.update(topics, score, now, cues, conversation_id)
+            return state.snapshot(now)
+
+    def invalidate(self, profile=None):
+        """Descarta el estado de un perfil, o de todos sin ``profile``."""
+        with self._lock:
+            if profile is None:
+                self._states.clear()
+            else:
+                self._states.pop(profile, None)
+
+    def stats(self):
+        """Aciertos, fallos y perfiles en caché."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "profiles": len(self._states),
+            }
+
+
+profile_states = ProfileStateCache()
+
+
+def _collect_state_metrics():
+    """Expone los contadores de la caché de estado por perfil como métricas."""
+    stats = profile_states.stats()
+    return [
+        (
+            "trueliebot_profile_state_requests_total",
+            "counter",
+            "Consultas a la caché de estado por perfil por resultado.",
+            [
+                ({"result": "hit"}, stats["hits"]),
+                ({"result": "miss"}, stats["misses"]),
+            ],
+        ),
+        (
+            "trueliebot_profile_state_profiles",
+            "gauge",
+            "Perfiles con estado en memoria.",
+            [({}, stats["profiles"])],
+        ),
+    ]
+
+
+register_collector(_collect_state_metrics)
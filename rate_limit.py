@@ -0,0 +1,248 @@
+"""
+Limitación de peticiones por perfil e IP con cubos de tokens (token bucket).
+El estado vive en memoria del proceso o, para compartirlo entre workers, en SQLite.
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify, request
+
+from metrics import rate_limited_requests
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")  # o "sqlite"
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB", "rate_limits.db")
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+# Proxies de confianza delante de la app: cuántas entradas añaden al final de
+# X-Forwarded-For. Heroku (DYNO) y Render (RENDER) ponen su router delante, así que
+# allí se confía en uno por defecto; sin proxy la cabecera se puede falsificar
+_PLATFORM_ROUTER = "DYNO" in os.environ or "RENDER" in os.environ
+RATE_LIMIT_TRUST_PROXY = int(
+    os.environ.get("RATE_LIMIT_TRUST_PROXY", "1" if _PLATFORM_ROUTER else "0")
+)
+
+# Cuotas por defecto "peticiones/segundos"; se sobrescriben con RATE_LIMIT_<CUOTA>
+DEFAULT_QUOTAS = {
+    "openai": "30/60",
+    "write": "300/60",
+    "bulk": "10/60",
+    "read": "1200/60",
+}
+
+
+def parse_quota(text):
+    """Convierte ``"30/60"`` en ``(capacidad, tokens_por_segundo)``."""
+    count, seconds = text.split("/")
+    return int(count), int(count) / float(seconds)
+
+
+def load_quotas():
+    """Cuotas configuradas, con los valores por defecto y las del entorno."""
+    return {
+        name: parse_quota(os.environ.get(f"RATE_LIMIT_{name.upper()}", default))
+        for name, default in DEFAULT_QUOTAS.items()
+    }
+
+
+QUOTAS = load_quotas()
+
+
+def take_token(tokens, updated, now, capacity, rate, cost=1):
+    """Rellena el cubo hasta ``now`` e intenta gastar ``cost`` tokens.
+
+    Devuelve ``(tokens_restantes, espera)``; ``espera`` es 0 si se admite la
+    petición o los segundos hasta que haya tokens suficientes.
+    """
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryBackend:
+    """Cubos en memoria del proceso; los más antiguos se descartan por LRU."""
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key, capacity, rate, cost=1):
+        """Gasta ``cost`` tokens del cubo ``key``; devuelve la espera (0 = admitida)."""
+        return self.acquire_all([key], capacity, rate, cost)[0]
+
+    def acquire_all(self, keys, capacity, rate, cost=1):
+        """Gasta ``cost`` tokens de cada cubo, solo si todos los tienen.
+
+        Devuelve la espera de cada cubo (todas 0 = admitida); si alguno no tiene
+        tokens no se gasta de ninguno.
+        """
+        now = time.monotonic()
+        with self._lock:
+            results = []
+            for key in keys:
+                tokens, updated = self._buckets.pop(key, (capacity, now))
+                results.append(take_token(tokens, updated, now, capacity, rate, cost))
+            admitted = all(wait == 0 for _, wait in results)
+            for key, (tokens, wait) in zip(keys, results):
+                if not admitted and wait == 0:
+                    tokens += cost  # se devuelve lo gastado
+                self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return [wait for _, wait in results]
+
+    def clear(self):
+        """Vacía todos los cubos."""
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBackend:
+    """Cubos en una base de datos SQLite compartida por todos los workers.
+
+    Cada petición lee y actualiza su cubo en una transacción ``BEGIN IMMEDIATE``,
+    así que los workers de la misma máquina ven la misma cuota. Los cubos sin uso
+    durante ``ttl`` segundos se borran de vez en cuando.
+    """
+
+    def __init__(self, path=RATE_LIMIT_DB, ttl=3600, cleanup_every=1000):
+        self.path = path
+        self.ttl = ttl
+        self.cleanup_every = cleanup_every
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._calls = 0
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=5.0, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL"
+                ") WITHOUT ROWID"
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def acquire(self, key, capacity, rate, cost=1):
+        """Gasta ``cost`` tokens del cubo ``key``; devuelve la espera (0 = admitida)."""
+        return self.acquire_all([key], capacity, rate, cost)[0]
+
+    def acquire_all(self, keys, capacity, rate, cost=1):
+        """Gasta ``cost`` tokens de cada cubo en una transacción, solo si todos los
+        tienen; devuelve la espera de cada cubo (todas 0 = admitida).
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                results = []
+                for key in keys:
+                    row = conn.execute(
+                        "SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?",
+                        (key,),
+                    ).fetchone()
+                    tokens, updated = row if row else (capacity, now)
+                    results.append(
+                        take_token(tokens, updated, now, capacity, rate, cost)
+                    )
+                admitted = all(wait == 0 for _, wait in results)
+                conn.executemany(
+                    "INSERT INTO rate_limit_buckets (key, tokens, updated) "
+                    "VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                    "tokens = excluded.tokens, updated = excluded.updated",
+                    [
+                        (key, tokens if admitted or wait else tokens + cost, now)
+                        for key, (tokens, wait) in zip(keys, results)
+                    ],
+                )
+                self._calls += 1
+                if self._calls % self.cleanup_every == 0:
+                    conn.execute(
+                        "DELETE FROM rate_limit_buckets WHERE updated < ?",
+                        (now - self.ttl,),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return [wait for _, wait in results]
+
+    def clear(self):
+        """Vacía todos los cubos."""
+        with self._lock:
+            self._connection().execute("DELETE FROM rate_limit_buckets")
+
+
+def create_backend(name=RATE_LIMIT_BACKEND):
+    """Crea el backend configurado (``memory`` o ``sqlite``)."""
+    if name == "sqlite":
+        return SQLiteBackend()
+    if name != "memory":
+        raise ValueError(f"Backend de limitación desconocido: {name}")
+    return MemoryBackend()
+
+
+backend = create_backend()
+
+
+def client_ip():
+    """IP del cliente según los ``RATE_LIMIT_TRUST_PROXY`` proxies de confianza.
+
+    Cada proxy añade al final de X-Forwarded-For la IP que se le conectó, así que
+    el cliente es la entrada que añadió el primero de ellos; las anteriores las
+    puede haber escrito el propio cliente.
+    """
+    forwarded = request.headers.get("X-Forwarded-For")
+    if RATE_LIMIT_TRUST_PROXY and forwarded:
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        if len(hops) >= RATE_LIMIT_TRUST_PROXY:
+            return hops[-RATE_LIMIT_TRUST_PROXY]
+    return request.remote_addr or "desconocida"
+
+
+def rate_limit(quota, profile=None):
+    """Aplica la cuota ``quota`` a la IP del cliente y, si se indica, al perfil.
+
+    Devuelve una respuesta 429 con ``Retry-After`` si alguna se ha agotado, o None
+    si la petición puede seguir. Los dos cubos se comprueban a la vez: una petición
+    rechazada no gasta de ninguno. Si el backend falla, se deja pasar la petición.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return None
+    capacity, rate = QUOTAS[quota]
+    scopes = [("ip", client_ip())]
+    if profile is not None:
+        scopes.append(("profile", profile))
+    try:
+        waits = backend.acquire_all(
+            [f"{quota}:{scope}:{value}" for scope, value in scopes], capacity, rate
+        )
+    except Exception:
+        logger.exception("Fallo en el backend de limitación de peticiones")
+        return None
+    for (scope, _), wait in zip(scopes, waits):
+        if wait > 0:
+            rate_limited_requests.inc(quota=quota, scope=scope)
+    if max(waits) > 0:
+        return (
+            jsonify({"error": "Demasiadas peticiones, reintenta más tarde"}),
+            429,
+            {"Retry-After": str(math.ceil(max(waits)))},
+        )
+    return None
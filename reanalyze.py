@@ -0,0 +1,137 @@
+"""
+Reanálisis offline en paralelo de las conversaciones guardadas.
+Recorre la tabla por tramos de id, analiza cada tramo en un pool de procesos y guarda
+temas, cita y puntuación de indicios por lotes, con un punto de control para reanudar.
+Solo recorre la tabla activa: los mensajes archivados conservan el análisis que
+tenían al archivarse.
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from deception_cues import cue_matrix
+from lie_detection_studies import get_study_citation_by_topic
+from storage import fetch_conversation_batch, save_analysis, setup_schema
+from topic_detection import detect_topics, normalize
+
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_CHECKPOINT = "reanalysis_checkpoint.json"
+
+
+def analyze_chunk(rows):
+    """Analiza un tramo de ``(id, profile, message)``; se ejecuta en el pool.
+
+    Devuelve ``(conversation_id, profile, topics, cita, puntuación)`` por mensaje. La
+    cita es la del primer tema con estudio, como en ``POST /api/conversations``.
+    """
+    texts = [normalize(message) for _, _, message in rows]
+    _, scores = cue_matrix(texts, normalized=True)
+    results = []
+    for (conversation_id, profile, _), text, score in zip(rows, texts, scores):
+        topics = detect_topics(text, normalized=True)
+        citation = None
+        for topic in topics:
+            citation = get_study_citation_by_topic(topic)[0]
+            if citation:
+                break
+        results.append((conversation_id, profile, topics, citation, score))
+    return results
+
+
+def load_checkpoint(path):
+    """Lee el punto de control, o empieza desde el principio si no existe."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"last_id": 0, "processed": 0}
+
+
+def save_checkpoint(path, state):
+    """Escribe el punto de control de forma atómica (fichero temporal + rename)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def iter_chunks(after_id, chunk_size):
+    """Genera tramos consecutivos de ``(id, profile, message)`` por orden de id."""
+    while True:
+        rows = fetch_conversation_batch(after_id, chunk_size)
+        if not rows:
+            return
+        yield [(row["id"], row["profile"], row["message"]) for row in rows]
+        after_id = rows[-1]["id"]
+
+
+def reanalyze(
+    workers=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    checkpoint=DEFAULT_CHECKPOINT,
+    restart=False,
+):
+    """Reanaliza las conversaciones con id posterior al punto de control.
+
+    El proceso principal lee los tramos y los reparte entre ``workers`` procesos,
+    con como mucho ``2 * workers`` tramos en vuelo para acotar la memoria. Los
+    resultados se guardan en el orden de lectura, una transacción por tramo y
+    shard, y el punto de control avanza tras cada tramo: una ejecución interrumpida
+    se reanuda sin repetir ni saltarse mensajes. Al terminar se borra el punto de
+    control. Genera ``(ultimo_id, total_procesado)`` tras cada tramo.
+    """
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    state = load_checkpoint(checkpoint)
+    setup_schema()
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        chunks = iter_chunks(state["last_id"], chunk_size)
+        while True:
+            for chunk in chunks:
+                pending.append((chunk[-1][0], pool.submit(analyze_chunk, chunk)))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            last_id, future = pending.popleft()
+            state["processed"] += save_analysis(future.result())
+            state["last_id"] = last_id
+            save_checkpoint(checkpoint, state)
+            yield last_id, state["processed"]
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(
+        description="Reanaliza en paralelo las conversaciones guardadas. Los "
+        "mensajes archivados no se reanalizan: conservan el análisis y los temas "
+        "que tenían al archivarse."
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignora el punto de control"
+    )
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    resumed = 0 if args.restart else load_checkpoint(args.checkpoint)["processed"]
+    total = resumed
+    for last_id, total in reanalyze(
+        args.workers, args.chunk_size, args.checkpoint, args.restart
+    ):
+        rate = (total - resumed) / max(time.perf_counter() - start, 1e-9)
+        print(f"Procesados {total} mensajes (último id {last_id}, {rate:.0f}/s)")
+    print(f"Reanálisis completado: {total} mensajes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Rebalanceo de shards: mueve cada perfil al fichero que le corresponde según el
+anillo de hashing consistente después de cambiar DB_SHARDS.
+"""
+
+import argparse
+import os
+
+import db
+from archive_conversations import add_archived_stats
+from initialize_db import create_schema
+
+DEFAULT_BATCH_SIZE = 1000
+STATS_TABLES = (
+    "profile_stats",
+    "profile_length_stats",
+    "profile_activity_stats",
+    "profile_topic_stats",
+)
+# Progreso de cada movimiento en el shard destino: se actualiza en la misma
+# transacción que cada tramo copiado, así que una ejecución interrumpida se
+# reanuda donde se quedó en lugar de copiar de nuevo lo ya movido
+PROGRESS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rebalance_progress (
+        profile TEXT PRIMARY KEY,
+        source INTEGER NOT NULL,
+        id_offset INTEGER NOT NULL,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        moved INTEGER NOT NULL DEFAULT 0,
+        copied INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+
+def existing_shards():
+    """Índices de los ficheros de shard presentes en disco (consecutivos desde 0)."""
+    index = 0
+    while os.path.exists(db.shard_path(index)):
+        index += 1
+    return list(range(index))
+
+
+def ensure_shard_schema(index):
+    """Crea el esquema del shard ``index`` si su fichero aún no lo tiene."""
+    conn = db.get_db_connection(db.shard_path(index))
+    try:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'conversations'"
+        ).fetchone()
+        if not exists:
+            create_schema(conn.cursor(), index)
+        conn.execute(PROGRESS_SCHEMA)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def plan_moves(num_shards=None):
+    """Genera ``(perfil, shard_origen, shard_destino)`` de los perfiles mal ubicados."""
+    num_shards = num_shards or db.DB_SHARDS
+    for index in existing_shards():
+        with db.pooled_connection(db.shard_path(index)) as conn:
+            profiles = [
+                row[0]
+                for row in conn.execute("SELECT DISTINCT profile FROM conversations")
+            ]
+        for profile in profiles:
+            target = db.shard_index(profile, num_shards)
+            if target != index:
+                yield profile, index, target
+
+
+def id_offset(profile, source_path, target_path):
+    """Desplazamiento que lleva los ids del perfil al rango libre del destino.
+
+    Sumar la misma cantidad a todos los ids (activos y archivados) conserva su
+    orden y no choca con los ids que ya existen en el destino.
+    """
+    with db.pooled_connection(source_path) as conn:
+        first_id = conn.execute(
+            "SELECT min(first) FROM ("
+            "SELECT min(id) AS first FROM conversations WHERE profile = ? "
+            "UNION ALL "
+            "SELECT min(first_id) FROM conversation_archive WHERE profile = ?)",
+            (profile, profile),
+        ).fetchone()[0]
+    with db.pooled_connection(target_path) as conn:
+        last_id = conn.execute(
+            "SELECT max("
+            "COALESCE((SELECT seq FROM sqlite_sequence "
+            "WHERE name = 'conversations'), 0), "
+            "COALESCE((SELECT max(id) FROM conversations), 0), "
+            "COALESCE((SELECT max(last_id) FROM conversation_archive), 0))"
+        ).fetchone()[0]
+    return last_id + 1 - (first_id or 0)
+
+
+def copy_conversations(conn, profile, rows, topics, offset, analyses=None):
+    """Copia filas de ``conversations`` (con sus temas) en la transacción de ``conn``.
+
+    Cada fila recibe su id más ``offset`` y conserva el resto de columnas, también
+    el ``content_hash``: las copias repetidas que la migración dejó sin hash no
+    chocan con el índice único. ``analyses`` son las filas de
+    ``conversation_analysis`` de esos mensajes, que se copian con el mismo
+    desplazamiento.
+    """
+    for row in rows:
+        conversation_id = row["id"] + offset
+        conn.execute(
+            "INSERT INTO conversations "
+            "(id, profile, message, created_at, content_hash) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                conversation_id,
+                profile,
+                row["message"],
+                row["created_at"],
+                row["content_hash"],
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO conversation_topics (conversation_id, profile, topic) "
+            "VALUES (?, ?, ?)",
+            [(conversation_id, profile, topic) for topic in topics.get(row["id"], [])],
+        )
+    conn.executemany(
+        "INSERT INTO conversation_analysis "
+        "(conversation_id, profile, study_citation, cue_score, analyzed_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [
+            (
+                analysis["conversation_id"] + offset,
+                profile,
+                analysis["study_citation"],
+                analysis["cue_score"],
+                analysis["analyzed_at"],
+            )
+            for analysis in analyses or []
+        ],
+    )
+
+
+def start_move(profile, source, source_path, target_path):
+    """Progreso del movimiento del perfil: el de una ejecución anterior o uno nuevo.
+
+    Un progreso con otro shard de origen no es de este movimiento y se sustituye.
+    """
+    with db.pooled_connection(target_path) as conn:
+        progress = conn.execute(
+            "SELECT source, id_offset, last_id, moved, copied "
+            "FROM rebalance_progress WHERE profile = ?",
+            (profile,),
+        ).fetchone()
+    if progress is not None and progress["source"] == source:
+        return progress
+    offset = id_offset(profile, source_path, target_path)
+    with db.pooled_connection(target_path) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO rebalance_progress (profile, source, id_offset) "
+            "VALUES (?, ?, ?)",
+            (profile, source, offset),
+        )
+    return {"id_offset": offset, "last_id": 0, "moved": 0, "copied": 0}
+
+
+def move_profile(profile, source, target, batch_size=DEFAULT_BATCH_SIZE):
+    """Copia las conversaciones de un perfil (temas y análisis) y las borra del origen.
+
+    Los mensajes, activos y archivados, reciben ids del rango libre del shard destino
+    desplazados en bloque, así que conservan su orden, y mantienen su
+    ``created_at``. Las estadísticas se recalculan en el destino; la actividad
+    diaria, ``first_seen`` y ``last_seen`` se copian del origen. Si una ejecución
+    anterior se interrumpió, continúa desde el último tramo copiado. Devuelve los
+    mensajes movidos (sin los archivados).
+    """
+    source_path, target_path = db.shard_path(source), db.shard_path(target)
+    progress = start_move(profile, source, source_path, target_path)
+    offset, after_id, moved = (
+        progress["id_offset"],
+        progress["last_id"],
+        progress["moved"],
+    )
+    while not progress["copied"]:
+        with db.pooled_connection(source_path) as conn:
+            rows = conn.execute(
+                "SELECT id, message, created_at, content_hash FROM conversations "
+                "WHERE profile = ? AND id > ? ORDER BY id LIMIT ?",
+                (profile, after_id, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+            topics = {}
+            for conversation_id, topic in conn.execute(
+                "SELECT conversation_id, topic FROM conversation_topics "
+                "WHERE conversation_id BETWEEN ? AND ? AND profile = ?",
+                (rows[0]["id"], rows[-1]["id"], profile),
+            ):
+                topics.setdefault(conversation_id, []).append(topic)
+            analyses = conn.execute(
+                "SELECT conversation_id, study_citation, cue_score, analyzed_at "
+                "FROM conversation_analysis "
+                "WHERE conversation_id BETWEEN ? AND ? AND profile = ?",
+                (rows[0]["id"], rows[-1]["id"], profile),
+            ).fetchall()
+        moved += len(rows)
+        after_id = rows[-1]["id"]
+        with db.pooled_connection(target_path) as conn:
+            copy_conversations(conn, profile, rows, topics, offset, analyses)
+            conn.execute(
+                "UPDATE rebalance_progress SET last_id = ?, moved = ? "
+                "WHERE profile = ?",
+                (after_id, moved, profile),
+            )
+
+    if not progress["copied"]:
+        copy_archive_and_stats(profile, source_path, target_path, offset, moved)
+    with db.pooled_connection(source_path) as conn:
+        conn.execute("DELETE FROM conversations WHERE profile = ?", (profile,))
+        conn.execute("DELETE FROM conversation_archive WHERE profile = ?", (profile,))
+        conn.execute(
+            "DELETE FROM conversation_archive_hashes WHERE profile = ?", (profile,)
+        )
+        for table in STATS_TABLES:
+            conn.execute(f"DELETE FROM {table} WHERE profile = ?", (profile,))
+    with db.pooled_connection(target_path) as conn:
+        conn.execute("DELETE FROM rebalance_progress WHERE profile = ?", (profile,))
+    return moved
+
+
+def copy_archive_and_stats(profile, source_path, target_path, offset, moved):
+    """Copia los bloques archivados del perfil y ajusta sus estadísticas en destino.
+
+    Todo va en una transacción que además marca el movimiento como copiado, así que
+    una ejecución interrumpida no lo repite.
+    """
+    with db.pooled_connection(source_path) as conn:
+        summary = conn.execute(
+            "SELECT first_seen, last_seen FROM profile_stats WHERE profile = ?",
+            (profile,),
+        ).fetchone()
+        activity = conn.execute(
+            "SELECT day, message_count FROM profile_activity_stats WHERE profile = ?",
+            (profile,),
+        ).fetchall()
+        blocks = conn.execute(
+            "SELECT profile, first_id, last_id, message_count, oldest, newest, "
+            "payload FROM conversation_archive WHERE profile = ? ORDER BY first_id",
+            (profile,),
+        ).fetchall()
+        archived_hashes = conn.execute(
+            "SELECT content_hash, conversation_id FROM conversation_archive_hashes "
+            "WHERE profile = ?",
+            (profile,),
+        ).fetchall()
+    with db.pooled_connection(target_path) as conn:
+        for block in blocks:
+            rows = db.decode_archive_block(block["payload"])
+            for row in rows:
+                row[0] += offset
+            conn.execute(
+                "INSERT INTO conversation_archive (profile, first_id, last_id, "
+                "message_count, oldest, newest, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    profile,
+                    block["first_id"] + offset,
+                    block["last_id"] + offset,
+                    block["message_count"],
+                    block["oldest"],
+                    block["newest"],
+                    db.encode_archive_block(rows),
+                ),
+            )
+            add_archived_stats(conn, profile, rows)
+        conn.executemany(
+            "INSERT INTO conversation_archive_hashes "
+            "(profile, content_hash, conversation_id) VALUES (?, ?, ?)",
+            [
+                (profile, row["content_hash"], row["conversation_id"] + offset)
+                for row in archived_hashes
+            ],
+        )
+        if blocks:
+            # Los ids archivados quedan reservados para que no se reutilicen
+            last_id = max(block["last_id"] for block in blocks) + offset
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT 'conversations', 0 "
+                "WHERE NOT EXISTS "
+                "(SELECT 1 FROM sqlite_sequence WHERE name = 'conversations')"
+            )
+            conn.execute(
+                "UPDATE sqlite_sequence SET seq = max(seq, ?) "
+                "WHERE name = 'conversations'",
+                (last_id,),
+            )
+
+        # Los triggers del destino apuntaron los mensajes movidos como actividad de hoy
+        conn.execute(
+            "UPDATE profile_activity_stats SET message_count = message_count - ? "
+            "WHERE profile = ? AND day = date('now')",
+            (moved, profile),
+        )
+        conn.executemany(
+            "INSERT INTO profile_activity_stats (profile, day, message_count) "
+            "VALUES (?, ?, ?) ON CONFLICT(profile, day) DO UPDATE SET "
+            "message_count = message_count + excluded.message_count",
+            [(profile, day, count) for day, count in activity],
+        )
+        conn.execute(
+            "DELETE FROM profile_activity_stats "
+            "WHERE profile = ? AND message_count <= 0",
+            (profile,),
+        )
+        if summary is not None and summary["first_seen"]:
+            # Los triggers del destino fecharon el perfil ahora: se restauran las
+            # fechas del origen (con las escrituras detenidas son las vigentes)
+            conn.execute(
+                "UPDATE profile_stats SET first_seen = ?, last_seen = ? "
+                "WHERE profile = ?",
+                (summary["first_seen"], summary["last_seen"], profile),
+            )
+        conn.execute(
+            "UPDATE rebalance_progress SET copied = 1 WHERE profile = ?", (profile,)
+        )
+
+
+def unfinished_moves(num_shards):
+    """Genera ``(perfil, origen, destino)`` de los copiados sin borrar del origen."""
+    for index in range(num_shards):
+        with db.pooled_connection(db.shard_path(index)) as conn:
+            rows = conn.execute(
+                "SELECT profile, source FROM rebalance_progress WHERE copied = 1"
+            ).fetchall()
+        for profile, source in rows:
+            yield profile, source, index
+
+
+def rebalance(num_shards=None, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+    """Mueve todos los perfiles mal ubicados; genera ``(perfil, origen, destino, n)``.
+
+    Debe ejecutarse con las escrituras detenidas: un mensaje insertado durante el
+    movimiento de su perfil podría quedarse en el shard de origen. Si se
+    interrumpe, se relanza con el mismo número de shards y termina lo pendiente.
+    """
+    num_shards = num_shards or db.DB_SHARDS
+    if not dry_run:
+        for index in range(num_shards):
+            ensure_shard_schema(index)
+        for profile, source, target in list(unfinished_moves(num_shards)):
+            move_profile(profile, source, target)
+    for profile, source, target in list(plan_moves(num_shards)):
+        moved = 0 if dry_run else move_profile(profile, source, target, batch_size)
+        yield profile, source, target, moved
+
+
+def main(argv=None):
+    """Punto de entrada de la línea de comandos."""
+    parser = argparse.ArgumentParser(
+        description="Redistribuye los perfiles entre los shards de SQLite."
+    )
+    parser.add_argument("--shards", type=int, default=db.DB_SHARDS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+    profiles = total = 0
+    for profile, source, target, moved in rebalance(
+        args.shards, args.batch_size, args.dry_run
+    ):
+        profiles += 1
+        total += moved
+        print(f"{profile}: shard {source} -> {target} ({moved} mensajes)")
+    action = "a mover" if args.dry_run else "movidos"
+    print(f"Rebalanceo completado: {profiles} perfiles {action}, {total} mensajes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,45 +3,248 @@ Rutas y lógica de negocio para la gestión de conversaciones y la integración
 Incluye validación, inserción, consulta y justificación científica automática.
 """
 
-from flask import Blueprint, request, jsonify
-from marshmallow import Schema, fields, ValidationError
-from db import fetch_conversations, insert_conversation
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from storage import (
+    fetch_conversations,
+    fetch_conversations_version,
+    has_archived_conversations,
+    insert_conversation,
+    iter_conversations,
+    search_conversations,
+)
 import os
+import base64
+import binascii
+import queue
+import re
 import openai
 from unittest.mock import patch
 import json
 from lie_detection_studies import get_study_citation_by_topic
 from advice_script import get_advice_script
-import unicodedata
+from topic_detection import canonical_topic, detect_topics, normalize
+from schemas import ConversationSchema, conversation_schema  # noqa: F401
+from bulk_import import DEFAULT_BATCH_SIZE, PARSERS, import_stream
+from validation import (
+    MAX_CONVERSATION_BODY_BYTES,
+    MAX_SCORE_BODY_BYTES,
+    validate_conversation,
+    validate_score_request,
+)
+from dedup import analyze_message, content_index
+from deception_cues import FEATURE_NAMES, score_messages
+from profile_state import profile_states
+from write_behind import WRITE_BEHIND_ENABLED, write_behind_queue
+from completion_cache import completion_cache, make_cache_key
+from openai_proxy import (
+    OPENAI_MAX_TOKENS,
+    OPENAI_MODEL,
+    UpstreamBusyError,
+    UpstreamTimeoutError,
+    complete,
+    stream_completion,
+)
+from http_cache import cached, make_etag, not_modified, parse_sqlite_datetime
+from rate_limit import rate_limit
+from streaming import encode_stream, negotiate_encoding
 
 conversations_bp = Blueprint("conversations", __name__)
 
+# Las páginas de conversaciones se revalidan siempre; el guion de consejos es fijo
+CONVERSATIONS_CACHE_CONTROL = "private, no-cache"
+ADVICE_MAX_AGE = int(os.environ.get("ADVICE_MAX_AGE", "3600"))
+ADVICE_BODY = json.dumps({"advice": get_advice_script()}, ensure_ascii=False)
+ADVICE_ETAG = make_etag(ADVICE_BODY)
 
-class ConversationSchema(Schema):
-    profile = fields.Str(required=True)
-    message = fields.Str(required=True)
 
+def encode_cursor(last_id):
+    """Codifica el último id de una página como cursor opaco."""
+    return base64.urlsafe_b64encode(str(last_id).encode("ascii")).decode("ascii")
 
-conversation_schema = ConversationSchema()
+
+def decode_cursor(cursor):
+    """Decodifica un cursor opaco; lanza ValueError si no es válido."""
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii"))
+    except (binascii.Error, UnicodeError) as err:
+        raise ValueError("Cursor inválido") from err
+
+
+def _json_page_chunks(first, rows, limit):
+    """Fragmentos del mismo cuerpo JSON que la respuesta normal, fila a fila."""
+    yield '{"data": [' + json.dumps(first)
+    last, count = first, 1
+    for row in rows:
+        yield ", " + json.dumps(row)
+        last, count = row, count + 1
+    next_cursor = encode_cursor(last["id"]) if count == limit else None
+    yield '], "next_cursor": %s, "status": "success"}' % json.dumps(next_cursor)
+
+
+def _ndjson_chunks(first, rows):
+    """Una conversación JSON por línea."""
+    yield json.dumps(first) + "\n"
+    for row in rows:
+        yield json.dumps(row) + "\n"
 
 
 @conversations_bp.route("/api/conversations", methods=["GET"])
 def get_conversations():
-    """Obtiene conversaciones para un perfil dado, con paginación."""
+    """Obtiene conversaciones para un perfil dado, con paginación por offset o cursor.
+
+    Con ``stream=true`` o ``format=ndjson`` la página se serializa fila a fila
+    mientras se lee de la base de datos, comprimida con gzip o brotli si el cliente
+    lo acepta, así que la memoria no depende de ``limit``.
+    """
     try:
         profile = request.args.get("profile", "default")
+        limited = rate_limit("read", profile)
+        if limited is not None:
+            return limited
+        fmt = request.args.get("format", "json")
+        if fmt not in ("json", "ndjson"):
+            return jsonify({"error": "Formato no soportado"}), 400
+        streamed = fmt == "ndjson" or request.args.get("stream", "").lower() in (
+            "1",
+            "true",
+        )
         try:
             limit = int(request.args.get("limit", 20))
             offset = int(request.args.get("offset", 0))
+            after_id = request.args.get("after_id")
+            cursor = request.args.get("cursor")
+            if cursor is not None:
+                after_id = decode_cursor(cursor)
+            elif after_id is not None:
+                after_id = int(after_id)
         except ValueError:
             return jsonify({"error": "Parámetros de paginación inválidos"}), 400
-        conversations = fetch_conversations(profile, limit, offset)
+        topic = request.args.get("topic")
+        if topic is not None:
+            topic = canonical_topic(topic)
+            if topic is None:
+                return jsonify({"error": "Tema desconocido"}), 400
+        # La versión se obtiene con índices y tablas de resumen; si el cliente ya
+        # tiene esta página se responde 304 sin leer las conversaciones
+        version = fetch_conversations_version(profile, topic)
+        # Cada representación (formato y compresión) tiene su propio ETag
+        representation = "json"
+        if streamed:
+            encoding = negotiate_encoding(request.accept_encodings)
+            representation = f"{fmt}-stream-{encoding}"
+        etag = make_etag(
+            profile,
+            limit,
+            offset,
+            after_id,
+            topic,
+            version["max_id"],
+            version["message_count"],
+            version["topic_count"],
+            version["analyzed_at"],
+            representation,
+        )
+        last_modified = parse_sqlite_datetime(version["last_seen"])
+        response = not_modified(etag, last_modified, CONVERSATIONS_CACHE_CONTROL)
+        if response is not None:
+            return response
+        if streamed:
+            rows = iter_conversations(profile, limit, offset, after_id, topic)
+            first = next(rows, None)
+            if first is None:
+                return jsonify({"message": "No conversations found"}), 404
+            if fmt == "ndjson":
+                chunks = _ndjson_chunks(first, rows)
+                mimetype = "application/x-ndjson"
+            else:
+                chunks = _json_page_chunks(first, rows, limit)
+                mimetype = "application/json"
+            response = Response(encode_stream(chunks, encoding), mimetype=mimetype)
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+            response.headers["Vary"] = "Accept-Encoding"
+            return cached(response, etag, last_modified, CONVERSATIONS_CACHE_CONTROL)
+        conversations = fetch_conversations(profile, limit, offset, after_id, topic)
         if conversations:
+            next_cursor = None
+            if len(conversations) == limit:
+                next_cursor = encode_cursor(conversations[-1]["id"])
+            return cached(
+                jsonify(
+                    {
+                        "data": conversations,
+                        "next_cursor": next_cursor,
+                        "status": "success",
+                    }
+                ),
+                etag,
+                last_modified,
+                CONVERSATIONS_CACHE_CONTROL,
+            )
+        return jsonify({"message": "No conversations found"}), 404
+    except Exception as e:
+        return (
+            jsonify({"error": f"Internal Server Error: {str(e)}"}),
+            500,
+        )
+
+
+def build_search_query(text):
+    """Convierte texto libre en una expresión MATCH de FTS5 (todos los términos).
+
+    Los términos se normalizan igual que en la detección de temas y se citan,
+    así que la sintaxis de FTS5 que escriba el usuario no tiene efecto.
+    """
+    terms = re.findall(r"\w+", normalize(text))
+    return " ".join(f'"{term}"' for term in terms)
+
+
+@conversations_bp.route("/api/conversations/search", methods=["GET"])
+def search_conversations_route():
+    """Búsqueda de texto completo en los mensajes.
+
+    Los resultados se ordenan por relevancia, se paginan y resaltan los términos.
+    Los mensajes archivados no se buscan; ``archived_excluded`` indica si el perfil
+    (o, sin perfil, alguno) tiene mensajes archivados que podrían faltar.
+    """
+    try:
+        match = build_search_query(request.args.get("q", ""))
+        if not match:
+            return jsonify({"error": "Falta el parámetro de búsqueda 'q'"}), 400
+        profile = request.args.get("profile")
+        limited = rate_limit("read", profile)
+        if limited is not None:
+            return limited
+        try:
+            limit = int(request.args.get("limit", 20))
+            offset = int(request.args.get("offset", 0))
+        except ValueError:
+            return jsonify({"error": "Parámetros de paginación inválidos"}), 400
+        results = search_conversations(match, profile, limit, offset)
+        archived_excluded = has_archived_conversations(profile)
+        if results:
+            next_offset = offset + limit if len(results) == limit else None
             return (
-                jsonify({"data": conversations, "status": "success"}),
+                jsonify(
+                    {
+                        "data": results,
+                        "next_offset": next_offset,
+                        "archived_excluded": archived_excluded,
+                        "status": "success",
+                    }
+                ),
                 200,
             )
-        return jsonify({"message": "No conversations found"}), 404
+        return (
+            jsonify(
+                {
+                    "message": "No conversations found",
+                    "archived_excluded": archived_excluded,
+                }
+            ),
+            404,
+        )
     except Exception as e:
         return (
             jsonify({"error": f"Internal Server Error: {str(e)}"}),
@@ -51,49 +254,99 @@ def get_conversations():
 
 @conversations_bp.route("/api/conversations", methods=["POST"])
 def post_conversations():
-    """Crea una nueva conversación y cita estudios científicos si corresponde."""
+    """Crea una nueva conversación y cita estudios científicos si corresponde.
+
+    Los cuerpos mayores que ``MAX_CONVERSATION_BODY_BYTES`` se rechazan con 413
+    antes de leerlos o de parsear el JSON. Si el perfil ya tiene un mensaje con el
+    mismo contenido no se guarda otra copia y la respuesta lo indica con
+    ``duplicate``; el análisis de un contenido ya visto se reutiliza.
+    """
+    if (request.content_length or 0) > MAX_CONVERSATION_BODY_BYTES:
+        return jsonify({"error": "Cuerpo de la petición demasiado grande"}), 413
+    # Limita también los cuerpos sin Content-Length (transferencia por bloques)
+    request.max_content_length = MAX_CONVERSATION_BODY_BYTES
+    try:
+        try:
+            data = request.get_json(silent=True)
+        except RequestEntityTooLarge:
+            return jsonify({"error": "Cuerpo de la petición demasiado grande"}), 413
+        errors = validate_conversation(data)
+        if errors:
+            return jsonify({"error": errors}), 400
+        profile = data["profile"]
+        message = data["message"]
+        limited = rate_limit("write", profile)
+        if limited is not None:
+            return limited
+        digest, analysis = analyze_message(message)
+        topics = analysis["topics"]
+        # Los mensajes repetidos del perfil (reenvíos) no se vuelven a guardar
+        duplicate = content_index.find(profile, digest) is not None
+        conversation_id = None  # desconocido con inserción diferida
+        if not duplicate:
+            if WRITE_BEHIND_ENABLED:
+                try:
+                    write_behind_queue.put(profile, message, topics)
+                except queue.Full:
+                    return (
+                        jsonify(
+                            {"error": "Cola de escritura llena, reintenta más tarde"}
+                        ),
+                        503,
+                        {"Retry-After": "1"},
+                    )
+            else:
+                conversation_id = insert_conversation(profile, message, topics)
+                duplicate = conversation_id is None
+            content_index.add(profile, digest)
+        if duplicate:
+            state = profile_states.get(profile)
+        else:
+            state = profile_states.record(
+                profile,
+                topics,
+                analysis["score"],
+                cues=analysis["cues"],
+                conversation_id=conversation_id,
+            )
+        body = {
+            "message": "Conversation created",
+            "duplicate": duplicate,
+            "profile_state": state,
+        }
+        if analysis["study_citation"]:
+            body.update(
+                study_citation=analysis["study_citation"],
+                study_summary=analysis["study_summary"],
+                advice=get_advice_script(),
+            )
+        return jsonify(body), 201
+    except Exception as e:
+        return (
+            jsonify({"error": f"Internal Server Error: {str(e)}"}),
+            500,
+        )
+
+
+@conversations_bp.route("/api/conversations/score", methods=["POST"])
+def score_conversations():
+    """Puntúa indicios textuales de engaño de un lote de mensajes sin guardarlos."""
+    if (request.content_length or 0) > MAX_SCORE_BODY_BYTES:
+        return jsonify({"error": "Cuerpo de la petición demasiado grande"}), 413
+    request.max_content_length = MAX_SCORE_BODY_BYTES
+    limited = rate_limit("read")
+    if limited is not None:
+        return limited
     try:
-        data = request.get_json()
         try:
-            validated = conversation_schema.load(data)
-            if not isinstance(validated, dict):
-                raise ValidationError("Datos no válidos")
-        except ValidationError as err:
-            return jsonify({"error": err.messages}), 400
-        profile = validated.get("profile")
-        message = validated.get("message")
-        if not isinstance(profile, str) or not isinstance(message, str):
-            return jsonify({"error": "Los campos deben ser cadenas de texto."}), 400
-        insert_conversation(profile, message)
-        # Normalizar mensaje para comparación robusta (sin tildes, minúsculas)
-        def normalize(text):
-            return unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode('utf-8').lower()
-        normalized_message = normalize(message)
-        keywords = [
-            ("microexpresión", ["microexpresion", "microexpresión"]),
-            ("carga cognitiva", ["cognitivo", "carga cognitiva"]),
-            ("fMRI", ["resonancia", "fmri", "f m r i"]),
-            ("verbal", ["paraverbal", "verbal", "verbales", "verbalidad"]),
-            ("SCAN", ["scan"]),
-            ("IA", ["inteligencia artificial", "ia"]),
-            ("emoción", ["emocional", "emoción"]),
-        ]
-        import re
-        for topic, keyword_list in keywords:
-            for k in keyword_list:
-                k_norm = normalize(k)
-                # Coincidencia robusta: palabra completa o subcadena aislada usando regex (palabra o entre signos)
-                pattern = r"(^|\W)" + re.escape(k_norm) + r"(es|idad|al|ales)?($|\W)"
-                if re.search(pattern, normalized_message):
-                    cita, resumen = get_study_citation_by_topic(topic)
-                    if cita:
-                        return jsonify({
-                            "message": "Conversation created",
-                            "study_citation": cita,
-                            "study_summary": resumen,
-                            "advice": get_advice_script()
-                        }), 201
-        return jsonify({"message": "Conversation created"}), 201
+            data = request.get_json(silent=True)
+        except RequestEntityTooLarge:
+            return jsonify({"error": "Cuerpo de la petición demasiado grande"}), 413
+        errors = validate_score_request(data)
+        if errors:
+            return jsonify({"error": errors}), 400
+        results = score_messages(data["messages"])
+        return jsonify({"features": list(FEATURE_NAMES), "results": results}), 200
     except Exception as e:
         return (
             jsonify({"error": f"Internal Server Error: {str(e)}"}),
@@ -101,6 +354,120 @@ def post_conversations():
         )
 
 
+@conversations_bp.route("/api/conversations/bulk", methods=["POST"])
+def post_conversations_bulk():
+    """Importa en bloque una exportación de WhatsApp (.txt) o un stream NDJSON.
+
+    Si un lote falla se responde 500 con el resumen de los lotes ya guardados y el
+    número del lote fallido (``failed_batch``).
+    """
+    fmt = request.args.get("format")
+    if fmt is None:
+        is_ndjson = request.mimetype in ("application/x-ndjson", "application/jsonl")
+        fmt = "ndjson" if is_ndjson else "whatsapp"
+    if fmt not in PARSERS:
+        return jsonify({"error": f"Formato no soportado: {fmt}"}), 400
+    try:
+        batch_size = int(request.args.get("batch_size", DEFAULT_BATCH_SIZE))
+        if batch_size < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "Parámetro batch_size inválido"}), 400
+    profile = request.args.get("profile")
+    limited = rate_limit("bulk", profile)
+    if limited is not None:
+        return limited
+    upload = request.files.get("file")
+    stream = upload.stream if upload is not None else request.stream
+    batches = []
+    try:
+        for batch in import_stream(stream, fmt, profile, batch_size):
+            batches.append(batch)
+    except Exception as e:
+        # Los lotes anteriores ya están guardados: se informa de ellos y del lote
+        # que falló para poder reanudar la importación desde ahí
+        return (
+            jsonify(
+                {
+                    "status": "error",
+                    "error": f"Internal Server Error: {str(e)}",
+                    "failed_batch": len(batches) + 1,
+                    **_bulk_summary(batches),
+                }
+            ),
+            500,
+        )
+    finally:
+        # Sin perfil fijo no se sabe qué perfiles cambiaron: se descartan todos
+        profile_states.invalidate(profile)
+    return jsonify({"status": "success", **_bulk_summary(batches)}), 201
+
+
+def _bulk_summary(batches):
+    """Totales de una importación masiva a partir de los resúmenes de sus lotes."""
+    return {
+        "inserted": sum(b["inserted"] for b in batches),
+        "duplicates": sum(b["duplicates"] for b in batches),
+        "rejected": sum(len(b["errors"]) for b in batches),
+        "batches": batches,
+    }
+
+
+def _study_fields(prompt):
+    """Campos de cita científica y consejos si el prompt contiene palabras clave."""
+    topics = detect_topics(prompt)
+    if topics:
+        cita, resumen = get_study_citation_by_topic(topics[0])
+        if cita and resumen:
+            return {
+                "study_citation": str(cita),
+                "study_summary": str(resumen),
+                # Solución: advice como string, no lista
+                "advice": "\n".join(get_advice_script()),
+            }
+    return {}
+
+
+def _sse(data, event=None):
+    """Formatea un evento server-sent events."""
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+
+def _stream_openai_chat(prompt):
+    """Respuesta SSE que reenvía los fragmentos de OpenAI a medida que llegan."""
+    cache_key = make_cache_key(prompt, OPENAI_MODEL, max_tokens=OPENAI_MAX_TOKENS)
+    hit = completion_cache.get(cache_key)
+    stream = None
+    if hit is None:
+        stream = stream_completion(prompt, OPENAI_MODEL, OPENAI_MAX_TOKENS)
+
+    def generate():
+        if stream is None:
+            answer = hit
+            yield _sse({"token": answer})
+        else:
+            tokens = []
+            try:
+                for token in stream:
+                    tokens.append(token)
+                    yield _sse({"token": token})
+            except Exception as e:
+                yield _sse({"error": str(e)}, event="error")
+                return
+            answer = "".join(tokens).strip()
+            completion_cache.set(cache_key, answer)
+        yield _sse({"response": answer, **_study_fields(prompt)}, event="done")
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    if stream is not None:
+        response.call_on_close(stream.close)
+    return response
+
+
 @conversations_bp.route("/api/openai", methods=["POST"])
 def openai_chat():
     """Endpoint para interactuar con OpenAI GPT usando un prompt enviado por el usuario. Si el prompt contiene palabras clave de manipulación, devuelve también cita científica y consejos."""
@@ -108,60 +475,35 @@ def openai_chat():
     prompt = data.get("prompt")
     if not prompt:
         return jsonify({"error": "Falta el campo 'prompt'"}), 400
+    limited = rate_limit("openai", data.get("profile"))
+    if limited is not None:
+        return limited
     openai.api_key = os.environ.get("OPENAI_API_KEY")
-    # Permitir mock para pruebas locales
-    if os.environ.get("MOCK_OPENAI", "0") == "1":
-        answer = "París"
-        response_json = {"response": answer}
-    else:
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=100,
-            )
-            import json
-            try:
-                response_dict = json.loads(response.__str__())
-            except Exception:
-                response_dict = response if isinstance(response, dict) else {}
-            answer = response_dict.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-            response_json = {"response": answer}
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
+    try:
+        if data.get("stream"):
+            return _stream_openai_chat(prompt)
+        answer = completion_cache.get_or_compute(
+            prompt,
+            OPENAI_MODEL,
+            lambda: complete(prompt, OPENAI_MODEL, OPENAI_MAX_TOKENS),
+            max_tokens=OPENAI_MAX_TOKENS,
+        )
+    except UpstreamBusyError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+    except (UpstreamTimeoutError, openai.error.Timeout):
+        return jsonify({"error": "Tiempo de espera agotado con OpenAI"}), 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
     # --- INTEGRACIÓN DE DETECCIÓN DE PALABRAS CLAVE ---
-    import unicodedata, re
-    def normalize(text):
-        return unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode('utf-8').lower()
-    normalized_prompt = normalize(prompt)
-    keywords = [
-        ("microexpresión", ["microexpresion", "microexpresión"]),
-        ("carga cognitiva", ["cognitivo", "carga cognitiva"]),
-        ("fMRI", ["resonancia", "fmri", "f m r i"]),
-        ("verbal", ["paraverbal", "verbal", "verbales", "verbalidad"]),
-        ("SCAN", ["scan"]),
-        ("IA", ["inteligencia artificial", "ia"]),
-        ("emoción", ["emocional", "emoción"]),
-    ]
-    for topic, keyword_list in keywords:
-        for k in keyword_list:
-            k_norm = normalize(k)
-            pattern = r"(^|\W)" + re.escape(k_norm) + r"(es|idad|al|ales)?($|\W)"
-            if re.search(pattern, normalized_prompt):
-                cita, resumen = get_study_citation_by_topic(topic)
-                if cita and resumen:
-                    response_json["study_citation"] = str(cita)
-                    response_json["study_summary"] = str(resumen)
-                    # Solución: advice como string, no lista
-                    response_json["advice"] = "\n".join(get_advice_script())
-                break
-        else:
-            continue
-        break
-    return jsonify(response_json)
+    return jsonify({"response": answer, **_study_fields(prompt)})
 
 
 @conversations_bp.route("/api/advice", methods=["GET"])
 def get_advice():
     """Devuelve un guion de consejos para víctimas de mentiras o manipulación."""
-    return jsonify({"advice": get_advice_script()})
+    cache_control = f"public, max-age={ADVICE_MAX_AGE}"
+    response = not_modified(ADVICE_ETAG, cache_control=cache_control)
+    if response is not None:
+        return response
+    response = Response(ADVICE_BODY, mimetype="application/json")
+    return cached(response, ADVICE_ETAG, cache_control=cache_control)
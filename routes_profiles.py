@@ -0,0 +1,83 @@
+"""
+Rutas de consulta agregada por perfil.
+"""
+
+from flask import Blueprint, jsonify, request
+from profile_state import profile_states
+from storage import count_topics, fetch_profile_stats
+from rate_limit import rate_limit
+
+profiles_bp = Blueprint("profiles", __name__)
+
+
+@profiles_bp.route("/api/profiles/<profile>/topics", methods=["GET"])
+def get_profile_topics(profile):
+    """Devuelve cuántos mensajes del perfil tocan cada tema."""
+    limited = rate_limit("read", profile)
+    if limited is not None:
+        return limited
+    try:
+        return jsonify({"profile": profile, "topics": count_topics(profile)}), 200
+    except Exception as e:
+        return (
+            jsonify({"error": f"Internal Server Error: {str(e)}"}),
+            500,
+        )
+
+
+@profiles_bp.route("/api/profiles/<profile>/stats", methods=["GET"])
+def get_profile_stats(profile):
+    """Devuelve estadísticas agregadas del perfil desde las tablas de resumen."""
+    limited = rate_limit("read", profile)
+    if limited is not None:
+        return limited
+    try:
+        try:
+            days = int(request.args.get("days", 30))
+        except ValueError:
+            return jsonify({"error": "Parámetro days inválido"}), 400
+        stats = fetch_profile_stats(profile, days)
+        if stats is None:
+            return jsonify({"message": "No conversations found"}), 404
+        return jsonify(stats), 200
+    except Exception as e:
+        return (
+            jsonify({"error": f"Internal Server Error: {str(e)}"}),
+            500,
+        )
+
+
+@profiles_bp.route("/api/profiles/<profile>/cues", methods=["GET"])
+def get_profile_cues(profile):
+    """Media de los indicios de engaño de todos los mensajes del perfil."""
+    limited = rate_limit("read", profile)
+    if limited is not None:
+        return limited
+    try:
+        summary = profile_states.cues(profile)
+        if summary is None:
+            return jsonify({"message": "No conversations found"}), 404
+        return jsonify(summary), 200
+    except Exception as e:
+        return (
+            jsonify({"error": f"Internal Server Error: {str(e)}"}),
+            500,
+        )
+
+
+@profiles_bp.route("/api/profiles/<profile>/state", methods=["GET"])
+def get_profile_state(profile):
+    """Estado acumulado del perfil (temas, indicios recientes, ritmo y alertas)."""
+    limited = rate_limit("read", profile)
+    if limited is not None:
+        return limited
+    try:
+        state = profile_states.get(profile)
+        if state is None:
+            return jsonify({"message": "No conversations found"}), 404
+        return jsonify({"profile": profile, **state}), 200
+    except Exception as e:
+        return (
+            jsonify({"error": f"Internal Server Error: {str(e)}"}),
+            500,
+        )
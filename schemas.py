@@ -0,0 +1,13 @@
+"""
+Esquemas de validación (marshmallow) compartidos por las rutas y los importadores.
+"""
+
+from marshmallow import Schema, fields
+
+
+class ConversationSchema(Schema):
+    profile = fields.Str(required=True)
+    message = fields.Str(required=True)
+
+
+conversation_schema = ConversationSchema()
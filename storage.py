@@ -0,0 +1,104 @@
+"""
+Capa de almacenamiento intercambiable para las conversaciones.
+El backend se elige con STORAGE_BACKEND: ``sqlite`` (db.py, con shards) o
+``postgres`` (storage_postgres.py, para varios nodos que comparten la base de datos).
+"""
+
+import os
+
+import db
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+
+# Operaciones que debe implementar cada backend, con la firma de las de db.py
+OPERATIONS = (
+    "fetch_conversations",
+    "iter_conversations",
+    "fetch_recent_conversations",
+    "fetch_conversations_version",
+    "search_conversations",
+    "has_archived_conversations",
+    "insert_conversation",
+    "insert_conversations",
+    "fetch_duplicate_id",
+    "iter_content_hashes",
+    "annotate_topics",
+    "save_analysis",
+    "fetch_conversation_batch",
+    "count_topics",
+    "fetch_profile_stats",
+)
+
+
+class SQLiteStorage:
+    """Backend SQLite: delega en las funciones de ``db``."""
+
+    name = "sqlite"
+
+    def __getattr__(self, name):
+        # Se resuelve en cada llamada para respetar los cambios en db (p. ej. tests)
+        if name in OPERATIONS:
+            return getattr(db, name)
+        raise AttributeError(name)
+
+    def setup_schema(self, reset=False):
+        """Crea el esquema en todos los shards (``reset`` lo vacía antes)."""
+        from initialize_db import setup_sqlite_schema
+
+        setup_sqlite_schema(reset)
+
+    def close(self):
+        """Cierra las conexiones del pool."""
+        db.close_db_connections()
+
+
+def create_storage(name=STORAGE_BACKEND):
+    """Crea el backend de almacenamiento ``name``."""
+    if name == "sqlite":
+        return SQLiteStorage()
+    if name == "postgres":
+        from storage_postgres import PostgresStorage
+
+        return PostgresStorage()
+    raise ValueError(f"Backend de almacenamiento desconocido: {name}")
+
+
+backend = create_storage()
+
+
+def _delegate(name):
+    """Función de módulo que llama a la operación ``name`` del backend activo."""
+
+    def operation(*args, **kwargs):
+        return getattr(backend, name)(*args, **kwargs)
+
+    operation.__name__ = name
+    operation.__doc__ = getattr(db, name).__doc__
+    return operation
+
+
+fetch_conversations = _delegate("fetch_conversations")
+iter_conversations = _delegate("iter_conversations")
+fetch_recent_conversations = _delegate("fetch_recent_conversations")
+fetch_conversations_version = _delegate("fetch_conversations_version")
+search_conversations = _delegate("search_conversations")
+has_archived_conversations = _delegate("has_archived_conversations")
+insert_conversation = _delegate("insert_conversation")
+insert_conversations = _delegate("insert_conversations")
+fetch_duplicate_id = _delegate("fetch_duplicate_id")
+iter_content_hashes = _delegate("iter_content_hashes")
+annotate_topics = _delegate("annotate_topics")
+save_analysis = _delegate("save_analysis")
+fetch_conversation_batch = _delegate("fetch_conversation_batch")
+count_topics = _delegate("count_topics")
+fetch_profile_stats = _delegate("fetch_profile_stats")
+
+
+def setup_schema(reset=False):
+    """Crea el esquema del backend activo; con ``reset`` borra los datos."""
+    backend.setup_schema(reset)
+
+
+def close_storage():
+    """Libera las conexiones del backend activo (p. ej. al apagar la app)."""
+    backend.close()
@@ -0,0 +1,586 @@
+"""
+Backend de almacenamiento PostgreSQL con pool de conexiones (psycopg2).
+Mismo esquema y mismas operaciones que db.py, para varios nodos tras un balanceador.
+"""
+
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from db import (
+    DB_FETCH_CHUNK,
+    LENGTH_BUCKETS,
+    bucket_label,
+    content_hash,
+    length_bucket_sql,
+)
+from metrics import db_query_duration, timed_query
+from topic_detection import detect_topics, normalize
+
+try:
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:  # psycopg2 es opcional: solo con STORAGE_BACKEND=postgres
+    psycopg2 = None
+
+POSTGRES_DSN = os.environ.get("POSTGRES_DSN", "dbname=trueliebot")
+POSTGRES_POOL_MIN = int(os.environ.get("POSTGRES_POOL_MIN", "1"))
+POSTGRES_POOL_MAX = int(os.environ.get("POSTGRES_POOL_MAX", "10"))
+
+# Mismo formato que datetime('now') de SQLite, en UTC
+_NOW = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+_TODAY = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD')"
+# Mismo valor que db.content_hash (16 primeros bytes de SHA-256 en hexadecimal)
+_CONTENT_HASH = "left(encode(sha256(convert_to(message, 'UTF8')), 'hex'), 32)"
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id BIGSERIAL PRIMARY KEY,
+        profile TEXT NOT NULL,
+        message TEXT NOT NULL,
+        search TSVECTOR NOT NULL
+    )
+    """,
+    # Migración no destructiva: las filas anteriores a la columna toman la fecha actual
+    f"ALTER TABLE conversations ADD COLUMN IF NOT EXISTS created_at TEXT NOT NULL "
+    f"DEFAULT {_NOW}",
+    "CREATE INDEX IF NOT EXISTS idx_profile_id ON conversations (profile, id)",
+    "CREATE INDEX IF NOT EXISTS idx_conversations_created_at "
+    "ON conversations (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_conversations_search "
+    "ON conversations USING GIN (search)",
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    # Hash de las filas anteriores a la columna: solo la primera de cada mensaje
+    # repetido en un perfil lo recibe, las copias se conservan con NULL
+    f"""
+    UPDATE conversations c SET content_hash = f.content_hash
+    FROM (
+        SELECT DISTINCT ON (profile, {_CONTENT_HASH})
+            id, {_CONTENT_HASH} AS content_hash
+        FROM conversations WHERE content_hash IS NULL
+        ORDER BY profile, {_CONTENT_HASH}, id
+    ) f
+    WHERE c.id = f.id AND NOT EXISTS (
+        SELECT 1 FROM conversations d
+        WHERE d.profile = c.profile AND d.content_hash = f.content_hash
+    )
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_conversations_profile_hash "
+    "ON conversations (profile, content_hash)",
+    """
+    CREATE TABLE IF NOT EXISTS conversation_topics (
+        conversation_id BIGINT NOT NULL
+            REFERENCES conversations (id) ON DELETE CASCADE,
+        profile TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        PRIMARY KEY (conversation_id, topic)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_topics_profile_topic "
+    "ON conversation_topics (profile, topic, conversation_id)",
+    """
+    CREATE TABLE IF NOT EXISTS conversation_analysis (
+        conversation_id BIGINT PRIMARY KEY
+            REFERENCES conversations (id) ON DELETE CASCADE,
+        profile TEXT NOT NULL,
+        study_citation TEXT,
+        cue_score DOUBLE PRECISION NOT NULL,
+        analyzed_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_analysis_profile_analyzed "
+    "ON conversation_analysis (profile, analyzed_at)",
+    """
+    CREATE TABLE IF NOT EXISTS profile_stats (
+        profile TEXT PRIMARY KEY,
+        message_count BIGINT NOT NULL DEFAULT 0,
+        total_length BIGINT NOT NULL DEFAULT 0,
+        first_seen TEXT,
+        last_seen TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS profile_length_stats (
+        profile TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        message_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (profile, bucket)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS profile_activity_stats (
+        profile TEXT NOT NULL,
+        day TEXT NOT NULL,
+        message_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (profile, day)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS profile_topic_stats (
+        profile TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        message_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (profile, topic)
+    )
+    """,
+    # Las tablas de resumen se mantienen con triggers, igual que en SQLite
+    f"""
+    CREATE OR REPLACE FUNCTION trueliebot_profile_stats_ai() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO profile_stats AS s
+            (profile, message_count, total_length, first_seen, last_seen)
+        VALUES (NEW.profile, 1, length(NEW.message), {_NOW}, {_NOW})
+        ON CONFLICT (profile) DO UPDATE SET
+            message_count = s.message_count + 1,
+            total_length = s.total_length + excluded.total_length,
+            last_seen = excluded.last_seen;
+        INSERT INTO profile_length_stats AS s (profile, bucket, message_count)
+        VALUES (NEW.profile, {length_bucket_sql("NEW.message")}, 1)
+        ON CONFLICT (profile, bucket) DO UPDATE SET
+            message_count = s.message_count + 1;
+        INSERT INTO profile_activity_stats AS s (profile, day, message_count)
+        VALUES (NEW.profile, {_TODAY}, 1)
+        ON CONFLICT (profile, day) DO UPDATE SET
+            message_count = s.message_count + 1;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION trueliebot_profile_stats_ad() RETURNS trigger AS $$
+    BEGIN
+        UPDATE profile_stats SET
+            message_count = message_count - 1,
+            total_length = total_length - length(OLD.message)
+        WHERE profile = OLD.profile;
+        UPDATE profile_length_stats SET message_count = message_count - 1
+        WHERE profile = OLD.profile
+            AND bucket = {length_bucket_sql("OLD.message")};
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION trueliebot_topic_stats_ai() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO profile_topic_stats AS s (profile, topic, message_count)
+        VALUES (NEW.profile, NEW.topic, 1)
+        ON CONFLICT (profile, topic) DO UPDATE SET
+            message_count = s.message_count + 1;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION trueliebot_topic_stats_ad() RETURNS trigger AS $$
+    BEGIN
+        UPDATE profile_topic_stats SET message_count = message_count - 1
+        WHERE profile = OLD.profile AND topic = OLD.topic;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS profile_stats_ai ON conversations",
+    "CREATE TRIGGER profile_stats_ai AFTER INSERT ON conversations "
+    "FOR EACH ROW EXECUTE FUNCTION trueliebot_profile_stats_ai()",
+    "DROP TRIGGER IF EXISTS profile_stats_ad ON conversations",
+    "CREATE TRIGGER profile_stats_ad AFTER DELETE ON conversations "
+    "FOR EACH ROW EXECUTE FUNCTION trueliebot_profile_stats_ad()",
+    "DROP TRIGGER IF EXISTS profile_topic_stats_ai ON conversation_topics",
+    "CREATE TRIGGER profile_topic_stats_ai AFTER INSERT ON conversation_topics "
+    "FOR EACH ROW EXECUTE FUNCTION trueliebot_topic_stats_ai()",
+    "DROP TRIGGER IF EXISTS profile_topic_stats_ad ON conversation_topics",
+    "CREATE TRIGGER profile_topic_stats_ad AFTER DELETE ON conversation_topics "
+    "FOR EACH ROW EXECUTE FUNCTION trueliebot_topic_stats_ad()",
+]
+
+TABLES = (
+    "conversation_topics",
+    "conversation_analysis",
+    "conversations",
+    "profile_stats",
+    "profile_length_stats",
+    "profile_activity_stats",
+    "profile_topic_stats",
+)
+
+# Columnas públicas de una conversación (la columna de búsqueda es interna)
+_COLUMNS = "c.id, c.profile, c.message, c.created_at"
+# Columnas de las páginas de conversaciones, con el último reanálisis offline
+_PAGE_COLUMNS = f"{_COLUMNS}, a.study_citation, a.cue_score"
+
+
+class PostgresStorage:
+    """Almacenamiento en PostgreSQL con un pool de conexiones compartido por hilos.
+
+    La búsqueda usa un ``tsvector`` del mensaje normalizado con ``normalize`` (sin
+    tildes ni mayúsculas), equivalente al tokenizador de FTS5 en SQLite. El
+    fragmento se resalta sobre el mensaje original, así que las palabras con
+    tilde se encuentran pero no se marcan.
+    """
+
+    name = "postgres"
+
+    def __init__(
+        self, dsn=POSTGRES_DSN, minconn=POSTGRES_POOL_MIN, maxconn=POSTGRES_POOL_MAX
+    ):
+        if psycopg2 is None:
+            raise RuntimeError(
+                "STORAGE_BACKEND=postgres necesita psycopg2 "
+                "(pip install psycopg2-binary)"
+            )
+        self._pool = ThreadedConnectionPool(minconn, maxconn, dsn)
+
+    @contextmanager
+    def _connection(self):
+        """Presta una conexión del pool dentro de una transacción."""
+        conn = self._pool.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._pool.putconn(conn, close=bool(conn.closed))
+
+    @contextmanager
+    def _cursor(self):
+        with self._connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                yield cursor
+
+    def setup_schema(self, reset=False):
+        """Crea tablas, índices y triggers; con ``reset`` borra antes las tablas."""
+        with self._cursor() as cursor:
+            if reset:
+                cursor.execute(f"DROP TABLE IF EXISTS {', '.join(TABLES)} CASCADE")
+            for statement in SCHEMA:
+                cursor.execute(statement)
+
+    def close(self):
+        """Cierra todas las conexiones del pool."""
+        self._pool.closeall()
+
+    @staticmethod
+    def _conversations_query(profile, limit, offset, after_id, topic):
+        if topic is None:
+            sql = (
+                f"SELECT {_PAGE_COLUMNS} FROM conversations c "
+                "LEFT JOIN conversation_analysis a ON a.conversation_id = c.id "
+                "WHERE c.profile = %s"
+            )
+            params: List[Any] = [profile]
+            id_column = "c.id"
+        else:
+            sql = (
+                f"SELECT {_PAGE_COLUMNS} FROM conversation_topics t "
+                "JOIN conversations c ON c.id = t.conversation_id "
+                "LEFT JOIN conversation_analysis a ON a.conversation_id = c.id "
+                "WHERE t.profile = %s AND t.topic = %s"
+            )
+            params = [profile, topic]
+            id_column = "t.conversation_id"
+        if after_id is not None:
+            sql += f" AND {id_column} > %s ORDER BY {id_column} LIMIT %s"
+            params.extend([after_id, limit])
+        else:
+            sql += f" ORDER BY {id_column} LIMIT %s OFFSET %s"
+            params.extend([limit, offset])
+        return sql, params
+
+    @timed_query("fetch_conversations")
+    def fetch_conversations(
+        self,
+        profile: str,
+        limit: int = 20,
+        offset: int = 0,
+        after_id: Optional[int] = None,
+        topic: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        sql, params = self._conversations_query(profile, limit, offset, after_id, topic)
+        with self._cursor() as cursor:
+            cursor.execute(sql, params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def iter_conversations(
+        self,
+        profile: str,
+        limit: int = 20,
+        offset: int = 0,
+        after_id: Optional[int] = None,
+        topic: Optional[str] = None,
+        chunk_size: int = DB_FETCH_CHUNK,
+    ) -> Iterator[Dict[str, Any]]:
+        # Cursor con nombre (del lado del servidor): trae chunk_size filas cada vez
+        sql, params = self._conversations_query(profile, limit, offset, after_id, topic)
+        start = time.perf_counter()
+        with self._connection() as conn:
+            with conn.cursor(
+                name=f"conversations_{uuid.uuid4().hex}", cursor_factory=RealDictCursor
+            ) as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(sql, params)
+                try:
+                    for row in cursor:
+                        yield dict(row)
+                finally:
+                    db_query_duration.observe(
+                        time.perf_counter() - start,
+                        operation="iter_conversations",
+                    )
+
+    @timed_query("fetch_recent_conversations")
+    def fetch_recent_conversations(
+        self, profile: str, limit: int = 20
+    ) -> List[Dict[str, Any]]:
+        with self._cursor() as cursor:
+            cursor.execute(
+                f"SELECT {_COLUMNS} FROM conversations c WHERE c.profile = %s "
+                "ORDER BY c.id DESC LIMIT %s",
+                (profile, limit),
+            )
+            return [dict(row) for row in reversed(cursor.fetchall())]
+
+    @timed_query("fetch_conversations_version")
+    def fetch_conversations_version(
+        self, profile: str, topic: Optional[str] = None
+    ) -> Dict[str, Any]:
+        with self._cursor() as cursor:
+            cursor.execute(
+                "SELECT (SELECT MAX(id) FROM conversations WHERE profile = %s) "
+                "AS max_id, s.message_count, s.last_seen, "
+                "(SELECT message_count FROM profile_topic_stats "
+                "WHERE profile = %s AND topic = %s) AS topic_count, "
+                "(SELECT MAX(analyzed_at) FROM conversation_analysis "
+                "WHERE profile = %s) AS analyzed_at "
+                "FROM (SELECT 1) AS one LEFT JOIN profile_stats s ON s.profile = %s",
+                (profile, profile, topic, profile, profile),
+            )
+            row = cursor.fetchone()
+        return {
+            "max_id": row["max_id"],
+            "message_count": row["message_count"] or 0,
+            "topic_count": row["topic_count"] or 0,
+            "last_seen": row["last_seen"],
+            "analyzed_at": row["analyzed_at"],
+        }
+
+    @timed_query("search_conversations")
+    def search_conversations(
+        self,
+        match: str,
+        profile: Optional[str] = None,
+        limit: int = 20,
+        offset: int = 0,
+    ) -> List[Dict[str, Any]]:
+        # ``match`` viene en sintaxis de FTS5 ("a" "b"): se buscan todos los términos
+        terms = " ".join(re.findall(r'"([^"]*)"', match)) or match
+        sql = (
+            f"SELECT {_COLUMNS}, "
+            "ts_headline('simple', c.message, q, 'StartSel=<mark>, "
+            "StopSel=</mark>, MaxWords=12, MinWords=3, MaxFragments=1') AS snippet, "
+            "-ts_rank(c.search, q) AS rank "
+            "FROM conversations c, plainto_tsquery('simple', %s) q "
+            "WHERE c.search @@ q"
+        )
+        params: List[Any] = [terms]
+        if profile is not None:
+            sql += " AND c.profile = %s"
+            params.append(profile)
+        sql += " ORDER BY rank LIMIT %s OFFSET %s"
+        params.extend([limit, offset])
+        with self._cursor() as cursor:
+            cursor.execute(sql, params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _insert_with_topics(
+        cursor, profile, message, topics=None, created_at=None
+    ) -> Optional[int]:
+        cursor.execute(
+            "INSERT INTO conversations "
+            "(profile, message, search, created_at, content_hash) "
+            "VALUES (%s, %s, to_tsvector('simple', %s), "
+            f"COALESCE(%s, {_NOW}), %s) "
+            "ON CONFLICT (profile, content_hash) DO NOTHING RETURNING id",
+            (profile, message, normalize(message), created_at, content_hash(message)),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        conversation_id = row["id"]
+        if topics is None:
+            topics = detect_topics(message)
+        if topics:
+            cursor.executemany(
+                "INSERT INTO conversation_topics (conversation_id, profile, topic) "
+                "VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+                [(conversation_id, profile, topic) for topic in topics],
+            )
+        return conversation_id
+
+    @timed_query("insert_conversation")
+    def insert_conversation(
+        self, profile: str, message: str, topics: Optional[Iterable[str]] = None
+    ) -> Optional[int]:
+        with self._cursor() as cursor:
+            return self._insert_with_topics(cursor, profile, message, topics)
+
+    @timed_query("insert_conversations")
+    def insert_conversations(self, rows: Iterable[Tuple], path=None) -> int:
+        # ``path`` solo tiene sentido con los shards de SQLite; aquí se ignora
+        rows = list(rows)
+        if not rows:
+            return 0
+        inserted = 0
+        with self._cursor() as cursor:
+            for profile, message, *extra in rows:
+                if self._insert_with_topics(cursor, profile, message, *extra):
+                    inserted += 1
+        return inserted
+
+    def has_archived_conversations(self, profile: Optional[str] = None) -> bool:
+        # El archivado solo existe en SQLite
+        return False
+
+    @timed_query("fetch_duplicate_id")
+    def fetch_duplicate_id(self, profile: str, digest: str) -> Optional[int]:
+        with self._cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM conversations "
+                "WHERE profile = %s AND content_hash = %s",
+                (profile, digest),
+            )
+            row = cursor.fetchone()
+        return row["id"] if row is not None else None
+
+    def iter_content_hashes(self) -> Iterator[Tuple[str, str]]:
+        after_id = 0
+        while True:
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "SELECT id, profile, content_hash FROM conversations "
+                    "WHERE id > %s AND content_hash IS NOT NULL "
+                    "ORDER BY id LIMIT %s",
+                    (after_id, DB_FETCH_CHUNK),
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row["profile"], row["content_hash"]
+            after_id = rows[-1]["id"]
+
+    @staticmethod
+    def _replace_topics(cursor, rows):
+        cursor.executemany(
+            "DELETE FROM conversation_topics WHERE conversation_id = %s",
+            [(conversation_id,) for conversation_id, _, _ in rows],
+        )
+        cursor.executemany(
+            "INSERT INTO conversation_topics (conversation_id, profile, topic) "
+            "VALUES (%s, %s, %s)",
+            [
+                (conversation_id, profile, topic)
+                for conversation_id, profile, topics in rows
+                for topic in topics
+            ],
+        )
+
+    @timed_query("annotate_topics")
+    def annotate_topics(self, rows: Iterable[Tuple[int, str, List[str]]]) -> int:
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self._cursor() as cursor:
+            self._replace_topics(cursor, rows)
+        return len(rows)
+
+    @timed_query("save_analysis")
+    def save_analysis(
+        self, rows: Iterable[Tuple[int, str, List[str], Optional[str], float]]
+    ) -> int:
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self._cursor() as cursor:
+            self._replace_topics(cursor, [row[:3] for row in rows])
+            cursor.executemany(
+                "INSERT INTO conversation_analysis "
+                "(conversation_id, profile, study_citation, cue_score, analyzed_at) "
+                f"VALUES (%s, %s, %s, %s, {_NOW}) "
+                "ON CONFLICT (conversation_id) DO UPDATE SET "
+                "study_citation = excluded.study_citation, "
+                "cue_score = excluded.cue_score, "
+                "analyzed_at = excluded.analyzed_at",
+                [
+                    (conversation_id, profile, citation, score)
+                    for conversation_id, profile, _, citation, score in rows
+                ],
+            )
+        return len(rows)
+
+    @timed_query("fetch_conversation_batch")
+    def fetch_conversation_batch(
+        self, after_id: int, limit: int
+    ) -> List[Dict[str, Any]]:
+        with self._cursor() as cursor:
+            cursor.execute(
+                f"SELECT {_COLUMNS} FROM conversations c WHERE c.id > %s "
+                "ORDER BY c.id LIMIT %s",
+                (after_id, limit),
+            )
+            return [dict(row) for row in cursor.fetchall()]
+
+    @timed_query("count_topics")
+    def count_topics(self, profile: str) -> Dict[str, int]:
+        with self._cursor() as cursor:
+            cursor.execute(
+                "SELECT topic, message_count FROM profile_topic_stats "
+                "WHERE profile = %s AND message_count > 0 "
+                "ORDER BY message_count DESC",
+                (profile,),
+            )
+            return {row["topic"]: row["message_count"] for row in cursor.fetchall()}
+
+    @timed_query("fetch_profile_stats")
+    def fetch_profile_stats(
+        self, profile: str, days: int = 30
+    ) -> Optional[Dict[str, Any]]:
+        with self._cursor() as cursor:
+            cursor.execute("SELECT * FROM profile_stats WHERE profile = %s", (profile,))
+            summary = cursor.fetchone()
+            if summary is None or summary["message_count"] <= 0:
+                return None
+            cursor.execute(
+                "SELECT bucket, message_count FROM profile_length_stats "
+                "WHERE profile = %s",
+                (profile,),
+            )
+            buckets = {row["bucket"]: row["message_count"] for row in cursor}
+            cursor.execute(
+                "SELECT day, message_count FROM profile_activity_stats "
+                "WHERE profile = %s AND day >= to_char("
+                "(now() AT TIME ZONE 'UTC')::date - %s, 'YYYY-MM-DD') ORDER BY day",
+                (profile, int(days)),
+            )
+            activity = cursor.fetchall()
+        count = summary["message_count"]
+        return {
+            "profile": profile,
+            "message_count": count,
+            "average_length": summary["total_length"] / count,
+            "first_seen": summary["first_seen"],
+            "last_seen": summary["last_seen"],
+            "topics": self.count_topics(profile),
+            "length_distribution": {
+                bucket_label(i): buckets.get(bound, 0)
+                for i, bound in enumerate(LENGTH_BUCKETS)
+            },
+            "activity": [
+                {"date": row["day"], "count": row["message_count"]} for row in activity
+            ],
+        }
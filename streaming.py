@@ -0,0 +1,75 @@
+"""
+Respuestas HTTP en streaming con compresión gzip o brotli negociada por cabecera.
+Los fragmentos se agrupan en bloques y se comprimen de forma incremental.
+"""
+
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional; sin él solo se ofrece gzip
+    brotli = None
+
+STREAM_CHUNK_BYTES = int(os.environ.get("STREAM_CHUNK_BYTES", str(64 * 1024)))
+STREAM_COMPRESSION_LEVEL = int(os.environ.get("STREAM_COMPRESSION_LEVEL", "6"))
+
+
+def available_encodings():
+    """Codificaciones admitidas, por orden de preferencia del servidor."""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate_encoding(accept_encodings):
+    """Elige la codificación a partir de ``request.accept_encodings``."""
+    return accept_encodings.best_match(available_encodings(), default="identity")
+
+
+class _Compressor:
+    """Interfaz común a ``zlib`` y ``brotli``: ``compress``, ``flush`` y ``finish``."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            # Se usa el mismo nivel que en gzip (brotli admite de 0 a 11)
+            quality = min(11, STREAM_COMPRESSION_LEVEL)
+            self._obj = brotli.Compressor(quality=quality)
+        else:
+            # wbits=31: formato gzip con cabecera y CRC
+            self._obj = zlib.compressobj(STREAM_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """Comprime ``data`` y vacía el compresor para que el cliente lo reciba ya."""
+        if self.encoding == "br":
+            return self._obj.process(data) + self._obj.flush()
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """Cierra el flujo comprimido."""
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def encode_stream(chunks, encoding="identity", chunk_bytes=None):
+    """Agrupa fragmentos de texto en bloques y los comprime si hace falta.
+
+    Agrupar evita enviar (y comprimir) un bloque por fila, y limita la memoria a un
+    bloque de ``chunk_bytes`` como máximo más la última fila.
+    """
+    limit = chunk_bytes or STREAM_CHUNK_BYTES
+    compressor = _Compressor(encoding) if encoding != "identity" else None
+    buffer, size = [], 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        buffer.append(data)
+        size += len(data)
+        if size >= limit:
+            block = b"".join(buffer)
+            buffer, size = [], 0
+            yield compressor.compress(block) if compressor else block
+    block = b"".join(buffer)
+    if compressor:
+        yield compressor.compress(block) + compressor.finish()
+    elif block:
+        yield block
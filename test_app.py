@@ -5,6 +5,8 @@ Incluye pruebas de endpoints, validaciones y lógica de negocio.
 
 import pytest
 import json
+import os
+import uuid
 from app import app
 from unittest.mock import patch
 
@@ -15,6 +17,25 @@ def client():
         yield client
 
 
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """Base de datos temporal con los mensajes de ejemplo en lugar de la real."""
+    import db
+    from dedup import content_index
+    from initialize_db import initialize_database
+    from profile_state import profile_states
+
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "conversations.db"))
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    initialize_database()
+    # Los filtros y estados en memoria se cargaron de la base de datos real
+    content_index.reset()
+    profile_states.invalidate()
+    yield db.DB_NAME
+    content_index.reset()
+    profile_states.invalidate()
+
+
 def test_home(client):
     """Prueba que la página de inicio carga correctamente."""
     response = client.get("/")
@@ -239,3 +260,1439 @@ def test_edge_cases_keywords(client):
     assert response.status_code == 201
     json_data = response.get_json()
     assert "study_citation" in json_data
+
+
+def test_detect_topics_single_pass():
+    """Debe detectar todos los temas en una sola pasada, en orden de prioridad."""
+    from topic_detection import detect_topics
+
+    message = "La emoción, la IA y la microexpresión; también lo paraverbal."
+    assert detect_topics(message) == ["microexpresión", "verbal", "IA", "emoción"]
+    assert detect_topics("microexpresionismo") == []
+    assert detect_topics("") == []
+
+
+def test_study_citation_batch_lookup():
+    """La búsqueda por lotes debe coincidir con la búsqueda individual."""
+    from lie_detection_studies import (
+        get_study_citation_by_topic,
+        get_study_citations_by_topics,
+    )
+
+    topics = ["microexpresión", "Carga Cognitiva", "tema desconocido"]
+    batch = get_study_citations_by_topics(topics)
+    assert list(batch) == topics
+    for topic in topics:
+        assert batch[topic] == get_study_citation_by_topic(topic)
+    assert "Ekman" in batch["microexpresión"][0]
+    assert "Vrij" in batch["Carga Cognitiva"][0]
+
+
+def test_db_pool_reuses_connections_in_wal_mode():
+    """El pool debe reutilizar conexiones y trabajar en modo WAL."""
+    import db
+
+    with db.pooled_connection() as conn:
+        first = conn
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode.lower() == db.DB_JOURNAL_MODE.lower()
+    with db.pooled_connection() as conn:
+        assert conn is first
+    db.close_db_connections()
+    with db.pooled_connection() as conn:
+        assert conn is not first
+
+
+def test_get_conversations_cursor_pagination(client, temp_db):
+    """La paginación por cursor debe recorrer todos los mensajes sin repetir."""
+    mensajes = [f"Mensaje cursor {i}" for i in range(12)]
+    for msg in mensajes:
+        client.post("/api/conversations", json={"profile": "cursor", "message": msg})
+    vistos = []
+    url = "/api/conversations?profile=cursor&limit=5"
+    while True:
+        response = client.get(url)
+        if response.status_code == 404:
+            break
+        body = response.get_json()
+        vistos.extend(conv["message"] for conv in body["data"])
+        if not body["next_cursor"]:
+            break
+        url = f"/api/conversations?profile=cursor&limit=5&cursor={body['next_cursor']}"
+    assert vistos[-12:] == mensajes
+
+    response = client.get("/api/conversations?profile=cursor&cursor=no-valido")
+    assert response.status_code == 400
+
+
+def test_bulk_import_whatsapp_export(client, temp_db):
+    """Debe importar una exportación de WhatsApp con mensajes multilínea por lotes."""
+    # Perfil nuevo en cada ejecución: los mensajes repetidos no se vuelven a guardar
+    profile = f"bulk_whatsapp_{uuid.uuid4().hex[:8]}"
+    export = (
+        "12/31/20, 9:15 PM - Los mensajes están cifrados de extremo a extremo.\n"
+        "12/31/20, 9:16 PM - Ana: Hola, ¿qué tal?\n"
+        "12/31/20, 9:17 PM - Luis: Leí sobre la carga cognitiva\n"
+        "al mentir.\n"
+        "[31/12/20, 21:18:03] Ana: La microexpresión lo delata\n"
+    )
+    response = client.post(
+        f"/api/conversations/bulk?profile={profile}&batch_size=2",
+        data=export.encode("utf-8"),
+        content_type="text/plain",
+    )
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body["inserted"] == 3
+    assert [b["inserted"] for b in body["batches"]] == [2, 1]
+    assert body["batches"][0]["topics"] == {"carga cognitiva": 1}
+    assert body["batches"][1]["topics"] == {"microexpresión": 1}
+    response = client.get(f"/api/conversations?profile={profile}&limit=100")
+    data = response.get_json()["data"]
+    fechas = {conv["message"]: conv["created_at"] for conv in data}
+    assert fechas == {
+        "Hola, ¿qué tal?": "2020-12-31 21:16:00",
+        "Leí sobre la carga cognitiva\nal mentir.": "2020-12-31 21:17:00",
+        "La microexpresión lo delata": "2020-12-31 21:18:03",
+    }
+
+
+def test_bulk_import_reports_batches_saved_before_a_failure(
+    client, temp_db, monkeypatch
+):
+    """Si un lote falla, la respuesta resume los lotes ya guardados."""
+    import bulk_import
+
+    profile = f"bulk_fallo_{uuid.uuid4().hex[:8]}"
+    insert_conversations = bulk_import.insert_conversations
+    calls = []
+
+    def failing_insert(rows):
+        calls.append(rows)
+        if len(calls) == 2:
+            raise RuntimeError("disco lleno")
+        return insert_conversations(rows)
+
+    monkeypatch.setattr(bulk_import, "insert_conversations", failing_insert)
+    lines = [
+        json.dumps(
+            {
+                "profile": profile,
+                "message": f"Mensaje {i}",
+                "created_at": "2021-03-04 05:06:07",
+            }
+        )
+        for i in range(5)
+    ] + [json.dumps({"profile": profile, "message": "x", "created_at": "ayer"})]
+    response = client.post(
+        "/api/conversations/bulk?batch_size=2",
+        data="\n".join(lines),
+        content_type="application/x-ndjson",
+    )
+    assert response.status_code == 500
+    body = response.get_json()
+    assert "disco lleno" in body["error"]
+    assert (body["inserted"], body["failed_batch"]) == (2, 2)
+    assert [b["batch"] for b in body["batches"]] == [1]
+    guardados = client.get(f"/api/conversations?profile={profile}").get_json()["data"]
+    assert {conv["created_at"] for conv in guardados} == {"2021-03-04 05:06:07"}
+
+    monkeypatch.setattr(bulk_import, "insert_conversations", insert_conversations)
+    response = client.post(
+        "/api/conversations/bulk",
+        data="\n".join(lines),
+        content_type="application/x-ndjson",
+    )
+    body = response.get_json()
+    assert (body["inserted"], body["duplicates"]) == (3, 2)
+    assert body["batches"][0]["errors"] == {
+        "5": {"created_at": ["Not a valid datetime."]}
+    }
+
+
+def test_bulk_import_ndjson_reports_invalid_lines(client, temp_db):
+    """Las líneas NDJSON inválidas se rechazan sin impedir el resto del lote."""
+    profile = f"bulk_ndjson_{uuid.uuid4().hex[:8]}"
+    lines = [
+        json.dumps({"profile": profile, "message": "Primero"}),
+        "{no es json",
+        json.dumps({"profile": profile}),
+        json.dumps({"profile": profile, "message": "Último"}),
+    ]
+    response = client.post(
+        "/api/conversations/bulk",
+        data="\n".join(lines),
+        content_type="application/x-ndjson",
+    )
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body["inserted"] == 2
+    assert sorted(body["batches"][0]["errors"]) == ["1", "2"]
+
+
+def test_write_behind_queue_groups_rows():
+    """La cola diferida agrupa filas por transacción y las escribe al vaciarse."""
+    from write_behind import WriteBehindQueue
+
+    lotes = []
+    cola = WriteBehindQueue(writer=lotes.append, max_rows=3, max_delay_ms=100)
+    for i in range(7):
+        cola.put("write_behind", f"Mensaje diferido {i}")
+    cola.flush()
+    cola.close()
+    assert [len(lote) for lote in lotes] == [3, 3, 1]
+    assert lotes[0][0] == ("write_behind", "Mensaje diferido 0", None)
+
+
+def test_write_behind_retries_and_dead_letter(tmp_path):
+    """Un lote que falla se reintenta y, si sigue fallando, va al fichero de fallos."""
+    from write_behind import WriteBehindQueue
+
+    fallos = []
+
+    def writer(rows):
+        fallos.append(len(rows))
+        if len(fallos) < 3 or rows[0][1] == "Siempre falla":
+            raise RuntimeError("base de datos no disponible")
+
+    dead_letter = tmp_path / "fallos.jsonl"
+    cola = WriteBehindQueue(
+        writer=writer, retries=2, retry_ms=1, dead_letter=str(dead_letter)
+    )
+    cola.put("write_behind", "Se escribe al tercer intento")
+    cola.flush()
+    assert fallos == [1, 1, 1] and not dead_letter.exists()
+    cola.put("write_behind", "Siempre falla")
+    cola.flush()
+    cola.close()
+    assert cola.stats() == {"retried": 4, "dead_lettered": 1}
+    assert json.loads(dead_letter.read_text(encoding="utf-8")) == {
+        "profile": "write_behind",
+        "message": "Siempre falla",
+    }
+
+
+def test_post_conversations_write_behind(client, monkeypatch, temp_db):
+    """En modo diferido, el POST encola y responde 503 si la cola está llena."""
+    import queue
+    import routes_conversations
+    from write_behind import WriteBehindQueue
+
+    cola = WriteBehindQueue(max_delay_ms=1)
+    monkeypatch.setattr(routes_conversations, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(routes_conversations, "write_behind_queue", cola)
+    data = {"profile": "write_behind", "message": "Mensaje encolado"}
+    response = client.post("/api/conversations", json=data)
+    assert response.status_code == 201
+    cola.close()
+    response = client.get("/api/conversations?profile=write_behind&limit=1000")
+    mensajes = [conv["message"] for conv in response.get_json()["data"]]
+    assert "Mensaje encolado" in mensajes
+
+    def cola_llena(*args):
+        raise queue.Full
+
+    monkeypatch.setattr(cola, "put", cola_llena)
+    # Un mensaje distinto: el repetido ya no se encola
+    data = {"profile": "write_behind", "message": "Otro mensaje encolado"}
+    response = client.post("/api/conversations", json=data)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_openai_chat_uses_completion_cache(client, monkeypatch):
+    """Prompts equivalentes deben reutilizar la respuesta en caché."""
+    from completion_cache import completion_cache
+
+    completion_cache.clear()
+    monkeypatch.delenv("MOCK_OPENAI", raising=False)
+    contenido = '{"choices": [{"message": {"content": "Madrid"}}]}'
+    respuesta = type("obj", (object,), {"__str__": lambda self: contenido})()
+    with patch("openai.ChatCompletion.create", return_value=respuesta) as mock_openai:
+        for prompt in ["¿Capital de España?", "  ¿Capital   de España? "]:
+            response = client.post("/api/openai", json={"prompt": prompt})
+            assert response.status_code == 200
+            assert response.get_json()["response"] == "Madrid"
+    assert mock_openai.call_count == 1
+    stats = completion_cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    completion_cache.clear()
+
+
+def test_completion_cache_disk_tier_and_ttl(tmp_path):
+    """El nivel en disco sobrevive a la memoria y las entradas caducan por TTL."""
+    from completion_cache import CompletionCache
+
+    ruta = str(tmp_path / "cache.db")
+    cache = CompletionCache(max_entries=1, ttl=60, db_path=ruta, db_max_entries=2)
+    for i in range(3):
+        cache.set(f"k{i}", f"v{i}")
+    otra = CompletionCache(max_entries=1, ttl=60, db_path=ruta)
+    assert otra.get("k0") is None
+    assert otra.get("k2") == "v2"
+    assert otra.stats()["disk_hits"] == 1
+    caducada = CompletionCache(ttl=0.000001, db_path=ruta)
+    assert caducada.get("k1") is None
+
+
+def test_completion_cache_evicts_in_batches_and_skips_empty(tmp_path):
+    """El disco se recorta por tandas al pasar el límite y no se guarda lo vacío."""
+    import sqlite3
+
+    from completion_cache import CompletionCache
+
+    ruta = str(tmp_path / "cache.db")
+    cache = CompletionCache(max_entries=0, db_path=ruta, db_max_entries=10)
+
+    def entries():
+        with sqlite3.connect(ruta) as conn:
+            return conn.execute("SELECT count(*) FROM completion_cache").fetchone()[0]
+
+    for i in range(11):
+        cache.set(f"k{i}", f"v{i}")
+    # Al pasar de 10 se deja un margen: las siguientes inserciones no recortan
+    assert entries() == 9
+    assert cache.get("k1") is None and cache.get("k10") == "v10"
+    cache.set("k11", "v11")
+    assert entries() == 10
+
+    calls = []
+    for _ in range(2):
+        assert cache.get_or_compute("hola", "m", lambda: calls.append(1) or "") == ""
+    assert len(calls) == 2
+    assert entries() == 10
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    """Servidor local que imita OpenAI; desactiva el mock y la caché de respuestas."""
+    import openai_proxy
+    from completion_cache import completion_cache
+    from fake_openai import start_fake_upstream
+
+    server, api_base = start_fake_upstream(answer="Hola desde el servidor falso")
+    monkeypatch.delenv("MOCK_OPENAI", raising=False)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(openai_proxy, "OPENAI_API_BASE", api_base)
+    monkeypatch.setattr(openai_proxy, "OPENAI_BACKOFF_BASE", 0.01)
+    completion_cache.clear()
+    yield server
+    completion_cache.clear()
+    server.shutdown()
+
+
+def test_openai_chat_retries_transient_errors(client, fake_upstream):
+    """Un 503 transitorio del upstream se reintenta con backoff."""
+    fake_upstream.fail_first = 1
+    response = client.post("/api/openai", json={"prompt": "Reintento"})
+    assert response.status_code == 200
+    assert response.get_json()["response"] == "Hola desde el servidor falso"
+    assert fake_upstream.requests == 2
+
+
+def test_openai_chat_deadline_returns_504(client, fake_upstream, monkeypatch):
+    """Si el upstream no responde dentro de OPENAI_DEADLINE se responde 504 a tiempo."""
+    import time
+    import openai_proxy
+
+    monkeypatch.setattr(openai_proxy, "OPENAI_DEADLINE", 0.3)
+    fake_upstream.delay = 2
+    for data in ({"prompt": "Lento"}, {"prompt": "Lento en stream", "stream": True}):
+        start = time.monotonic()
+        response = client.post("/api/openai", json=data)
+        assert response.status_code == 504
+        assert time.monotonic() - start < 1.5
+
+
+def test_openai_chat_streaming_sse(client, fake_upstream):
+    """En modo stream, los fragmentos llegan como eventos SSE y se cierra con 'done'."""
+    data = {"prompt": "Stream sobre microexpresión", "stream": True}
+    response = client.post("/api/openai", json=data)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    eventos = response.get_data(as_text=True).strip().split("\n\n")
+    tokens = [json.loads(e[len("data: "):])["token"] for e in eventos[:-1]]
+    assert "".join(tokens).strip() == "Hola desde el servidor falso"
+    assert eventos[-1].startswith("event: done")
+    final = json.loads(eventos[-1].split("data: ", 1)[1])
+    assert final["response"] == "Hola desde el servidor falso"
+    assert "study_citation" in final
+
+
+def test_openai_chat_concurrency_limit(client, monkeypatch):
+    """Si no quedan huecos para llamar a OpenAI, la API responde 503."""
+    import threading
+    import openai_proxy
+    from completion_cache import completion_cache
+
+    completion_cache.clear()
+    monkeypatch.setattr(openai_proxy, "_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(openai_proxy, "OPENAI_ADMISSION_TIMEOUT", 0.01)
+    openai_proxy._slots.acquire()
+    response = client.post("/api/openai", json={"prompt": "Sin hueco"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_openai_slots_leave_a_thread_for_other_routes(fake_upstream, monkeypatch):
+    """Con OpenAI lento y sus huecos llenos, las demás rutas se siguen sirviendo."""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    import openai_proxy
+
+    threads = 4  # como gunicorn.conf.py por defecto
+    slots = openai_proxy.max_in_flight(threads, configured=8)
+    assert slots == openai_proxy.max_in_flight(threads) == threads - 1
+    monkeypatch.setattr(openai_proxy, "_slots", threading.BoundedSemaphore(slots))
+    fake_upstream.delay = 1.0
+
+    def post_openai(i):
+        with app.test_client() as c:
+            return c.post("/api/openai", json={"prompt": f"Lento {i}"}).status_code
+
+    def get_home():
+        with app.test_client() as c:
+            return c.get("/").status_code
+
+    # Los hilos del worker: uno por hilo de Gunicorn
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        lentas = [pool.submit(post_openai, i) for i in range(slots)]
+        time.sleep(0.2)
+        extra = pool.submit(post_openai, slots)
+        start = time.monotonic()
+        assert pool.submit(get_home).result(timeout=5) == 200
+        assert time.monotonic() - start < 0.5
+        assert extra.result(timeout=5) == 503
+        assert [f.result(timeout=5) for f in lentas] == [200] * slots
+
+
+def test_search_conversations_fts(client, temp_db):
+    """La búsqueda ignora tildes y mayúsculas, ordena por relevancia y resalta."""
+    mensajes = [
+        "La EMOCIÓN se nota en la voz",
+        "Otra emocion distinta, emoción repetida",
+        "Mensaje sin relación",
+    ]
+    for msg in mensajes:
+        client.post("/api/conversations", json={"profile": "busqueda", "message": msg})
+    response = client.get("/api/conversations/search?q=Emocion&profile=busqueda")
+    assert response.status_code == 200
+    resultados = response.get_json()["data"]
+    assert {r["message"] for r in resultados} <= set(mensajes[:2])
+    assert len(resultados) >= 2
+    assert resultados[0]["message"] == mensajes[1]
+    assert "<mark>" in resultados[0]["snippet"]
+
+    assert response.get_json()["archived_excluded"] is False
+
+    response = client.get('/api/conversations/search?q="NEAR(&profile=busqueda')
+    assert response.status_code == 404
+    response = client.get("/api/conversations/search?q=")
+    assert response.status_code == 400
+
+
+def test_search_flags_archived_messages(client, tmp_path, monkeypatch):
+    """La búsqueda avisa de que no incluye los mensajes archivados."""
+    import archive_conversations
+    import db
+    from initialize_db import setup_sqlite_schema
+
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "conv.db"))
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    setup_sqlite_schema()
+    db.insert_conversation("viejo", "Una microexpresión de hace años")
+    db.insert_conversation("nuevo", "Otra microexpresión reciente")
+    with db.pooled_connection() as conn:
+        conn.execute(
+            "UPDATE conversations SET created_at = '2000-01-01 00:00:00' "
+            "WHERE profile = 'viejo'"
+        )
+    assert dict(archive_conversations.archive(days=30)) == {"viejo": 1}
+
+    response = client.get("/api/conversations/search?q=microexpresion&profile=viejo")
+    assert response.status_code == 404
+    assert response.get_json()["archived_excluded"] is True
+    response = client.get("/api/conversations/search?q=microexpresion&profile=nuevo")
+    assert response.get_json()["archived_excluded"] is False
+    response = client.get("/api/conversations/search?q=microexpresion")
+    assert [r["profile"] for r in response.get_json()["data"]] == ["nuevo"]
+    assert response.get_json()["archived_excluded"] is True
+
+    monkeypatch.setattr(archive_conversations, "STORAGE_BACKEND", "postgres")
+    with pytest.raises(RuntimeError, match="no está soportado"):
+        list(archive_conversations.archive(days=30))
+
+
+def test_conversation_topics_filter_and_counts(client, temp_db):
+    """Los temas se guardan al insertar y permiten filtrar y contar por perfil."""
+    import db
+    from backfill_topics import backfill_topics
+
+    profile = "temas_test"
+    with db.pooled_connection() as conn:
+        conn.execute("DELETE FROM conversations WHERE profile = ?", (profile,))
+    for message in ["Carga cognitiva alta", "Sin tema", "La IA y lo cognitivo"]:
+        client.post(
+            "/api/conversations", json={"profile": profile, "message": message}
+        )
+    # Fila antigua sin anotar, como las anteriores a la tabla de temas
+    with db.pooled_connection() as conn:
+        conn.execute(
+            "INSERT INTO conversations (profile, message) VALUES (?, ?)",
+            (profile, "Una microexpresión antigua"),
+        )
+
+    response = client.get(f"/api/conversations?profile={profile}&topic=Carga Cognitiva")
+    assert response.status_code == 200
+    mensajes = [conv["message"] for conv in response.get_json()["data"]]
+    assert mensajes == ["Carga cognitiva alta", "La IA y lo cognitivo"]
+    response = client.get(f"/api/conversations?profile={profile}&topic=astrologia")
+    assert response.status_code == 400
+
+    list(backfill_topics(batch_size=2))
+    response = client.get(f"/api/profiles/{profile}/topics")
+    assert response.status_code == 200
+    assert response.get_json()["topics"] == {
+        "carga cognitiva": 2,
+        "IA": 1,
+        "microexpresión": 1,
+    }
+
+
+def test_profile_stats_incremental(client, temp_db):
+    """Las estadísticas del perfil se mantienen al insertar y al borrar mensajes."""
+    import db
+
+    profile = "stats_test"
+    with db.pooled_connection() as conn:
+        conn.execute("DELETE FROM conversations WHERE profile = ?", (profile,))
+    for message in ["Hola", "La resonancia y la emoción", "x" * 120]:
+        client.post("/api/conversations", json={"profile": profile, "message": message})
+    response = client.get(f"/api/profiles/{profile}/stats")
+    assert response.status_code == 200
+    stats = response.get_json()
+    assert stats["message_count"] == 3
+    assert stats["average_length"] == (4 + 26 + 120) / 3
+    assert stats["topics"] == {"fMRI": 1, "emoción": 1}
+    assert stats["length_distribution"]["0-19"] == 1
+    assert stats["length_distribution"]["20-49"] == 1
+    assert stats["length_distribution"]["100-199"] == 1
+    assert sum(day["count"] for day in stats["activity"]) >= 3
+
+    with db.pooled_connection() as conn:
+        conn.execute("DELETE FROM conversations WHERE profile = ?", (profile,))
+    response = client.get(f"/api/profiles/{profile}/stats")
+    assert response.status_code == 404
+    assert client.get("/api/profiles/perfil_inexistente/stats").status_code == 404
+
+
+def test_create_app_factory():
+    """La factoría crea instancias independientes con las rutas registradas."""
+    from app import create_app
+
+    nueva = create_app()
+    assert nueva is not app
+    assert not nueva.debug
+    rutas = {rule.rule for rule in nueva.url_map.iter_rules()}
+    assert {"/", "/api/conversations", "/api/profiles/<profile>/stats"} <= rutas
+
+
+def test_metrics_endpoint_prometheus_format(client, temp_db):
+    """/metrics expone latencias por ruta, de base de datos, de temas y de la caché."""
+    client.post("/api/conversations", json={"profile": "metrics", "message": "Hola IA"})
+    client.get("/api/conversations?profile=metrics")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    body = response.get_data(as_text=True)
+    assert "# TYPE trueliebot_http_request_duration_seconds histogram" in body
+    assert (
+        'trueliebot_http_request_duration_seconds_count{method="POST",'
+        'route="/api/conversations",status="201"}'
+    ) in body
+    assert (
+        'trueliebot_db_query_duration_seconds_count{operation="insert_conversation"}'
+    ) in body
+    assert "trueliebot_topic_detection_duration_seconds_count " in body
+    assert 'trueliebot_openai_cache_requests_total{result="hit"}' in body
+    assert 'le="+Inf"' in body
+
+
+def test_benchmarks_micro_and_compare(tmp_path, monkeypatch):
+    """Los microbenchmarks corren sobre una base sembrada y detectan regresiones."""
+    import db
+    from benchmarks import compare, micro, seed
+
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "bench.db"))
+    seed.seed_database(db.DB_NAME, 300, num_profiles=3, batch_size=100)
+    report = micro.run(iterations=5, depth=50)
+    results = report["results"]
+    assert {"fetch_conversations_deep_keyset", "insert_conversation"} <= set(results)
+    # Cada inserción (calentamiento incluido) es un mensaje nuevo, no un duplicado
+    with db.pooled_connection() as conn:
+        (inserted,) = conn.execute(
+            "SELECT COUNT(*) FROM conversations WHERE profile = 'benchmark'"
+        ).fetchone()
+    assert inserted == 10
+    assert results["detect_topics"]["operations"] == 5
+    assert {"p50_ms", "p95_ms", "p99_ms", "throughput_ops_s"} <= set(
+        results["detect_topics"]
+    )
+
+    slower = json.loads(json.dumps(report))
+    slower["results"]["detect_topics"]["p95_ms"] = (
+        results["detect_topics"]["p95_ms"] * 2 + 1
+    )
+    _, regressions = compare.compare(report, slower, threshold=10)
+    assert [(op, metric) for op, metric, *_ in regressions] == [
+        ("detect_topics", "p95_ms")
+    ]
+
+
+def test_conditional_get_conversations_and_advice(client, temp_db):
+    """Las páginas y el guion de consejos responden 304 si el ETag no ha cambiado."""
+    import db
+
+    with db.pooled_connection() as conn:
+        conn.execute("DELETE FROM conversations WHERE profile = 'etag'")
+    client.post("/api/conversations", json={"profile": "etag", "message": "Hola"})
+    first = client.get("/api/conversations?profile=etag")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "private, no-cache"
+    assert "Last-Modified" in first.headers
+
+    again = client.get(
+        "/api/conversations?profile=etag", headers={"If-None-Match": etag}
+    )
+    assert again.status_code == 304
+    assert again.data == b""
+    otra_pagina = client.get(
+        "/api/conversations?profile=etag&limit=5", headers={"If-None-Match": etag}
+    )
+    assert otra_pagina.status_code == 200
+
+    client.post("/api/conversations", json={"profile": "etag", "message": "Adiós"})
+    changed = client.get(
+        "/api/conversations?profile=etag", headers={"If-None-Match": etag}
+    )
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert len(changed.get_json()["data"]) == 2
+    assert changed.get_json()["data"][0]["cue_score"] is None
+
+    # El reanálisis offline también cambia la página
+    etag = changed.headers["ETag"]
+    conversation_id = changed.get_json()["data"][0]["id"]
+    db.save_analysis([(conversation_id, "etag", [], "Estudio", 0.25)])
+    reanalyzed = client.get(
+        "/api/conversations?profile=etag", headers={"If-None-Match": etag}
+    )
+    assert reanalyzed.status_code == 200
+    assert reanalyzed.get_json()["data"][0]["study_citation"] == "Estudio"
+    assert reanalyzed.get_json()["data"][0]["cue_score"] == 0.25
+
+    advice = client.get("/api/advice")
+    assert advice.get_json()["advice"]
+    assert advice.headers["Cache-Control"].startswith("public, max-age=")
+    revalidated = client.get(
+        "/api/advice", headers={"If-None-Match": advice.headers["ETag"]}
+    )
+    assert revalidated.status_code == 304
+
+    swagger = client.get("/static/swagger.json")
+    revalidated = client.get(
+        "/static/swagger.json", headers={"If-None-Match": swagger.headers["ETag"]}
+    )
+    assert revalidated.status_code == 304
+
+
+def test_get_conversations_streamed_json_ndjson_and_gzip(client, temp_db):
+    """El modo streaming devuelve la misma página, comprimida si se pide."""
+    import gzip
+
+    normal = client.get("/api/conversations?profile=default&limit=30").get_json()
+    streamed = client.get("/api/conversations?profile=default&limit=30&stream=true")
+    assert streamed.status_code == 200
+    assert streamed.headers["Vary"] == "Accept-Encoding"
+    assert json.loads(streamed.get_data()) == normal
+
+    comprimido = client.get(
+        "/api/conversations?profile=default&limit=30&format=ndjson",
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert comprimido.mimetype == "application/x-ndjson"
+    assert comprimido.headers["Content-Encoding"] == "gzip"
+    lines = gzip.decompress(comprimido.get_data()).decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == normal["data"]
+    assert comprimido.headers["ETag"] != streamed.headers["ETag"]
+
+    vacio = client.get("/api/conversations?profile=nadie_stream&format=ndjson")
+    assert vacio.status_code == 404
+    assert client.get("/api/conversations?format=xml").status_code == 400
+
+
+def test_encode_stream_groups_chunks():
+    """encode_stream agrupa fragmentos en bloques y produce gzip válido."""
+    import gzip
+    from streaming import encode_stream
+
+    chunks = [f"fila {i}\n" for i in range(1000)]
+    plano = list(encode_stream(iter(chunks), chunk_bytes=1024))
+    assert 1 < len(plano) < 20
+    assert b"".join(plano).decode("utf-8") == "".join(chunks)
+    comprimido = b"".join(encode_stream(iter(chunks), "gzip", chunk_bytes=1024))
+    assert gzip.decompress(comprimido).decode("utf-8") == "".join(chunks)
+
+
+def test_post_conversations_size_limits(client, monkeypatch, temp_db):
+    """Los mensajes y perfiles demasiado largos se rechazan antes de procesarlos."""
+    import routes_conversations
+    import validation
+
+    monkeypatch.setattr(validation, "MAX_MESSAGE_BYTES", 10)
+    response = client.post(
+        "/api/conversations", json={"profile": "limites", "message": "ñ" * 6}
+    )
+    assert response.status_code == 400
+    assert "message" in response.get_json()["error"]
+    response = client.post(
+        "/api/conversations", json={"profile": "p" * 101, "message": "Hola"}
+    )
+    assert response.status_code == 400
+    assert "profile" in response.get_json()["error"]
+
+    # Cuerpo enorme: 413 sin llegar a parsear el JSON
+    monkeypatch.setattr(routes_conversations, "MAX_CONVERSATION_BODY_BYTES", 100)
+    with patch("routes_conversations.validate_conversation") as validar:
+        response = client.post(
+            "/api/conversations",
+            data=json.dumps({"profile": "limites", "message": "x" * 500}),
+            content_type="application/json",
+        )
+    assert response.status_code == 413
+    validar.assert_not_called()
+
+    response = client.post(
+        "/api/conversations", data="{no es json", content_type="application/json"
+    )
+    assert response.status_code == 400
+
+
+def test_validate_conversation_matches_schema_errors():
+    """La validación rápida devuelve los mismos errores que ConversationSchema."""
+    from schemas import conversation_schema
+    from validation import validate_conversation
+
+    casos = [
+        {"profile": "a", "message": "b"},
+        {},
+        {"message": "Sin perfil"},
+        {"profile": 123, "message": None},
+        {"profile": "a", "message": "b", "extra": 1},
+        ["no", "dict"],
+        None,
+    ]
+    for caso in casos:
+        assert validate_conversation(caso) == conversation_schema.validate(caso)
+
+
+def test_rate_limit_by_profile_and_ip(client, monkeypatch, temp_db):
+    """Se responde 429 con Retry-After al agotar la cuota del perfil o de la IP."""
+    import rate_limit
+    from metrics import rate_limited_requests
+
+    monkeypatch.setattr(rate_limit, "backend", rate_limit.MemoryBackend())
+    monkeypatch.setitem(rate_limit.QUOTAS, "write", (2, 0.01))
+    antes = rate_limited_requests.value(quota="write", scope="profile")
+
+    def post(profile, ip):
+        return client.post(
+            "/api/conversations",
+            json={"profile": profile, "message": "Hola"},
+            environ_base={"REMOTE_ADDR": ip},
+        )
+
+    assert post("rl_a", "10.0.0.1").status_code == 201
+    assert post("rl_a", "10.0.0.2").status_code == 201
+    response = post("rl_a", "10.0.0.3")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert rate_limited_requests.value(quota="write", scope="profile") == antes + 1
+
+    # Otro perfil desde una IP ya agotada también se limita
+    assert post("rl_b", "10.0.0.1").status_code == 201
+    assert post("rl_c", "10.0.0.1").status_code == 429
+
+
+@pytest.mark.parametrize("backend_name", ["memory", "sqlite"])
+def test_rate_limit_rejection_spends_no_tokens(
+    client, monkeypatch, temp_db, tmp_path, backend_name
+):
+    """Una petición que rechaza el cubo del perfil no gasta de la cuota de la IP."""
+    import rate_limit
+
+    backend = (
+        rate_limit.MemoryBackend()
+        if backend_name == "memory"
+        else rate_limit.SQLiteBackend(str(tmp_path / "limits.db"))
+    )
+    monkeypatch.setattr(rate_limit, "backend", backend)
+    monkeypatch.setitem(rate_limit.QUOTAS, "write", (2, 0.01))
+
+    def post(profile, ip):
+        return client.post(
+            "/api/conversations",
+            json={"profile": profile, "message": "Hola"},
+            environ_base={"REMOTE_ADDR": ip},
+        )
+
+    assert post("rl_lleno", "10.0.1.1").status_code == 201
+    assert post("rl_lleno", "10.0.1.2").status_code == 201
+    for _ in range(3):
+        assert post("rl_lleno", "10.0.1.3").status_code == 429
+    # La IP 10.0.1.3 conserva sus dos tokens
+    assert post("rl_otro", "10.0.1.3").status_code == 201
+    assert post("rl_otro2", "10.0.1.3").status_code == 201
+
+
+def test_rate_limit_client_ip_behind_proxy(client, monkeypatch):
+    """Se toma la IP que añadió el proxy de confianza, no la que escribe el cliente."""
+    import rate_limit
+
+    headers = {"X-Forwarded-For": "6.6.6.6, 203.0.113.7"}
+    with client.application.test_request_context(
+        headers=headers, environ_base={"REMOTE_ADDR": "10.1.2.3"}
+    ):
+        monkeypatch.setattr(rate_limit, "RATE_LIMIT_TRUST_PROXY", 0)
+        assert rate_limit.client_ip() == "10.1.2.3"
+        monkeypatch.setattr(rate_limit, "RATE_LIMIT_TRUST_PROXY", 1)
+        assert rate_limit.client_ip() == "203.0.113.7"
+        monkeypatch.setattr(rate_limit, "RATE_LIMIT_TRUST_PROXY", 2)
+        assert rate_limit.client_ip() == "6.6.6.6"
+        monkeypatch.setattr(rate_limit, "RATE_LIMIT_TRUST_PROXY", 3)
+        assert rate_limit.client_ip() == "10.1.2.3"
+
+
+def test_rate_limit_sqlite_backend_shared(tmp_path):
+    """Dos procesos (dos backends) sobre el mismo fichero comparten la cuota."""
+    from rate_limit import SQLiteBackend
+
+    path = str(tmp_path / "limits.db")
+    worker_1, worker_2 = SQLiteBackend(path), SQLiteBackend(path)
+    waits = [
+        backend.acquire("openai:ip:1.2.3.4", 3, 0.001)
+        for backend in (worker_1, worker_2, worker_1, worker_2)
+    ]
+    assert waits[:3] == [0, 0, 0]
+    assert waits[3] > 0
+
+
+def test_sharded_storage_and_rebalance(tmp_path, monkeypatch):
+    """Los perfiles se reparten entre shards y el rebalanceo conserva los datos."""
+    import db
+    from initialize_db import initialize_database
+    from rebalance_shards import rebalance
+
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "conv.db"))
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    initialize_database(120, num_profiles=12, batch_size=50)
+    # Fechas antiguas fijas: el rebalanceo no debe cambiarlas por la fecha actual
+    with db.pooled_connection() as conn:
+        conn.execute(
+            "UPDATE profile_stats SET first_seen = '2001-01-01 00:00:00', "
+            "last_seen = '2002-02-02 00:00:00'"
+        )
+    antes = {
+        f"perfil_{k}": db.fetch_profile_stats(f"perfil_{k}") for k in range(1, 12)
+    }
+
+    monkeypatch.setattr(db, "DB_SHARDS", 3)
+    movidos = list(rebalance(batch_size=4))
+    assert movidos and all(n == 10 for *_, n in movidos)
+    assert list(rebalance()) == []
+    for profile, stats in antes.items():
+        path = db.shard_for(profile)
+        with db.pooled_connection(path) as conn:
+            rows = conn.execute(
+                "SELECT id FROM conversations WHERE profile = ?", (profile,)
+            ).fetchall()
+        ids = [row[0] for row in rows]
+        assert len(ids) == 10
+        assert {i // db.SHARD_ID_SPAN for i in ids} == {db.shard_index(profile)}
+        despues = db.fetch_profile_stats(profile)
+        for key in ("message_count", "topics", "length_distribution", "activity"):
+            assert despues[key] == stats[key]
+        assert despues["first_seen"] == "2001-01-01 00:00:00"
+        assert despues["last_seen"] == "2002-02-02 00:00:00"
+
+    # Inserciones y lecturas van al shard del perfil; la búsqueda los recorre todos
+    nuevo = db.insert_conversation("perfil_5", "Una microexpresión nueva")
+    assert nuevo // db.SHARD_ID_SPAN == db.shard_index("perfil_5")
+    assert db.fetch_conversations("perfil_5", limit=20)[-1]["id"] == nuevo
+    resultados = db.search_conversations('"microexpresion"', limit=100)
+    assert nuevo in {r["id"] for r in resultados}
+    assert len({r["id"] // db.SHARD_ID_SPAN for r in resultados}) > 1
+    lote = db.fetch_conversation_batch(0, 1000)
+    assert len(lote) == len({r["id"] for r in lote})
+
+
+def test_storage_backend_selection(monkeypatch):
+    """La capa de almacenamiento delega en el backend configurado."""
+    import storage
+
+    assert storage.backend.name == "sqlite"
+    with pytest.raises(ValueError):
+        storage.create_storage("oracle")
+
+    class Registro:
+        name = "registro"
+
+        def count_topics(self, profile):
+            return {"ia": 7}
+
+    monkeypatch.setattr(storage, "backend", Registro())
+    assert storage.count_topics("default") == {"ia": 7}
+
+
+@pytest.mark.skipif(
+    not os.environ.get("POSTGRES_TEST_DSN"),
+    reason="Define POSTGRES_TEST_DSN para probar el backend PostgreSQL",
+)
+def test_postgres_storage_roundtrip():
+    """El backend PostgreSQL cumple las mismas operaciones que el de SQLite."""
+    pytest.importorskip("psycopg2")
+    from storage_postgres import PostgresStorage
+
+    pg = PostgresStorage(os.environ["POSTGRES_TEST_DSN"])
+    try:
+        pg.setup_schema(reset=True)
+        first = pg.insert_conversation("pg", "Noté una microexpresión de miedo")
+        pg.insert_conversations([("pg", "Hola"), ("pg", "Su tono emocional", None)])
+        page = pg.fetch_conversations("pg", limit=2)
+        assert [row["id"] for row in page][0] == first
+        assert [row["message"] for row in pg.iter_conversations("pg", limit=10)] == [
+            "Noté una microexpresión de miedo",
+            "Hola",
+            "Su tono emocional",
+        ]
+        assert pg.fetch_conversations("pg", after_id=page[-1]["id"])[0]["message"] == (
+            "Su tono emocional"
+        )
+        version = pg.fetch_conversations_version("pg")
+        assert version["message_count"] == 3 and version["last_seen"]
+        results = pg.search_conversations('"microexpresion"', profile="pg")
+        assert [row["id"] for row in results] == [first]
+        assert "<mark>miedo</mark>" in pg.search_conversations('"miedo"')[0]["snippet"]
+        stats = pg.fetch_profile_stats("pg")
+        assert stats["message_count"] == 3
+        assert stats["topics"] == pg.count_topics("pg")
+        assert pg.fetch_profile_stats("nadie") is None
+    finally:
+        pg.close()
+
+
+CUE_MESSAGES = [
+    "No sé, quizás fui yo, pero te lo juro que no estaba porque tenía trabajo.",
+    "Vi una luz brillante y escuché un ruido fuerte, olía a quemado.",
+    "",
+]
+
+
+def test_deception_cues_batch_scoring():
+    """La puntuación por lotes no depende del lote."""
+    import deception_cues
+
+    mensajes = CUE_MESSAGES
+    features, scores = deception_cues.cue_matrix(mensajes)
+    cues = dict(zip(deception_cues.FEATURE_NAMES, features[0]))
+    assert cues["hedges"] > 0 and cues["justifications"] > 0
+    assert dict(zip(deception_cues.FEATURE_NAMES, features[1]))["sensory"] > 0.3
+    assert scores[0] > scores[1]
+    assert features[2][-1] == 0.0 and 0 < scores[2] < 1
+    # Un mensaje suelto recibe la misma puntuación que dentro del lote
+    assert deception_cues.cue_matrix(mensajes[1:2])[1][0] == pytest.approx(scores[1])
+
+
+def test_deception_cues_numpy_matches_python(monkeypatch):
+    """Con y sin numpy se obtienen los mismos rasgos y puntuaciones."""
+    pytest.importorskip("numpy")
+    import deception_cues
+
+    mensajes = CUE_MESSAGES
+    features, scores = deception_cues.cue_matrix(mensajes)
+    monkeypatch.setattr(deception_cues, "numpy", None)
+    python_features, python_scores = deception_cues.cue_matrix(mensajes)
+    assert python_scores == pytest.approx(scores)
+    assert python_features[0] == pytest.approx(features[0])
+
+
+def test_score_conversations_and_profile_cues(client, temp_db):
+    """Endpoints de puntuación por petición y agregada por perfil."""
+    response = client.post(
+        "/api/conversations/score",
+        json={"messages": ["Te prometo que no, la verdad", "Vi su coche rojo"]},
+    )
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["features"][-2:] == ["length_ratio", "words"]
+    assert len(body["results"]) == 2
+    assert body["results"][0]["score"] > body["results"][1]["score"]
+
+    response = client.post("/api/conversations/score", json={"messages": [1]})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == {"messages": {"0": ["Not a valid string."]}}
+    response = client.post("/api/conversations/score", json={"messages": []})
+    assert response.status_code == 400
+
+    response = client.get("/api/profiles/default/cues")
+    assert response.status_code == 200
+    summary = response.get_json()
+    assert summary["message_count"] >= 50
+    assert 0 < summary["mean_score"] < 1
+    assert set(summary["mean_cues"]) == set(
+        ["first_person", "third_person", "hedges", "justifications", "sensory",
+         "negations", "fillers", "length_ratio", "words"]
+    )
+    assert client.get("/api/profiles/nadie/cues").status_code == 404
+
+
+def test_reanalyze_parallel_with_checkpoint(tmp_path, temp_db):
+    """El reanálisis se reanuda desde el punto de control y analiza cada mensaje."""
+    import sqlite3
+    import db
+    import reanalyze
+
+    checkpoint = str(tmp_path / "checkpoint.json")
+    run = reanalyze.reanalyze(workers=2, chunk_size=7, checkpoint=checkpoint)
+    first_id, first_total = next(run)
+    next(run)
+    run.close()  # interrupción tras dos tramos
+    state = reanalyze.load_checkpoint(checkpoint)
+    assert state["processed"] == 14 and state["last_id"] > first_id
+    assert first_total == 7
+
+    progress = list(reanalyze.reanalyze(workers=2, chunk_size=7, checkpoint=checkpoint))
+    assert not os.path.exists(checkpoint)
+    conn = sqlite3.connect(db.DB_NAME)
+    total, with_citation = conn.execute(
+        "SELECT count(*), count(study_citation) FROM conversation_analysis"
+    ).fetchone()
+    conversations = conn.execute("SELECT count(*) FROM conversations").fetchone()[0]
+    microexpression = conn.execute(
+        "SELECT a.study_citation FROM conversation_analysis a "
+        "JOIN conversations c ON c.id = a.conversation_id "
+        "WHERE c.message LIKE '%microexpresión%' LIMIT 1"
+    ).fetchone()[0]
+    conn.close()
+    assert progress[-1][1] == total == conversations
+    assert 0 < with_citation < total
+    assert microexpression.startswith("Ekman")
+
+
+def test_profile_state_incremental_window_and_lru(monkeypatch):
+    """El estado por perfil se actualiza en O(1), con ventana, alertas y LRU."""
+    import profile_state
+
+    monkeypatch.setattr(profile_state, "PROFILE_STATE_WINDOW", 3)
+    state = profile_state.ProfileState(2, {"IA": 1}, [0.1, 0.2], now=0.0)
+    for second, score in enumerate([0.9, 0.9, 0.9]):
+        state.update(["IA"], score, now=float(second))
+    snapshot = state.snapshot(now=3.0)
+    assert snapshot["message_count"] == 5
+    assert snapshot["topics"] == {"IA": 4}
+    assert snapshot["recent_scores"] == {"window": 3, "mean": 0.9, "last": 0.9}
+    assert snapshot["messages_per_minute"] == 3.0
+    monkeypatch.setattr(profile_state, "PROFILE_STATE_MIN_MESSAGES", 3)
+    monkeypatch.setattr(profile_state, "PROFILE_STATE_BURST_RATE", 3)
+    assert state.snapshot(now=3.0)["flags"] == ["high_cue_scores", "message_burst"]
+    # Pasado un minuto los mensajes salen de la ventana de ritmo
+    assert state.snapshot(now=120.0)["messages_per_minute"] == 0.0
+
+    cache = profile_state.ProfileStateCache(max_profiles=1, ttl=10)
+    assert cache.get("default", now=0.0)["message_count"] >= 50
+    assert cache.get("nadie", now=0.0) is None
+    first = cache.record("nuevo_diferido", ["IA"], 0.4, now=1.0)
+    assert first["message_count"] == 1 and first["topics"] == {"IA": 1}
+    assert cache.stats()["profiles"] == 1  # "default" se descartó por LRU
+    assert cache.record("nuevo_diferido", [], 0.6, now=2.0)["recent_scores"][
+        "mean"
+    ] == 0.5
+    assert cache.get("nuevo_diferido", now=20.0) is None  # caducado y sin filas
+
+
+def test_profile_state_endpoint_and_post_response(client, temp_db):
+    """El POST devuelve el estado actualizado y el endpoint lo expone."""
+    profile = f"estado_{uuid.uuid4().hex[:8]}"
+    response = client.post(
+        "/api/conversations",
+        json={"profile": profile, "message": "Quizás no, te lo juro, la verdad"},
+    )
+    assert response.status_code == 201
+    first = response.get_json()["profile_state"]
+    response = client.post(
+        "/api/conversations",
+        json={"profile": profile, "message": "Leí sobre IA y resonancia"},
+    )
+    second = response.get_json()["profile_state"]
+    assert second["message_count"] == first["message_count"] + 1
+    assert second["topics"]["IA"] == first["topics"].get("IA", 0) + 1
+    assert second["recent_scores"]["window"] == first["recent_scores"]["window"] + 1
+
+    response = client.get(f"/api/profiles/{profile}/state")
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["profile"] == profile
+    assert body["message_count"] == second["message_count"]
+    assert client.get("/api/profiles/nadie/state").status_code == 404
+
+
+def test_profile_cues_are_kept_incrementally(client, monkeypatch, temp_db):
+    """Tras la primera consulta las medias de indicios se actualizan sin releer."""
+    import deception_cues
+    import profile_state
+    import storage
+
+    profile = f"indicios_{uuid.uuid4().hex[:8]}"
+    for message in ["Vi una luz roja", "Quizás no, te lo juro, la verdad"]:
+        client.post("/api/conversations", json={"profile": profile, "message": message})
+    first = client.get(f"/api/profiles/{profile}/cues").get_json()
+    assert first["message_count"] == 2
+
+    def no_scan(*args, **kwargs):
+        raise AssertionError("no debería recorrer el historial")
+
+    monkeypatch.setattr(profile_state, "fetch_conversations", no_scan)
+    client.post(
+        "/api/conversations", json={"profile": profile, "message": "Creo que sí"}
+    )
+    summary = client.get(f"/api/profiles/{profile}/cues").get_json()
+    rescan = deception_cues.scan_profile(storage.fetch_conversations, profile)
+    assert summary == rescan.summary(profile)
+    assert summary["message_count"] == 3
+
+    # Sin id (inserción diferida) un nuevo máximo no se puede sumar
+    assert not rescan.add(None, [0.0] * len(deception_cues.FEATURE_NAMES), 1.0)
+    assert rescan.add(None, [0.0] * len(deception_cues.FEATURE_NAMES), 0.0)
+    assert rescan.count == 4
+
+
+def test_schema_migration_is_non_destructive(tmp_path, monkeypatch):
+    """Las migraciones añaden created_at a una base antigua sin perder filas."""
+    import sqlite3
+    import db
+    from initialize_db import MIGRATIONS, setup_sqlite_schema
+
+    path = str(tmp_path / "antigua.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "profile TEXT NOT NULL, message TEXT NOT NULL)"
+    )
+    conn.executemany(
+        "INSERT INTO conversations (profile, message) VALUES (?, ?)",
+        [("default", "Hola"), ("default", "Una microexpresión")],
+    )
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(db, "DB_NAME", path)
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    setup_sqlite_schema()
+    setup_sqlite_schema()  # idempotente
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT message, created_at FROM conversations").fetchall()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+    assert [message for message, _ in rows] == ["Hola", "Una microexpresión"]
+    assert all(created_at for _, created_at in rows)
+    assert version == len(MIGRATIONS)
+    nuevo = db.insert_conversation("default", "Mensaje nuevo")
+    assert db.fetch_conversations("default", after_id=nuevo - 1)[0]["created_at"]
+
+
+def test_archive_read_through_and_rebalance(tmp_path, monkeypatch):
+    """Los mensajes archivados se siguen leyendo igual, también tras rebalancear."""
+    import db
+    from archive_conversations import archive
+    from initialize_db import initialize_database
+    from rebalance_shards import rebalance
+
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "conv.db"))
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    initialize_database(60, num_profiles=3)
+    with db.pooled_connection() as conn:
+        old_ids = [
+            row[0]
+            for row in conn.execute(
+                "SELECT id FROM conversations WHERE profile = 'default' "
+                "ORDER BY id LIMIT 15"
+            )
+        ]
+        conn.executemany(
+            "UPDATE conversations SET created_at = '2000-01-01 00:00:00' "
+            "WHERE id = ?",
+            [(i,) for i in old_ids[::2] + old_ids[1::2]],
+        )
+        # Reanálisis de parte de los mensajes, archivados y activos
+        hot_id = conn.execute(
+            "SELECT max(id) FROM conversations WHERE profile = 'default'"
+        ).fetchone()[0]
+        conn.executemany(
+            "INSERT INTO conversation_analysis "
+            "(conversation_id, profile, study_citation, cue_score, analyzed_at) "
+            "VALUES (?, 'default', ?, ?, '2001-01-01 00:00:00')",
+            [(i, f"Estudio {i}", i / 100) for i in old_ids[:10] + [hot_id]],
+        )
+
+    def snapshot():
+        pages, after_id = [], 0
+        while True:
+            page = db.fetch_conversations("default", limit=7, after_id=after_id)
+            if not page:
+                break
+            pages.append(page)
+            after_id = page[-1]["id"]
+        return {
+            "pages": pages,
+            "offset": db.fetch_conversations("default", limit=5, offset=12),
+            "topic": db.fetch_conversations("default", limit=50, topic="emoción"),
+            "stream": list(db.iter_conversations("default", limit=50)),
+            "stats": db.fetch_profile_stats("default"),
+        }
+
+    antes = snapshot()
+    analizados = [r for r in antes["stream"] if r["cue_score"] is not None]
+    assert len(analizados) == 11
+    assert analizados[0]["study_citation"] == f"Estudio {old_ids[0]}"
+    assert dict(archive(days=30, block_size=4)) == {"default": 15}
+    with db.pooled_connection() as conn:
+        hot = conn.execute(
+            "SELECT count(*) FROM conversations WHERE profile = 'default'"
+        ).fetchone()[0]
+        blocks = conn.execute("SELECT count(*) FROM conversation_archive").fetchone()
+    assert hot == 5 and blocks[0] == 4
+    # Reimportar un mensaje archivado no crea otra copia
+    archivado = antes["stream"][0]
+    digest = db.content_hash(archivado["message"])
+    assert db.fetch_duplicate_id("default", digest) == archivado["id"]
+    assert db.insert_conversation("default", archivado["message"]) is None
+    assert ("default", digest) in set(db.iter_content_hashes())
+    assert snapshot() == antes
+    assert dict(archive(days=30)) == {}
+
+    monkeypatch.setattr(db, "DB_SHARDS", 3)
+    list(rebalance())
+    despues = snapshot()
+    assert despues["stats"] == antes["stats"]
+    assert db.insert_conversation("default", archivado["message"]) is None
+    assert db.fetch_duplicate_id("default", digest) == despues["stream"][0]["id"]
+    assert [r["message"] for p in despues["pages"] for r in p] == [
+        r["message"] for p in antes["pages"] for r in p
+    ]
+    assert [r["created_at"] for r in despues["stream"]] == [
+        r["created_at"] for r in antes["stream"]
+    ]
+    assert [r["cue_score"] for r in despues["stream"]] == [
+        r["cue_score"] for r in antes["stream"]
+    ]
+
+    # Se archiva en el shard nuevo y se vuelve al primero: el orden se conserva
+    with db.pooled_connection(db.shard_for("default")) as conn:
+        conn.execute(
+            "UPDATE conversations SET created_at = '2000-01-01 00:00:00' "
+            "WHERE profile = 'default' AND id = (SELECT min(id) FROM conversations "
+            "WHERE profile = 'default')"
+        )
+    assert dict(archive(days=30)) == {"default": 1}
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    list(rebalance())
+    de_vuelta = snapshot()
+    assert [
+        (r["message"], r["study_citation"], r["cue_score"]) for r in de_vuelta["stream"]
+    ] == [(r["message"], r["study_citation"], r["cue_score"]) for r in antes["stream"]]
+    assert de_vuelta["stats"]["message_count"] == antes["stats"]["message_count"]
+
+
+def test_rebalance_resumes_after_interruption(tmp_path, monkeypatch):
+    """Un rebalanceo interrumpido se relanza sin duplicar ni perder mensajes."""
+    import db
+    import rebalance_shards
+    from archive_conversations import archive
+    from initialize_db import initialize_database
+
+    monkeypatch.setattr(db, "DB_NAME", str(tmp_path / "conv.db"))
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    initialize_database(120, num_profiles=12, batch_size=50)
+    with db.pooled_connection() as conn:
+        conn.execute(
+            "UPDATE conversations SET created_at = '2000-01-01 00:00:00' "
+            "WHERE id IN (SELECT id FROM conversations ORDER BY id LIMIT 40)"
+        )
+    archive(days=30, block_size=3)
+
+    def snapshot(profile):
+        rows = list(db.iter_conversations(profile, limit=100))
+        stats = db.fetch_profile_stats(profile)
+        return [(r["message"], r["created_at"]) for r in rows], stats
+
+    perfiles = ["default"] + [f"perfil_{k}" for k in range(1, 12)]
+    antes = {profile: snapshot(profile) for profile in perfiles}
+
+    copy_conversations = rebalance_shards.copy_conversations
+    copy_archive_and_stats = rebalance_shards.copy_archive_and_stats
+    calls = []
+
+    def crash_mid_copy(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 5:
+            raise RuntimeError("caída")
+        copy_conversations(*args, **kwargs)
+
+    def crash_after_copy(*args, **kwargs):
+        copy_archive_and_stats(*args, **kwargs)
+        raise RuntimeError("caída")
+
+    monkeypatch.setattr(db, "DB_SHARDS", 3)
+    monkeypatch.setattr(rebalance_shards, "copy_conversations", crash_mid_copy)
+    with pytest.raises(RuntimeError):
+        list(rebalance_shards.rebalance(batch_size=2))
+    # El perfil a medias tiene tramos copiados en el destino
+    pendientes = []
+    for index in range(3):
+        with db.pooled_connection(db.shard_path(index)) as conn:
+            pendientes += conn.execute(
+                "SELECT moved FROM rebalance_progress WHERE copied = 0"
+            ).fetchall()
+    assert len(pendientes) == 1 and pendientes[0][0] > 0
+    monkeypatch.setattr(rebalance_shards, "copy_conversations", copy_conversations)
+    monkeypatch.setattr(rebalance_shards, "copy_archive_and_stats", crash_after_copy)
+    with pytest.raises(RuntimeError):
+        list(rebalance_shards.rebalance(batch_size=2))
+    monkeypatch.setattr(
+        rebalance_shards, "copy_archive_and_stats", copy_archive_and_stats
+    )
+    list(rebalance_shards.rebalance(batch_size=2))
+
+    assert list(rebalance_shards.rebalance()) == []
+    for profile in perfiles:
+        assert snapshot(profile) == antes[profile]
+    for index in range(3):
+        with db.pooled_connection(db.shard_path(index)) as conn:
+            assert conn.execute("SELECT * FROM rebalance_progress").fetchall() == []
+            shards = conn.execute(
+                "SELECT DISTINCT profile FROM conversations"
+            ).fetchall()
+        assert {db.shard_index(row[0]) for row in shards} <= {index}
+
+
+def test_content_dedup_migration_bloom_and_analysis_cache(tmp_path, monkeypatch):
+    """Los repetidos no se guardan y el análisis de lo ya visto se reutiliza.
+
+    La migración conserva las copias que ya existían, sin hash.
+    """
+    import sqlite3
+    import time
+    import db
+    import dedup
+    from initialize_db import setup_sqlite_schema
+
+    path = str(tmp_path / "repetidos.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "profile TEXT NOT NULL, message TEXT NOT NULL)"
+    )
+    conn.executemany(
+        "INSERT INTO conversations (profile, message) VALUES (?, ?)",
+        [("a", "Reenviado"), ("a", "Reenviado"), ("b", "Reenviado")],
+    )
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(db, "DB_NAME", path)
+    monkeypatch.setattr(db, "DB_SHARDS", 1)
+    setup_sqlite_schema()
+    conn = sqlite3.connect(path)
+    hashes = conn.execute("SELECT content_hash FROM conversations ORDER BY id")
+    reenviado = db.content_hash("Reenviado")
+    assert [h for (h,) in hashes] == [reenviado, None, reenviado]
+    conn.close()
+    assert db.insert_conversation("a", "Reenviado") is None
+    assert db.insert_conversation("a", "Nuevo") is not None
+    assert db.insert_conversations([("a", "Nuevo"), ("c", "Nuevo")]) == 1
+    assert "content_hash" not in db.fetch_conversations("a")[0]
+
+    index = dedup.ContentIndex(capacity=100)
+    # Sin cargar, las comprobaciones van a la base de datos
+    index.start_loading = lambda: None
+    assert index.find("a", db.content_hash("Reenviado")) is not None
+    assert index.find("a", db.content_hash("Nunca visto")) is None
+    assert index.stats()["skipped"] == 0 and index.stats()["lookups"] == 2
+    assert index.load() and index.stats()["loaded"]
+    assert index.find("a", db.content_hash("Reenviado")) is not None
+    assert index.find("a", db.content_hash("Nunca visto")) is None
+    assert index.stats()["skipped"] == 1
+    # En segundo plano
+    del index.start_loading
+    index.reset()
+    index.start_loading()
+    deadline = time.monotonic() + 5
+    while not index.stats()["loaded"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert index.stats()["loaded"] and index.stats()["entries"] == 4
+
+    bloom = dedup.BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f"clave {i}")
+    assert all(f"clave {i}" in bloom for i in range(1000))
+    falsos = sum(f"otra {i}" in bloom for i in range(10000))
+    assert falsos < 300
+
+    llamadas = []
+    monkeypatch.setattr(
+        dedup, "detect_topics", lambda message: llamadas.append(message) or []
+    )
+    monkeypatch.setattr(dedup, "analysis_cache", dedup.AnalysisCache(max_entries=10))
+    results = dedup.analyze_messages(["uno", "dos", "uno"])
+    assert results[0] == results[2]
+    assert llamadas == ["uno", "dos"]
+    dedup.analyze_message("dos")
+    assert llamadas == ["uno", "dos"]
+
+    # Al rebalancear, las copias antiguas sin hash se mueven también
+    from rebalance_shards import rebalance
+
+    shards = next(n for n in range(2, 10) if db.shard_index("a", n))
+    monkeypatch.setattr(db, "DB_SHARDS", shards)
+    assert ("a", 0, db.shard_index("a"), 3) in list(rebalance())
+    mensajes = [row["message"] for row in db.fetch_conversations("a")]
+    assert mensajes == ["Reenviado", "Reenviado", "Nuevo"]
+    assert db.fetch_profile_stats("a")["message_count"] == 3
+
+
+def test_post_and_bulk_skip_duplicate_messages(client, temp_db):
+    """Un mensaje repetido del perfil no se guarda otra vez ni cuenta en su estado."""
+    profile = f"reenvios_{uuid.uuid4().hex[:8]}"
+    data = {"profile": profile, "message": "Noté una microexpresión rara"}
+    first = client.post("/api/conversations", json=data).get_json()
+    second = client.post("/api/conversations", json=data).get_json()
+    assert first["duplicate"] is False and second["duplicate"] is True
+    assert second["study_citation"] == first["study_citation"]
+    assert second["profile_state"]["message_count"] == 1
+    other = {"profile": f"{profile}_b", "message": data["message"]}
+    response = client.post("/api/conversations", json=other)
+    assert response.get_json()["duplicate"] is False
+
+    lines = [json.dumps({"profile": profile, "message": m}) for m in ("A", "A", "B")]
+    lines.append(json.dumps(data))
+    response = client.post(
+        "/api/conversations/bulk",
+        data="\n".join(lines),
+        content_type="application/x-ndjson",
+    )
+    body = response.get_json()
+    assert body["inserted"] == 2 and body["duplicates"] == 2
+    response = client.get(f"/api/conversations?profile={profile}&limit=100")
+    mensajes = [conv["message"] for conv in response.get_json()["data"]]
+    assert sorted(mensajes) == sorted(["A", "B", data["message"]])
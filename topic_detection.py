@@ -0,0 +1,72 @@
+"""
+Módulo de detección de temas (palabras clave) en mensajes.
+Compila una única expresión regular al importar el módulo, reutilizada por las rutas.
+"""
+
+import re
+import time
+import unicodedata
+
+from metrics import topic_detection_duration
+
+# Temas en orden de prioridad y sus variantes de palabra clave
+KEYWORDS = [
+    ("microexpresión", ["microexpresion", "microexpresión"]),
+    ("carga cognitiva", ["cognitivo", "carga cognitiva"]),
+    ("fMRI", ["resonancia", "fmri", "f m r i"]),
+    ("verbal", ["paraverbal", "verbal", "verbales", "verbalidad"]),
+    ("SCAN", ["scan"]),
+    ("IA", ["inteligencia artificial", "ia"]),
+    ("emoción", ["emocional", "emoción"]),
+]
+
+# Sufijos admitidos tras una palabra clave (plurales y derivados)
+KEYWORD_SUFFIXES = ["es", "idad", "al", "ales"]
+
+
+def normalize(text):
+    """Normaliza un texto para comparación robusta (sin tildes, minúsculas)."""
+    return (
+        unicodedata.normalize("NFKD", text)
+        .encode("ASCII", "ignore")
+        .decode("utf-8")
+        .lower()
+    )
+
+
+def _build_pattern(keywords):
+    """Construye una expresión regular combinada con un grupo con nombre por tema."""
+    suffixes = "|".join(re.escape(s) for s in KEYWORD_SUFFIXES)
+    groups = []
+    group_topics = {}
+    for index, (topic, keyword_list) in enumerate(keywords):
+        variants = sorted({normalize(k) for k in keyword_list}, key=len, reverse=True)
+        group = f"t{index}"
+        group_topics[group] = topic
+        groups.append(f"(?P<{group}>{'|'.join(re.escape(v) for v in variants)})")
+    # Lookahead de ancho cero: permite coincidencias solapadas en una sola pasada
+    pattern = r"(?<!\w)(?=(?:" + "|".join(groups) + r")(?:" + suffixes + r")?(?!\w))"
+    return re.compile(pattern), group_topics
+
+
+_TOPIC_PATTERN, _GROUP_TOPICS = _build_pattern(KEYWORDS)
+_TOPIC_ORDER = {topic: index for index, (topic, _) in enumerate(KEYWORDS)}
+
+
+def detect_topics(text, normalized=False):
+    """Devuelve los temas detectados en el texto, sin repetir y por prioridad."""
+    start = time.perf_counter()
+    if not normalized:
+        text = normalize(text)
+    found = {_GROUP_TOPICS[m.lastgroup] for m in _TOPIC_PATTERN.finditer(text)}
+    topics = sorted(found, key=_TOPIC_ORDER.__getitem__)
+    topic_detection_duration.observe(time.perf_counter() - start)
+    return topics
+
+
+_TOPIC_BY_NORMALIZED = {normalize(topic): topic for topic, _ in KEYWORDS}
+
+
+def canonical_topic(name):
+    """Devuelve el nombre canónico de un tema (sin distinguir tildes ni mayúsculas)."""
+    return _TOPIC_BY_NORMALIZED.get(normalize(name).strip())
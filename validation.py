@@ -0,0 +1,127 @@
+"""
+Validación rápida de conversaciones, sin marshmallow, con límites de tamaño.
+Devuelve los errores con el mismo formato que ``ConversationSchema.validate``.
+"""
+
+import os
+from datetime import datetime
+
+MAX_MESSAGE_BYTES = int(os.environ.get("MAX_MESSAGE_BYTES", "16384"))
+MAX_PROFILE_LENGTH = int(os.environ.get("MAX_PROFILE_LENGTH", "100"))
+# Margen para el escape JSON (\uXXXX) y el resto de campos del cuerpo
+MAX_CONVERSATION_BODY_BYTES = int(
+    os.environ.get("MAX_CONVERSATION_BODY_BYTES", str(4 * MAX_MESSAGE_BYTES))
+)
+MAX_SCORE_MESSAGES = int(os.environ.get("MAX_SCORE_MESSAGES", "1000"))
+MAX_SCORE_BODY_BYTES = int(
+    os.environ.get("MAX_SCORE_BODY_BYTES", str(4 * 1024 * 1024))
+)
+
+FIELDS = ("profile", "message")
+MISSING = "Missing data for required field."
+NULL = "Field may not be null."
+NOT_STRING = "Not a valid string."
+UNKNOWN = "Unknown field."
+INVALID_TYPE = "Invalid input type."
+NOT_LIST = "Not a valid list."
+INVALID_DATETIME = "Not a valid datetime."
+
+# Formato de ``created_at`` en la importación masiva (el de datetime() de SQLite)
+CREATED_AT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _field_error(value, max_length, max_bytes):
+    """Mensaje de error de un campo de texto, o None si es válido."""
+    if value is None:
+        return NULL
+    if type(value) is not str:
+        return NOT_STRING
+    if max_length is not None and len(value) > max_length:
+        return f"Longer than maximum length {max_length}."
+    # len(value) es un límite inferior del tamaño en UTF-8: solo se codifica si hace
+    # falta, y como mucho cada carácter ocupa 4 bytes
+    if max_bytes is not None and 4 * len(value) > max_bytes:
+        if len(value.encode("utf-8", "surrogatepass")) > max_bytes:
+            return f"Longer than maximum size {max_bytes} bytes."
+    return None
+
+
+def validate_conversation(data):
+    """Valida una conversación; devuelve los errores por campo (vacío si es válida)."""
+    if type(data) is not dict:
+        return {"_schema": [INVALID_TYPE]}
+    errors = {}
+    present = 0
+    for name, max_length, max_bytes in (
+        ("profile", MAX_PROFILE_LENGTH, None),
+        ("message", None, MAX_MESSAGE_BYTES),
+    ):
+        if name not in data:
+            errors[name] = [MISSING]
+            continue
+        present += 1
+        error = _field_error(data[name], max_length, max_bytes)
+        if error:
+            errors[name] = [error]
+    if len(data) > present:
+        for key in data:
+            if key not in FIELDS:
+                errors[key] = [UNKNOWN]
+    return errors
+
+
+def _created_at_error(value):
+    """Mensaje de error de un ``created_at``, o None si es válido."""
+    if type(value) is not str:
+        return NOT_STRING
+    try:
+        datetime.strptime(value, CREATED_AT_FORMAT)
+    except ValueError:
+        return INVALID_DATETIME
+    return None
+
+
+def validate_conversations(records):
+    """Valida una lista de conversaciones; errores indexados por posición.
+
+    Además de los campos de ``validate_conversation`` admite ``created_at``
+    opcional (``AAAA-MM-DD HH:MM:SS``), la fecha original de un mensaje importado.
+    """
+    errors = {}
+    for index, record in enumerate(records):
+        created_at_error = None
+        if type(record) is dict and "created_at" in record:
+            record = dict(record)
+            created_at_error = _created_at_error(record.pop("created_at"))
+        record_errors = validate_conversation(record)
+        if created_at_error:
+            record_errors["created_at"] = [created_at_error]
+        if record_errors:
+            errors[index] = record_errors
+    return errors
+
+
+def validate_score_request(data):
+    """Valida el cuerpo ``{"messages": [...]}`` de la puntuación de indicios."""
+    if type(data) is not dict:
+        return {"_schema": [INVALID_TYPE]}
+    errors = {key: [UNKNOWN] for key in data if key != "messages"}
+    if "messages" not in data:
+        errors["messages"] = [MISSING]
+        return errors
+    messages = data["messages"]
+    if type(messages) is not list:
+        errors["messages"] = [NOT_LIST]
+    elif not 1 <= len(messages) <= MAX_SCORE_MESSAGES:
+        errors["messages"] = [
+            f"Length must be between 1 and {MAX_SCORE_MESSAGES}."
+        ]
+    else:
+        item_errors = {}
+        for index, message in enumerate(messages):
+            error = _field_error(message, None, MAX_MESSAGE_BYTES)
+            if error:
+                item_errors[index] = [error]
+        if item_errors:
+            errors["messages"] = item_errors
+    return errors
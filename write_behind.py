@@ -0,0 +1,201 @@
+"""
+Cola de escritura diferida (write-behind) para las inserciones de conversaciones.
+Un hilo en segundo plano agrupa las filas y las escribe en una sola transacción.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from storage import insert_conversations
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# Activación y ajustes configurables por entorno
+WRITE_BEHIND_ENABLED = os.environ.get("DB_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_BATCH = int(os.environ.get("DB_WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_DELAY_MS = int(os.environ.get("DB_WRITE_BEHIND_DELAY_MS", "50"))
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get("DB_WRITE_BEHIND_QUEUE_SIZE", "10000"))
+WRITE_BEHIND_PUT_TIMEOUT = float(os.environ.get("DB_WRITE_BEHIND_PUT_TIMEOUT", "0.5"))
+WRITE_BEHIND_RETRIES = int(os.environ.get("DB_WRITE_BEHIND_RETRIES", "3"))
+WRITE_BEHIND_RETRY_MS = int(os.environ.get("DB_WRITE_BEHIND_RETRY_MS", "100"))
+WRITE_BEHIND_DEAD_LETTER = os.environ.get(
+    "DB_WRITE_BEHIND_DEAD_LETTER", "write_behind_dead_letter.jsonl"
+)
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Cola acotada drenada por un hilo escritor que agrupa filas por transacción.
+
+    Las filas se escriben cada ``max_rows`` elementos o ``max_delay_ms`` milisegundos,
+    lo que ocurra antes. Si la cola está llena, ``put`` espera ``put_timeout``
+    segundos y después lanza ``queue.Full`` para que el llamante aplique backpressure.
+    Si el lote falla se reintenta ``retries`` veces con espera exponencial desde
+    ``retry_ms`` milisegundos (las filas ya escritas se descartan por repetidas);
+    si sigue fallando, sus filas se añaden en NDJSON a ``dead_letter``, que se
+    puede reimportar con ``bulk_import.py --format ndjson``.
+    """
+
+    def __init__(
+        self,
+        writer=insert_conversations,
+        max_rows=WRITE_BEHIND_BATCH,
+        max_delay_ms=WRITE_BEHIND_DELAY_MS,
+        maxsize=WRITE_BEHIND_QUEUE_SIZE,
+        put_timeout=WRITE_BEHIND_PUT_TIMEOUT,
+        retries=WRITE_BEHIND_RETRIES,
+        retry_ms=WRITE_BEHIND_RETRY_MS,
+        dead_letter=WRITE_BEHIND_DEAD_LETTER,
+    ):
+        self.writer = writer
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.maxsize = maxsize
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_delay = retry_ms / 1000.0
+        self.dead_letter = dead_letter
+        self.retried = 0
+        self.dead_lettered = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._pid = os.getpid()
+
+    def _ensure_started(self):
+        """Arranca el hilo escritor si no está activo en este proceso."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Proceso hijo tras un fork: el hilo y la cola del padre no sirven
+                self._queue = queue.Queue(self.maxsize)
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True
+                )
+                self._thread.start()
+
+    def put(self, profile, message, topics=None):
+        """Encola una conversación; lanza ``queue.Full`` si no hay hueco a tiempo.
+
+        ``topics`` son los temas ya detectados, para no repetir la detección.
+        """
+        self._ensure_started()
+        self._queue.put((profile, message, topics), timeout=self.put_timeout)
+
+    def pending(self):
+        """Número aproximado de filas pendientes de escribir."""
+        return self._queue.qsize()
+
+    def _collect(self, first):
+        """Agrupa filas hasta alcanzar el tamaño de lote o el plazo máximo."""
+        rows = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(rows) < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return rows, True
+            rows.append(item)
+        return rows, False
+
+    def _write(self, rows):
+        """Escribe un lote con reintentos; si no lo consigue va a ``dead_letter``."""
+        for attempt in range(self.retries + 1):
+            try:
+                self.writer(rows)
+                return
+            except Exception:
+                logger.exception(
+                    "No se pudieron escribir %d conversaciones (intento %d de %d)",
+                    len(rows),
+                    attempt + 1,
+                    self.retries + 1,
+                )
+            if attempt < self.retries:
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self.retry_delay * 2**attempt)
+        try:
+            with open(self.dead_letter, "a", encoding="utf-8") as dead_letter:
+                for profile, message, _ in rows:
+                    record = {"profile": profile, "message": message}
+                    dead_letter.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError:
+            logger.exception("No se pudo guardar el lote en %s", self.dead_letter)
+        with self._lock:
+            self.dead_lettered += len(rows)
+
+    def stats(self):
+        """Reintentos de lotes y filas enviadas a ``dead_letter``."""
+        with self._lock:
+            return {"retried": self.retried, "dead_lettered": self.dead_lettered}
+
+    def _run(self):
+        """Bucle del hilo escritor."""
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            rows, stop = self._collect(item)
+            self._write(rows)
+            for _ in rows:
+                self._queue.task_done()
+            if stop:
+                self._queue.task_done()
+                return
+
+    def flush(self):
+        """Bloquea hasta que todas las filas encoladas se hayan escrito."""
+        self._queue.join()
+
+    def close(self):
+        """Escribe las filas pendientes y detiene el hilo escritor."""
+        thread = self._thread
+        if thread is None or not thread.is_alive() or self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        thread.join()
+
+
+write_behind_queue = WriteBehindQueue()
+atexit.register(write_behind_queue.close)
+
+
+def _collect_write_behind_metrics():
+    """Expone la cola diferida y sus fallos de escritura como métricas."""
+    stats = write_behind_queue.stats()
+    return [
+        (
+            "trueliebot_write_behind_pending",
+            "gauge",
+            "Filas pendientes en la cola de escritura diferida.",
+            [({}, write_behind_queue.pending())],
+        ),
+        (
+            "trueliebot_write_behind_failures_total",
+            "counter",
+            "Fallos de escritura diferida: lotes reintentados y filas descartadas.",
+            [
+                ({"result": "retried"}, stats["retried"]),
+                ({"result": "dead_lettered"}, stats["dead_lettered"]),
+            ],
+        ),
+    ]
+
+
+register_collector(_collect_write_behind_metrics)